@@ -0,0 +1,13 @@
+CREATE INDEX Results_DataSource_index ON Results (DataSource);
+CREATE INDEX Results_ParamGroup_index ON Results (ParamGroup);
+CREATE INDEX Results_Param_index ON Results (Param);
+CREATE INDEX Results_SampleDate_index ON Results (SampleDate);
+CREATE INDEX Results_SampleId_index ON Results (SampleId);
+CREATE INDEX Results_StationId_index ON Results (StationId);
+
+CREATE INDEX Stations_StateCode_index ON Stations (StateCode);
+CREATE INDEX Stations_CountyCode_index ON Stations (CountyCode);
+CREATE INDEX Stations_StationType_index ON Stations (StationType);
+CREATE INDEX Stations_StationId_index ON Stations (StationId);
+CREATE INDEX Stations_HUC8_index ON Stations (HUC8);
+CREATE INDEX Stations_OrgId_index ON Stations (OrgId);
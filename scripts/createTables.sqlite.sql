@@ -0,0 +1,91 @@
+DROP TABLE IF EXISTS Results;
+DROP TABLE IF EXISTS Stations;
+DROP TABLE IF EXISTS Params;
+
+CREATE TABLE Results(
+    Id INTEGER PRIMARY KEY AUTOINCREMENT,
+    AnalysisDate TEXT NULL,
+    AnalytMeth TEXT NULL,
+    AnalytMethId TEXT NULL,
+    AutoQual TEXT NULL,
+    CAS_Reg TEXT NULL,
+    Chrg REAL NULL,
+    DataSource TEXT NULL,
+    DetectCond TEXT NULL,
+    IdNum TEXT NULL,
+    LabComments TEXT NULL,
+    LabName TEXT NULL,
+    Lat_Y REAL NULL,
+    LimitType TEXT NULL,
+    Lon_X REAL NULL,
+    MDL REAL NULL,
+    MDLUnit TEXT NULL,
+    MethodDescript TEXT NULL,
+    OrgId TEXT NULL,
+    OrgName TEXT NULL,
+    Param TEXT NULL,
+    ParamGroup TEXT NULL,
+    ProjectId TEXT NULL,
+    QualCode TEXT NULL,
+    ResultComment TEXT NULL,
+    ResultStatus TEXT NULL,
+    ResultValue REAL NULL,
+    SampComment TEXT NULL,
+    SampDepth REAL NULL,
+    SampDepthRef TEXT NULL,
+    SampDepthU TEXT NULL,
+    SampEquip TEXT NULL,
+    SampFrac TEXT NULL,
+    SampleDate TEXT NULL,
+    SampleTime TEXT NULL,
+    SampleId TEXT NULL,
+    SampMedia TEXT NULL,
+    SampMeth TEXT NULL,
+    SampMethName TEXT NULL,
+    SampType TEXT NULL,
+    StationId TEXT NULL,
+    Unit TEXT NULL,
+    USGSPCode TEXT NULL
+);
+
+CREATE TABLE Stations(
+    Id INTEGER PRIMARY KEY AUTOINCREMENT,
+    OrgId TEXT NULL,
+    OrgName TEXT NULL,
+    StationId TEXT NOT NULL,
+    StationName TEXT NULL,
+    StationType TEXT NULL,
+    StationComment TEXT NULL,
+    HUC8 TEXT NULL,
+    Lon_X REAL NULL,
+    Lat_Y REAL NULL,
+    HorAcc REAL NULL,
+    HorAccUnit TEXT NULL,
+    HorCollMeth TEXT NULL,
+    HorRef TEXT NULL,
+    Elev REAL NULL,
+    ElevUnit TEXT NULL,
+    ElevAcc REAL NULL,
+    ElevAccUnit TEXT NULL,
+    ElevMeth TEXT NULL,
+    ElevRef TEXT NULL,
+    StateCode INTEGER NULL,
+    CountyCode INTEGER NULL,
+    Aquifer TEXT NULL,
+    FmType TEXT NULL,
+    AquiferType TEXT NULL,
+    ConstDate TEXT NULL,
+    Depth REAL NULL,
+    DepthUnit TEXT NULL,
+    HoleDepth REAL NULL,
+    HoleDUnit TEXT NULL,
+    DemElevM REAL NULL,
+    DataSource TEXT NULL,
+    WIN INTEGER NULL,
+    -- well known text in NAD83 UTM zone 12N (26912)
+    Shape TEXT NULL
+);
+
+CREATE TABLE Params(
+    Param TEXT NULL
+);
@@ -0,0 +1,6 @@
+DELETE FROM Params;
+
+INSERT INTO Params
+SELECT DISTINCT Param
+FROM Results
+WHERE Param IS NOT NULL;
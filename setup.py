@@ -68,10 +68,11 @@ setup(
     ],
     install_requires=[
         'docopt==0.6.2',
-        'pyodbc==3.0.10',
-        'pyproj==1.9.4',
+        'pyodbc==4.0.30',
+        'pyproj>=2.1',
         'dateutils==0.6.6',
-        'requests==2.7.0'
+        'requests>=2.18',
+        'numpy>=1.17'
     ],
     dependency_links=[
     ],
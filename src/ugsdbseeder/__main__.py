@@ -5,18 +5,28 @@
 UGS Chemistry database seeder
 Usage:
   ugsdbseeder create-tables <configuration>
-  ugsdbseeder seed <source> <file_location> <configuration>
+  ugsdbseeder seed <source> <file_location> <configuration> [--defer-indices] [--temp-location=<temp_location>]
+                                                           [--workers=<workers>] [--resume]
+  ugsdbseeder reseed-samples <file_location> <configuration> <sample_id>...
   ugsdbseeder update <source> <configuration> [--file-location=<file_location>] [--post-process]
+                                              [--cache-location=<cache_location>] [--offline]
   ugsdbseeder postprocess <configuration>
   ugsdbseeder (-h | --help | --version)
 Options:
   -h --help                         Show this screen.
   -v --version                      Show version.
   --file-location=<file_location>   The parent location of the programs data.
+  --defer-indices                   Disable the nonclustered and spatial indices while seeding and rebuild them once at the end.
+  --temp-location=<temp_location>   The folder for temporary import files or :memory:. Defaults to the system temp folder.
+  --workers=<workers>               The number of processes seeding WQP result files [default: 1].
+  --resume                          Skip the work that a failed seed committed instead of starting over.
+  --cache-location=<cache_location> The folder to cache the WQP responses in and revalidate them from.
+  --offline                         Only replay the cached WQP responses.
 Argument values:
-  <configuration>       dev, stage, prod
+  <configuration>       dev, stage, prod, local (an embedded sqlite file)
   <source>              WQP, SDWIS, DOGM, UDWR, UGS, or "" for all
   <file_location>       the parent location of the programs data "c:\data"
+  <sample_id>           the WQP ActivityIdentifier of a sample to replace
 '''
 
 import sys
@@ -31,12 +41,22 @@ def main():
     if arguments['seed']:
         return seeder.seed(source=arguments['<source>'],
                            file_location=arguments['<file_location>'],
-                           who=arguments['<configuration>'])
+                           who=arguments['<configuration>'],
+                           defer_indices=arguments['--defer-indices'],
+                           temp_location=arguments['--temp-location'],
+                           workers=int(arguments['--workers']),
+                           resume=arguments['--resume'])
+    elif arguments['reseed-samples']:
+        return seeder.reseed_samples(file_location=arguments['<file_location>'],
+                                     who=arguments['<configuration>'],
+                                     sample_ids=arguments['<sample_id>'])
     elif arguments['update']:
         return seeder.update(source=arguments['<source>'],
                              who=arguments['<configuration>'],
                              location=arguments['--file-location'],
-                             postprocess=arguments['--post-process'])
+                             postprocess=arguments['--post-process'],
+                             cache_location=arguments['--cache-location'],
+                             offline=arguments['--offline'])
     elif arguments['create-tables']:
         return seeder.create_tables(who=arguments['<configuration>'])
     elif arguments['postprocess']:
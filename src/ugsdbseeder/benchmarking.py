@@ -1,4 +1,7 @@
-from time import clock
+try:
+    from time import perf_counter as clock
+except ImportError:
+    from time import clock
 from contextlib import contextmanager
 
 
@@ -6,6 +6,7 @@ models
 ----------------------------------
 The basic models
 '''
+from . import schema
 
 
 class Concentration(object):
@@ -209,3 +210,132 @@ class Concentration(object):
             pass
 
         return value
+
+
+class Record(object):
+
+    """
+    a row with a fixed layout generated from a schema. the values are stored in schema order
+    so they can be inserted without reordering or copying. it acts like the dictionary rows
+    it replaces
+    """
+
+    __slots__ = ('_values', '_extras')
+
+    #: the schema, field names and their column index. set by the generated types
+    schema = None
+    fields = []
+    index = {}
+
+    #: the keys outside of the schema a row can carry through the pipeline
+    extras = ()
+
+    def __init__(self, values=None):
+        if values is None:
+            values = [None] * len(self.fields)
+
+        self._values = values
+        self._extras = None
+
+    def values(self):
+        """
+        the list of values in schema order. this is not a copy
+        """
+        return self._values
+
+    def keys(self):
+        keys = list(self.fields)
+
+        if self._extras:
+            keys.extend(self._extras.keys())
+
+        return keys
+
+    def items(self):
+        return [(key, self[key]) for key in self.keys()]
+
+    def get(self, key, default=None):
+        try:
+            return self[key]
+        except KeyError:
+            return default
+
+    def __getitem__(self, key):
+        if key in self.index:
+            return self._values[self.index[key]]
+
+        if self._extras and key in self._extras:
+            return self._extras[key]
+
+        raise KeyError(key)
+
+    def __setitem__(self, key, value):
+        if key in self.index:
+            self._values[self.index[key]] = value
+
+            return
+
+        if self._extras is None:
+            self._extras = {}
+
+        self._extras[key] = value
+
+    def __delitem__(self, key):
+        if key in self.index:
+            #: schema fields are always present
+            self._values[self.index[key]] = None
+
+            return
+
+        if not self._extras or key not in self._extras:
+            raise KeyError(key)
+
+        del self._extras[key]
+
+    def __contains__(self, key):
+        return key in self.index or bool(self._extras and key in self._extras)
+
+    def __iter__(self):
+        return iter(self.keys())
+
+    def __len__(self):
+        return len(self.fields) + len(self._extras or {})
+
+    def __eq__(self, other):
+        try:
+            return dict(self.items()) == dict(other.items())
+        except AttributeError:
+            return NotImplemented
+
+    def __ne__(self, other):
+        equal = self.__eq__(other)
+
+        if equal is NotImplemented:
+            return equal
+
+        return not equal
+
+    __hash__ = None
+
+    def __repr__(self):
+        return '{}({})'.format(type(self).__name__, dict(self.items()))
+
+
+def record_type(name, row_schema, extras=()):
+    """
+    creates a Record type for a schema
+    """
+    fields = list(row_schema.keys())
+
+    return type(name, (Record,), {
+        '__slots__': (),
+        'schema': row_schema,
+        'fields': fields,
+        'index': dict((field, i) for i, field in enumerate(fields)),
+        'extras': extras
+    })
+
+
+#: gdb stations carry their arcpy point until it is reprojected
+Station = record_type('Station', schema.station, extras=('Shape@XY',))
+Result = record_type('Result', schema.result)
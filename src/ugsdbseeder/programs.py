@@ -9,20 +9,36 @@ the different source programs
 import csv
 import re
 from . import schema
-import sqlite3
-import os
 from collections import OrderedDict
-from datetime import datetime
+from concurrent.futures import ProcessPoolExecutor, ThreadPoolExecutor, as_completed
+from contextlib import contextmanager
+from datetime import datetime, timedelta
 from dateutil.parser import parse as dateparser
 from glob import glob
 from os.path import join, isdir, basename, splitext
+from shutil import rmtree
+from tempfile import mkdtemp
+from urllib.parse import quote
+from zlib import crc32
 from .querycsv import query_csv
-from functools import partial
-from .services import Caster, Normalizer, ChargeBalancer, HttpClient
+from .sql import create_cursor as create_odbc_cursor, find_new_keys, key_statements
+from .models import Result, Station
+from .services import (Caster, Checkpoint, Normalizer, ChargeBalancer, CsvGrouper, CsvIndex, HttpClient, RowBuffer,
+                       StationRegistry)
 from .benchmarking import get_milliseconds
 
 
 class Program(object):
+    #: the fields that identify a result row as already loaded
+    result_keys = ['SampleId']
+
+    #: where SampleId is in a result row
+    sample_id_index = list(schema.result.keys()).index('SampleId')
+
+    #: where the results being seeded come from in the checkpoint. files for wqp
+    checkpoint_source = ''
+    checkpoint = None
+
     most_recent_result_query = ('SELECT max(SampleDate) FROM [UGSWaterChemistry].[ugswaterchemistry].[Results]'
                                 ' WHERE [DataSource] = \'{}\'')
     new_stations_query = ('SELECT * FROM (VALUES{}) AS t(StationId) WHERE NOT EXISTS('
@@ -62,6 +78,72 @@ class Program(object):
 
         return self.cursor.fetchall()
 
+    def _buffer_results(self, rows):
+        '''collects result rows across sample sets so they are inserted in batches
+        rows: list(list(values)) the ordered result rows ready for insertion
+        '''
+
+        if not hasattr(self, 'result_buffer') or not self.result_buffer:
+            self.result_buffer = RowBuffer(self._insert_results)
+
+        self.result_buffer.extend(rows)
+
+    def _flush_results(self):
+        '''inserts any result rows still waiting in the buffer'''
+
+        if hasattr(self, 'result_buffer') and self.result_buffer:
+            self.result_buffer.flush()
+
+    def _insert_results(self, rows):
+        if not hasattr(self, 'cursor') or not self.cursor:
+            self.cursor = self.cursor_factory(self.db['connection_string'])
+
+        if not self.checkpoint:
+            self._insert_rows(rows, self.sql['result_insert'], self.cursor)
+
+            return
+
+        #: one transaction so the checkpoint is written at the same boundary as the commit
+        self._insert_rows(rows, self.sql['result_insert'], self.cursor, batch_size=len(rows))
+        self.checkpoint.complete_samples(self.datasource, self.checkpoint_source,
+                                         set(row[self.sample_id_index] for row in rows))
+
+    def _is_complete(self, step):
+        '''whether the step was committed by an earlier seed'''
+        if not self.checkpoint:
+            return False
+
+        if self.checkpoint.is_complete(self.datasource, step):
+            self.logger.info('- {}: already seeded. skipping'.format(step))
+
+            return True
+
+        return False
+
+    def _complete(self, step):
+        if self.checkpoint:
+            self.checkpoint.complete(self.datasource, step)
+
+    def _get_completed_samples(self):
+        '''the sample ids of checkpoint_source that were committed by an earlier seed'''
+        if not self.checkpoint:
+            return set()
+
+        completed = self.checkpoint.get_completed_samples(self.datasource, self.checkpoint_source)
+
+        if completed:
+            self.logger.info('- skipping {} samples that are already seeded'.format(len(completed)))
+
+        return completed
+
+    def _skip_completed_samples(self, sample_ids):
+        '''yields the `(id,)` sample id rows that were not committed by an earlier seed'''
+        completed = self._get_completed_samples()
+
+        for sample_id in sample_ids:
+            if Checkpoint.key(sample_id[0]) not in completed:
+                yield sample_id
+
 
 class WqpProgram(Program):
     '''class for handling wqp csv files'''
@@ -70,18 +152,46 @@ class WqpProgram(Program):
 
     TEMPDB = 'temp.sqlite3'
 
+    #: the sqlite location that keeps the import database in memory
+    IN_MEMORY = ':memory:'
+
+    #: the number of result rows to transform together
+    result_batch_size = 5000
+
+    #: the days of results in each update request
+    update_window_days = 30
+
+    #: the number of update requests made at once
+    fetch_workers = 4
+
     wqp_url = ('http://www.waterqualitydata.us/{}/search?sampleMedia=Water&startDateLo={}&startDateHi={}&'
-               'bBox=-115%2C35.5%2C-108%2C42.5&mimeType=csv')
+               'bBox={}&mimeType=csv')
+
+    station_url = 'http://www.waterqualitydata.us/Station/search?siteid={}&mimeType=csv'
+
+    #: the longest station url to request. the service and proxies reject longer urls
+    station_url_length = 2000
+
+    #: the west, south, east and north edges of the area to request
+    bbox = (-115, 35.5, -108, 42.5)
+
+    #: the columns and rows of tiles the bbox is split into for update requests
+    tile_grid = (2, 2)
+
+    #: tiles reporting more results than this are split in four
+    tile_max_results = 250000
+
+    #: the most times a tile is split
+    tile_max_depth = 3
 
     fields = {'sample_id': 'ActivityIdentifier', 'monitoring_location_id': 'MonitoringLocationIdentifier'}
 
     sql = {
-        'distinct_sample_id': 'select distinct({}) from {}',
-        'sample_id': 'select * from {} where {} = \'{}\'',
         'wqxids': 'select {0} from {1} where {0} LIKE \'%_WQX%\'',
-        'new_results': ('SELECT * FROM (VALUES{}) AS t(SampleId) WHERE NOT EXISTS('
-                        'SELECT 1 FROM [UGSWaterChemistry].[ugswaterchemistry].[Results] WHERE [SampleId] = t.SampleId)'),
-        'create_index': 'CREATE INDEX IF NOT EXISTS "ActivityIdentifier_{0}" ON "{0}" ("ActivityIdentifier" ASC)'
+        'new_results': key_statements('Results', ['SampleId']),
+        'station_coordinates': 'SELECT StationId, Lon_X, Lat_Y FROM Stations WHERE Lon_X IS NOT NULL AND Lat_Y IS NOT NULL',
+        #: charge balance rows are created without a DataSource
+        'delete_results': 'DELETE FROM Results WHERE SampleId = ? AND (DataSource = ? OR DataSource IS NULL)'
     }
 
     wqx_re = re.compile('(_WQX)-')
@@ -174,10 +284,13 @@ class WqpProgram(Program):
                  source=None,
                  secrets=None,
                  sql_statements={},
-                 update_row=None,
+                 update_rows=None,
                  insert_rows=None,
                  cursor_factory=None,
-                 arcpy=None):
+                 arcpy=None,
+                 temp_location=None,
+                 workers=1,
+                 checkpoint=None):
         self.logger = logger
         '''create a new WQP program
         db - the connection string for the database to seed
@@ -185,17 +298,28 @@ class WqpProgram(Program):
         update - boolean value whether we are seeding or updating
         secrets - ignored. Valid for sdwis only.
         sql_statements - common sql statements for inserting into stations and results
-        update_row - the function to reproject a point and set the DataSource
+        update_rows - the function to reproject the points of a batch of rows and set the DataSource
         insert_rows - the function to batch insert rows
         cursor_factory - the function to create pyodbc connection_string
         arcpy - ignored. for gdb programs only
+        temp_location - the folder for temporary files or :memory: for an in memory import database.
+                        defaults to the system temp folder
+        workers - the number of processes seeding result files
+        checkpoint - the optional checkpoint store to record and skip committed work
         '''
         self.db = db
-        self._update_row = update_row
+        self.source = source
+        self.temp_location = temp_location
+        self.workers = workers or 1
+        self._update_rows = update_rows
         self._insert_rows = insert_rows
         self.cursor_factory = cursor_factory
+        self.checkpoint = checkpoint
         self.sql.update(sql_statements)
 
+        #: the coordinates of seeded stations to set on their results
+        self.station_registry = StationRegistry()
+
         #: if update is True then we are updating
         if not update:
             #: check that source exists wqp/results and wqp/stations
@@ -234,10 +358,8 @@ class WqpProgram(Program):
                 raise Exception('No last updated date. You should seed some data first.')
 
             self.logger.info('fetching records after {}'.format(last_updated))
-            #: get new results from wqp service
-            result_url = self._format_url(self.wqp_url, 'Result', last_updated)
-            #: group them as if they were read from querycsv
-            new_results = self._group_rows_by_id(HttpClient.get_csv(result_url, self.logger))
+            #: get new results from wqp service grouped as if they were read from querycsv
+            new_results = self._fetch_results(last_updated)
             #: remove results that have a sample id already in the database
             new_results = self._remove_existing_results(new_results)
             #: find the station ids from the new results that aren't in the database
@@ -248,25 +370,64 @@ class WqpProgram(Program):
             if new_station_ids and len(new_station_ids) > 0:
                 self.logger.info('of the new stations found, attempting to insert {}'.format(len(new_station_ids)))
 
-                station_url = self._format_url(self.wqp_url, 'Station', last_updated)
-                new_stations = HttpClient.get_csv(station_url, self.logger)
+                self._fetch_stations(new_station_ids)
+            else:
+                self.logger.info('all stations already in database')
+            self._seed_sample_sets(list(new_results.values()))
+
+            self._flush_results()
+
+        finally:
+            if hasattr(self, 'cursor'):
+                del self.cursor
 
-                if not new_stations:
-                    raise Exception('WQP service should have returned results but result is empty. {}'.format(
-                        station_url))
+    def reseed_samples(self, sample_ids):
+        '''replace the results of the sample ids with their rows from the result csv files.
+        the rows are read through the sidecar index of each file. returns the number of sample sets
+        '''
+        if not hasattr(self, 'results_folder'):
+            raise Exception('You must pass a file location to reseed samples.')
 
-                header = next(new_stations)
+        sample_ids = list(OrderedDict.fromkeys(sample_ids))
+        sample_sets = OrderedDict()
 
-                stations = self._extract_stations_by_id(new_stations, new_station_ids, header)
-                wqx = self._get_wqx_duplicate_ids(stations)
+        try:
+            for csv_file in self._get_files(self.results_folder):
+                header, rows_for_id = CsvIndex(csv_file, self.fields['sample_id']).get_rows(sample_ids)
 
-                self._seed_stations(stations, header=header, wqx=wqx)
+                for sample_id, rows in rows_for_id.items():
+                    sample_sets.setdefault(sample_id, []).extend(
+                        self._etl_column_names(rows, self.result_config, header=header))
+
+            missing = [sample_id for sample_id in sample_ids if sample_id not in sample_sets]
+            if missing:
+                self.logger.warning('{} sample ids not found: {}'.format(len(missing), ', '.join(missing)))
+
+            if not hasattr(self, 'cursor') or not self.cursor:
+                self.cursor = self.cursor_factory(self.db['connection_string'])
+
+            #: stage the new rows before anything is deleted
+            staged = []
+            self.result_buffer = RowBuffer(staged.extend)
+
+            sample_sets_seeded = self._seed_sample_sets(sample_sets.values())
+
+            self._flush_results()
+
+            #: the charge balance rows are replaced with the results
+            for sample_id in sample_sets.keys():
+                self.cursor.execute(self.sql['delete_results'], (sample_id, self.datasource))
+
+            #: one transaction so a failed insert rolls back the deletes
+            if staged:
+                self._insert_rows(staged, self.sql['result_insert'], self.cursor, batch_size=len(staged))
             else:
-                self.logger.info('all stations already in database')
-            for samples_for_id in list(new_results.values()):
-                self._seed_results(samples_for_id)
+                self.cursor.commit()
 
+            return sample_sets_seeded
         finally:
+            self.result_buffer = None
+
             if hasattr(self, 'cursor'):
                 del self.cursor
 
@@ -274,6 +435,10 @@ class WqpProgram(Program):
         self.logger.info('processing {} stations...'.format(self.datasource))
 
         for csv_file in self._get_files(self.stations_folder):
+            step = 'stations/{}'.format(basename(csv_file))
+            if self._is_complete(step):
+                continue
+
             #: create csv reader
             with open(csv_file, 'r') as f:
                 self.logger.info('- {}'.format(basename(csv_file)))
@@ -286,42 +451,99 @@ class WqpProgram(Program):
                 header = next(reader)
 
                 self._seed_stations(reader, header=header, wqx=wqx)
+                self._complete(step)
 
                 self.logger.info('- {}: done'.format(basename(csv_file)))
 
         self.logger.info('processing {} stations done.'.format(self.datasource))
         self.logger.info('processing {} results...'.format(self.datasource))
 
-        for csv_file in self._get_files(self.results_folder):
-            self.logger.info('- {}'.format(basename(csv_file)))
+        csv_files = [csv_file for csv_file in self._get_files(self.results_folder)
+                     if not self._is_complete(self._get_result_step(csv_file))]
 
-            #: create sqlite db and get unique sample ids
-            unique_sample_ids = self._get_distinct_sample_ids_from(csv_file)
+        if self.workers > 1 and csv_files:
+            self._seed_result_files_in_parallel(csv_files)
+        else:
+            for csv_file in csv_files:
+                self.logger.info('- {}'.format(basename(csv_file)))
 
-            try:
-                #: this needs to be done after get_distinct so that the table is created in the db
-                self._add_sample_index(csv_file)
+                self._seed_result_file(csv_file)
+                self._complete(self._get_result_step(csv_file))
+
+                self.logger.info('- {}: done'.format(basename(csv_file)))
+
+        self._flush_results()
 
-                sample_sets = 0
-                sets_start = get_milliseconds()
+        self.logger.info('processing {} results done.'.format(self.datasource))
 
-                for sample_id in unique_sample_ids:
-                    samples = self._get_samples_for_id(sample_id, csv_file)
+    def _seed_result_files_in_parallel(self, csv_files):
+        '''seed the result files across a pool of worker processes. when there are fewer files than workers
+        the files are split into shards of sample ids. every task is attempted before the failures are raised
+        '''
+        shards = max(1, self.workers // len(csv_files))
+        tasks = [(csv_file, (shard, shards)) for csv_file in csv_files for shard in range(shards)]
+        arguments = self._get_worker_arguments()
 
-                    self._seed_results(samples)
+        self.logger.info('- seeding {} files in {} tasks with {} workers'.format(len(csv_files), len(tasks), self.workers))
 
-                    sample_sets += 1
-                    elapsed = get_milliseconds() - sets_start
-                    if sample_sets % 5000 == 0:
-                        self.logger.info('{} total sample sets (avg {} milliseconds per set)'.format(sample_sets, round(
-                            elapsed / sample_sets, 5)))
+        sample_sets = 0
+        failures = []
+        shards_done = dict((csv_file, 0) for csv_file in csv_files)
 
-            finally:
-                #: in case something goes wrong always clean up the db
-                os.remove(self.TEMPDB)
-            self.logger.info('- {}: done'.format(basename(csv_file)))
+        with ProcessPoolExecutor(max_workers=self.workers) as executor:
+            futures = dict((executor.submit(seed_result_file, arguments, csv_file, shard), (csv_file, shard))
+                           for csv_file, shard in tasks)
 
-        self.logger.info('processing {} results done.'.format(self.datasource))
+            for future in as_completed(futures):
+                csv_file, (shard, shards) = futures[future]
+                name = '{} {}/{}'.format(basename(csv_file), shard + 1, shards)
+
+                try:
+                    sample_sets += future.result()
+                except Exception as e:
+                    self.logger.error('- {}: failed. {}'.format(name, e))
+                    failures.append(name)
+
+                    continue
+
+                self.logger.info('- {}: done. {} total sample sets'.format(name, sample_sets))
+
+                shards_done[csv_file] += 1
+                if shards_done[csv_file] == shards:
+                    self._complete(self._get_result_step(csv_file))
+
+        if failures:
+            raise Exception('{} of {} result tasks failed: {}'.format(len(failures), len(tasks), ', '.join(failures)))
+
+    def _get_worker_arguments(self):
+        '''the arguments to create this program again in a worker process'''
+        return {
+            'logger': self.logger,
+            'db': self.db,
+            'update': False,
+            'source': self.source,
+            'sql_statements': dict(self.sql),
+            'update_rows': self._update_rows,
+            'insert_rows': self._insert_rows,
+            'cursor_factory': self.cursor_factory,
+            'temp_location': self.temp_location,
+            'checkpoint': self.checkpoint
+        }
+
+    def _get_result_step(self, csv_file):
+        return 'results/{}'.format(basename(csv_file))
+
+    def _seed_result_file(self, csv_file, shard=None):
+        '''seed the samples of a result csv file that are not checkpointed. returns the number of sample sets'''
+        self.checkpoint_source = basename(csv_file)
+
+        sample_sets = self._seed_sample_sets(self._get_sample_sets(csv_file, shard=shard,
+                                                                   skip=self._get_completed_samples()))
+
+        #: every row of the file is committed before it can be checkpointed
+        self._flush_results()
+
+        return sample_sets
 
     def _seed_stations(self, rows, header=None, wqx=None):
         stations = []
@@ -335,23 +557,19 @@ class WqpProgram(Program):
             if not self.wqx_re.search(station_id) and station_id in wqx:
                 continue
 
-            #: cast
-            row = Caster.cast(row, schema.station)
+            #: cast into a station record
+            stations.append(Caster.cast_record(row, Station))
 
-            #: set datasource, reproject and update shape
-            row = self._update_row(row, self.datasource)
-
-            #: normalize data including stripping _WXP etc
-            row = Normalizer.normalize_station(row)
+        #: set datasource, reproject and update shape
+        stations = self._update_rows(stations, self.datasource)
 
-            #: reorder and filter out any fields not in the schema
-            row = Normalizer.reorder_filter(row, schema.station)
+        #: normalize data including stripping _WXP etc
+        stations = [Normalizer.normalize_station(row) for row in stations]
 
-            #: have to generate sql manually because of quoting on spatial WKT
-            row = Caster.cast_for_sql(row)
+        #: remember where the stations are for their results
+        self.station_registry.add_stations(stations)
 
-            #: store row for later
-            stations.append(list(row.values()))
+        stations = [row.values() for row in stations]
 
         if not hasattr(self, 'cursor') or not self.cursor:
             self.cursor = self.cursor_factory(self.db['connection_string'])
@@ -359,33 +577,64 @@ class WqpProgram(Program):
         #: insert stations
         self._insert_rows(stations, self.sql['station_insert'], self.cursor)
 
+    def _set_station_coordinates(self, samples):
+        '''fill the result coordinates from the station registry. the existing stations are loaded once'''
+        if not self.station_registry.loaded:
+            if not hasattr(self, 'cursor') or not self.cursor:
+                self.cursor = self.cursor_factory(self.db['connection_string'])
+
+            self.station_registry.load(self.cursor.execute(self.sql['station_coordinates']).fetchall())
+
+        return self.station_registry.fill(samples)
+
     def _seed_results(self, samples_for_id):
-        #: cast to defined schema types
-        samples = list(map(partial(Caster.cast, schema=schema.result), samples_for_id))
+        #: cast to result records
+        samples = Caster.cast_records(samples_for_id, Result)
 
         #: set datasource and spatial information
-        samples = [self._update_row(sample, self.datasource) for sample in samples]
+        samples = self._update_rows(samples, self.datasource)
 
         #: normalize chemical names and units
-        samples = list(map(Normalizer.normalize_sample, samples))
+        samples = Normalizer.normalize_samples(samples)
 
-        #: create charge balance rows from sample
-        charge_balances = ChargeBalancer.get_charge_balance(samples)
+        #: wqp results do not carry their station location
+        samples = self._set_station_coordinates(samples)
+
+        #: create charge balance rows for every sample in the batch
+        charge_balances = ChargeBalancer.get_charge_balances(samples)
 
         samples.extend(charge_balances)
 
-        #: reorder and filter out any fields not in the schema
-        samples = list(map(partial(Normalizer.reorder_filter, schema=schema.result), samples))
+        #: records are already in schema order
+        rows = [sample.values() for sample in samples]
 
-        samples = list(map(Caster.cast_for_sql, samples))
+        self._buffer_results(rows)
 
-        rows = [list(sample.values()) for sample in samples]
+    def _seed_sample_sets(self, sample_sets):
+        '''seed the results of many samples in batches of at least result_batch_size rows
+        sample_sets: an iterable of the etl'd rows for each sample
+        '''
+        batch = []
+        sample_sets_seeded = 0
+        sets_start = get_milliseconds()
 
-        if not hasattr(self, 'cursor') or not self.cursor:
-            self.cursor = self.cursor_factory(self.db['connection_string'])
+        for samples_for_id in sample_sets:
+            batch.extend(samples_for_id)
+
+            if len(batch) >= self.result_batch_size:
+                self._seed_results(batch)
+                batch = []
+
+            sample_sets_seeded += 1
+            if sample_sets_seeded % 5000 == 0:
+                elapsed = get_milliseconds() - sets_start
+                self.logger.info('{} total sample sets (avg {} milliseconds per set)'.format(
+                    sample_sets_seeded, round(elapsed / sample_sets_seeded, 5)))
 
-        #: TODO determine if this should this be batched in sets bigger than just a sample set?
-        self._insert_rows(rows, self.sql['result_insert'], self.cursor)
+        if batch:
+            self._seed_results(batch)
+
+        return sample_sets_seeded
 
     def _get_files(self, location):
         '''Takes the file location and returns the csv's within it.'''
@@ -400,19 +649,6 @@ class WqpProgram(Program):
 
         return files
 
-    def _get_distinct_sample_ids_from(self, file_path):
-        '''Given a file_path, this returns a set of unique sample ids.'''
-
-        file_name = self._get_file_name_without_extension(file_path)
-
-        unique_sample_ids = query_csv(self.sql['distinct_sample_id'].format(self.fields['sample_id'], file_name),
-                                      [file_path], self.TEMPDB)
-        if len(unique_sample_ids) > 0:
-            #: remove header cell
-            unique_sample_ids.pop(0)
-
-        return unique_sample_ids
-
     def _get_wqx_duplicate_ids(self, file_path):
         '''Given the file_path, return the list of stripped station ids that have the _WQX suffix'''
 
@@ -424,8 +660,9 @@ class WqpProgram(Program):
             stations = file_path
 
         if file_name:
-            rows = query_csv(self.sql['wqxids'].format(self.fields['monitoring_location_id'], file_name), [file_path],
-                             self.TEMPDB)
+            with self._temp_database() as temp_database:
+                rows = query_csv(self.sql['wqxids'].format(self.fields['monitoring_location_id'], file_name),
+                                 [file_path], temp_database)
             if len(rows) > 0:
                 rows.pop(0)
 
@@ -434,19 +671,66 @@ class WqpProgram(Program):
         return set([re.sub(self.wqx_re, '-', station['StationId'])
                     for station in [x for x in stations if self.wqx_re.search(x['StationId'])]])
 
-    def _get_samples_for_id(self, sample_id_set, file_path, config=None):
-        '''Given a `(id,)` styled set of sample ids, this will return the sample
-        rows for the given csv file_path. The format will be an array of dictionaries
-        with the key being the destination field name and the value being the source csv value.
+    def _get_temp_folder(self):
+        '''the folder for temporary files. None is the system temp folder'''
+        if self.temp_location == self.IN_MEMORY:
+            return None
 
-        This is only invoked for result files.
+        return self.temp_location
+
+    @contextmanager
+    def _temp_database(self):
+        '''yields the path to an import database that is unique to this call and removed afterwards'''
+        if self.temp_location == self.IN_MEMORY:
+            yield self.IN_MEMORY
+
+            return
+
+        folder = mkdtemp(prefix='ugsdbseeder-', dir=self.temp_location)
+
+        try:
+            yield join(folder, self.TEMPDB)
+        finally:
+            rmtree(folder, ignore_errors=True)
+
+    @staticmethod
+    def _get_skip_filter(skip, where=None):
+        '''a function that is false for the sample ids in skip and otherwise the result of where'''
+        def not_skipped(sample_id):
+            if Checkpoint.key(sample_id) in skip:
+                return False
+
+            return where is None or where(sample_id)
+
+        return not_skipped
+
+    @staticmethod
+    def _get_shard_filter(index, count):
+        '''a function that is true for the sample ids in the shard at index of count shards'''
+        def in_shard(sample_id):
+            #: crc32 is the same in every process unlike hash
+            return crc32(sample_id.encode('utf-8')) % count == index
+
+        return in_shard
+
+    def _get_sample_sets(self, file_path, config=None, shard=None, skip=None):
+        '''Given a result csv file_path, this yields the rows of each sample in one pass over the file.
+        The format will be an array of dictionaries with the key being the destination field name
+        and the value being the source csv value.
+        shard: an optional (index, count) to only yield the samples with ids in that shard
+        skip: an optional set of sample ids to leave out
         '''
+        where = None
+        if shard:
+            where = self._get_shard_filter(*shard)
+
+        if skip:
+            where = self._get_skip_filter(skip, where)
 
-        file_name = self._get_file_name_without_extension(file_path)
-        samples_for_id = query_csv(self.sql['sample_id'].format(file_name, self.fields['sample_id'], sample_id_set[0]),
-                                   [file_path], self.TEMPDB)
+        grouper = CsvGrouper(file_path, self.fields['sample_id'], temp_location=self._get_temp_folder(), where=where)
 
-        return self._etl_column_names(samples_for_id, config or self.result_config)
+        for sample_id, samples_for_id in grouper.groups():
+            yield self._etl_column_names(samples_for_id, config or self.result_config, header=grouper.header)
 
     def _etl_column_names(self, rows, config, header=None):
         '''Given a dictionary or list of dictionaries, return a new row or
@@ -483,12 +767,7 @@ class WqpProgram(Program):
 
         return splitext(basename(file_path))[0]
 
-    def _add_sample_index(self, filepath):
-        '''Add an index to ActivityIdentifier field for the table matching the file'''
-        with sqlite3.connect(self.TEMPDB) as conn:
-            conn.cursor().execute(self.sql['create_index'].format(basename(filepath)[:-4]))
-
-    def _format_url(self, template, source, last_updated, today=None):
+    def _format_url(self, template, source, last_updated, today=None, bbox=None):
         date_format = '%m-%d-%Y'
         lo = dateparser(last_updated).strftime(date_format)
         hi = datetime.now().strftime(date_format)
@@ -496,7 +775,96 @@ class WqpProgram(Program):
         if today:
             hi = dateparser(today).strftime(date_format)
 
-        return template.format(source, lo, hi)
+        bbox = '%2C'.join(str(round(edge, 6)) for edge in bbox or self.bbox)
+
+        return template.format(source, lo, hi, bbox)
+
+    @staticmethod
+    def _split_bbox(bbox, columns, rows):
+        '''split the bbox into a grid of columns by rows bboxes'''
+        west, south, east, north = bbox
+        width = (east - west) / columns
+        height = (north - south) / rows
+
+        return [(west + width * column, south + height * row, west + width * (column + 1), south + height * (row + 1))
+                for row in range(rows) for column in range(columns)]
+
+    def _plan_tiles(self, lo, hi):
+        '''split the bbox into the tile grid and split the tiles with more than tile_max_results results again.
+        the counts come from HEAD requests. tiles without results are left out. returns a list of bboxes
+        '''
+        tiles = self._split_bbox(self.bbox, *self.tile_grid)
+        planned = []
+
+        def count(tile):
+            return HttpClient.get_count(self._format_url(self.wqp_url, 'Result', lo, hi, bbox=tile))
+
+        with ThreadPoolExecutor(max_workers=self.fetch_workers) as executor:
+            for depth in range(self.tile_max_depth + 1):
+                busy = []
+
+                for tile, results in zip(tiles, executor.map(count, tiles)):
+                    if results == 0:
+                        continue
+
+                    if results is not None and results > self.tile_max_results and depth < self.tile_max_depth:
+                        busy.extend(self._split_bbox(tile, 2, 2))
+                    else:
+                        planned.append(tile)
+
+                tiles = busy
+
+        return planned
+
+    def _get_date_windows(self, last_updated, today=None):
+        '''split the days from last_updated through today into windows of update_window_days.
+        returns a list of (lo, hi) dates that include both ends
+        '''
+        lo = dateparser(last_updated).date()
+        end = datetime.now().date()
+
+        if today:
+            end = dateparser(today).date()
+
+        windows = []
+        while True:
+            hi = max(lo, min(lo + timedelta(days=self.update_window_days - 1), end))
+            windows.append((lo, hi))
+
+            lo = hi + timedelta(days=1)
+            if lo > end:
+                return windows
+
+    def _fetch_results(self, last_updated, today=None):
+        '''request the results of every date window and tile at once and group each response as it arrives.
+        returns a dictionary with sample_id's as the key, with a list of rows as values
+        '''
+        requests = [(lo.isoformat(), hi.isoformat(), tile)
+                    for lo, hi in self._get_date_windows(last_updated, today)
+                    for tile in self._plan_tiles(lo.isoformat(), hi.isoformat())]
+        new_results = {}
+
+        self.logger.info('- requesting results in {} windows and tiles'.format(len(requests)))
+
+        with ThreadPoolExecutor(max_workers=self.fetch_workers) as executor:
+            futures = dict((executor.submit(HttpClient.get_csv,
+                                            self._format_url(self.wqp_url, 'Result', lo, hi, bbox=tile),
+                                            self.logger,
+                                            temp_location=self._get_temp_folder()), (lo, hi, tile))
+                           for lo, hi, tile in requests)
+
+            for future in as_completed(futures):
+                lo, hi, tile = futures[future]
+                results = self._group_rows_by_id(future.result())
+
+                self.logger.info('- {} to {} in {}: {} samples'.format(lo, hi, tile, len(results)))
+
+                #: a sample is only kept from the first window or tile it arrives in.
+                #: stations on the edge of two tiles are returned by both
+                for sample_id, rows in results.items():
+                    new_results.setdefault(sample_id, rows)
+
+        return new_results
 
     def _group_rows_by_id(self, cursor, config=None):
         '''groups samples by SampleId as they would be formatted by querycsv
@@ -510,7 +878,10 @@ class WqpProgram(Program):
         if not cursor:
             return
 
-        header = next(cursor)
+        #: an empty window can return no header
+        header = next(cursor, None)
+        if header is None:
+            return unique_sample_ids
 
         for row in cursor:
             row = self._etl_column_names(row, config or self.result_config, header=header)
@@ -545,6 +916,57 @@ class WqpProgram(Program):
 
         return [id[0] for id in unique_station_ids]
 
+    def _get_station_urls(self, station_ids):
+        '''the station urls requesting batches of the station ids that are no longer than station_url_length'''
+        urls = []
+        batch = []
+
+        for station_id in station_ids:
+            batch.append(quote(station_id, safe=''))
+
+            if len(batch) > 1 and len(self.station_url.format('%3B'.join(batch))) > self.station_url_length:
+                urls.append(self.station_url.format('%3B'.join(batch[:-1])))
+                batch = batch[-1:]
+
+        if batch:
+            urls.append(self.station_url.format('%3B'.join(batch)))
+
+        return urls
+
+    def _fetch_stations(self, station_ids):
+        '''request the stations by id in batches at once and seed each batch as it arrives.
+        returns the number of stations found
+        '''
+        station_ids = set(station_ids)
+        urls = self._get_station_urls(sorted(station_ids))
+
+        #: the duplicates are found from every id since a pair can be split across batches
+        wqx = self._get_wqx_duplicate_ids([{'StationId': station_id} for station_id in station_ids])
+        found = 0
+
+        self.logger.info('- requesting {} stations in {} batches'.format(len(station_ids), len(urls)))
+
+        with ThreadPoolExecutor(max_workers=self.fetch_workers) as executor:
+            futures = [executor.submit(HttpClient.get_csv, url, self.logger, temp_location=self._get_temp_folder())
+                       for url in urls]
+
+            for future in as_completed(futures):
+                stations = future.result()
+                header = next(stations, None)
+
+                if header is None:
+                    continue
+
+                stations = self._extract_stations_by_id(stations, station_ids, header)
+                found += len(stations)
+
+                self._seed_stations(stations, header=header, wqx=wqx)
+
+        if found < len(station_ids):
+            self.logger.warning('{} of {} new stations were not found'.format(len(station_ids) - found, len(station_ids)))
+
+        return found
+
     def _extract_stations_by_id(self, cursor, station_ids, header):
         '''loops over a cursor of stations and returns the stations that have an id
         in station_ids
@@ -597,26 +1019,33 @@ class WqpProgram(Program):
         return station_ids
 
     def _get_unique_sample_ids(self, sample_ids):
+        '''returns the set of (sample id,) keys that are not in the database yet'''
         if not hasattr(self, 'cursor') or not self.cursor:
             self.cursor = self.cursor_factory(self.db['connection_string'])
 
-        if len(sample_ids) == 0:
-            return None
+        return find_new_keys([(sample_id,) for sample_id in sample_ids], self.sql['new_results'], self.cursor)
 
-        statement = self.sql['new_results'].format(','.join(sample_ids))
+    def _remove_existing_results(self, results):
+        unique_sample_ids = set(key[0] for key in self._get_unique_sample_ids(list(results.keys())))
 
-        self.cursor.execute(statement)
+        return {key: results[key] for key in results if key in unique_sample_ids}
 
-        return self.cursor.fetchall()
 
-    def _remove_existing_results(self, results):
-        sample_ids = ['(\'{}\')'.format(re.sub('\'', '\'\'', sample_id)) for sample_id in list(results.keys())]
+def seed_result_file(arguments, csv_file, shard):
+    '''seed the results of a wqp csv file shard in a worker process with its own program and connection.
+    returns the number of sample sets seeded
+    '''
+    program = WqpProgram(**arguments)
 
-        unique_sample_ids = self._get_unique_sample_ids(sample_ids)
-        #: flatten list
-        unique_sample_ids = [item for iter_ in unique_sample_ids for item in iter_]
+    try:
+        sample_sets = program._seed_result_file(csv_file, shard=shard)
+    finally:
+        #: the connection pool was copied into this process for this task
+        pool = getattr(arguments['cursor_factory'], '__self__', None)
+        if hasattr(pool, 'close_all'):
+            pool.close_all()
 
-        return {key: results[key] for key in results if key in unique_sample_ids}
+    return sample_sets
 
 
 class SdwisProgram(Program):
@@ -624,10 +1053,10 @@ class SdwisProgram(Program):
 
     datasource = 'SDWIS'
 
+    result_keys = ['SampleDate', 'SampleId', 'Param']
+
     sql = {
-        'new_results': ('SELECT * FROM (VALUES{}) AS t(SampleDate,SampleId,Param) WHERE NOT EXISTS('
-                        'SELECT 1 FROM [UGSWaterChemistry].[ugswaterchemistry].[Results] WHERE [SampleId] = t.SampleId AND '
-                        '[SampleDate] = t.SampleDate AND [Param] = t.Param)'),
+        'new_results': key_statements('Results', ['SampleDate', 'SampleId', 'Param']),
         'specific-result': '''SELECT
             UTV80.TSASAMPL.COLLLECTION_END_DT AS "SampleDate",
             UTV80.TSASAMPL.LAB_ASGND_ID_NUM AS "SampleId",
@@ -771,40 +1200,53 @@ class SdwisProgram(Program):
                  source,
                  secrets=None,
                  sql_statements={},
-                 update_row=None,
+                 update_rows=None,
                  insert_rows=None,
                  cursor_factory=None,
-                 arcpy=None):
+                 arcpy=None,
+                 temp_location=None,
+                 workers=1,
+                 checkpoint=None):
         '''create a new SDWIS program
         db - the connection string for the database to seed
         source - the connection information to the sdwis database
         update - boolean value whether we are seeding or updating
         secrets - sdwis database connection information
         sql_statements - common sql statements for inserting into stations and results
-        update_row - the function to reproject a point and set the DataSource
+        update_rows - the function to reproject the points of a batch of rows and set the DataSource
         insert_row - the function to batch insert rows
-        cursor_factory - the function to create pyodbc connection_string
+        cursor_factory - the function to create a cursor for the database being seeded
         arcpy - ignored. for gdb programs only
+        temp_location - ignored. for wqp only
+        workers - ignored. for wqp only
+        checkpoint - the optional checkpoint store to record and skip committed work
         '''
         self.logger = logger
         self.db = db
         self.source_db = secrets
-        self._update_row = update_row
+        self._update_rows = update_rows
         self._insert_rows = insert_rows
         self.sql.update(sql_statements)
-        self.source_cursor = cursor_factory(secrets['connection_string'])
+        #: sdwis is always read over odbc whichever database is being seeded
+        self.source_cursor = create_odbc_cursor(secrets['connection_string'])
         self.cursor_factory = cursor_factory
+        self.checkpoint = checkpoint
 
     def seed(self):
         try:
             self.logger.info('seeding {} stations...'.format(self.datasource))
 
-            self._seed_stations(self.source_cursor.execute(self.sql['station'].format('')), schema.station)
+            if not self._is_complete('stations'):
+                self._seed_stations(self.source_cursor.execute(self.sql['station'].format('')), schema.station)
+                self._complete('stations')
 
             self.logger.info('seeding {} stations done.'.format(self.datasource))
             self.logger.info('seeding {} results...'.format(self.datasource))
 
-            self._seed_results(self.source_cursor.execute(self.sql['unique_sample_ids']))
+            if not self._is_complete('results'):
+                self._seed_results(self._skip_completed_samples(self.source_cursor.execute(self.sql['unique_sample_ids'])))
+                self._flush_results()
+                self._complete('results')
 
             self.logger.info('seeding {} results done.'.format(self.datasource))
         finally:
@@ -857,6 +1299,7 @@ class SdwisProgram(Program):
             self.logger.info('adding {} new results...'.format(len(list(new_results.keys()))))
 
             self._seed_results(list(new_results.keys()))
+            self._flush_results()
 
             self.logger.info('updating {} results done.'.format(self.datasource))
         finally:
@@ -878,23 +1321,14 @@ class SdwisProgram(Program):
             #: add shape column so row gets sql shape added
             row['Shape'] = None
 
-            #: cast
-            row = Caster.cast(row, schema.station)
-
-            #: set datasource, reproject and update shape
-            row = self._update_row(row, self.datasource)
+            #: cast into a station record
+            stations.append(Caster.cast_record(row, Station))
 
-            #: normalize data including stripping _WXP etc
-            row = Normalizer.normalize_station(row)
-
-            #: reorder and filter out any fields not in the schema
-            row = Normalizer.reorder_filter(row, schema.station)
+        #: set datasource, reproject and update shape
+        stations = self._update_rows(stations, self.datasource)
 
-            #: have to generate sql manually because of quoting on spatial WKT
-            row = Caster.cast_for_sql(row)
-
-            #: store row for later
-            stations.append(list(row.values()))
+        #: normalize data including stripping _WXP etc
+        stations = [Normalizer.normalize_station(row).values() for row in stations]
 
         if not hasattr(self, 'cursor') or not self.cursor:
             self.cursor = self.cursor_factory(self.db['connection_string'])
@@ -910,32 +1344,24 @@ class SdwisProgram(Program):
             #: sample id for seed or sample_date, sample_id, param key for update
             samples = self._get_samples_for_id(sample_id)
 
-            #: cast
-            samples = [Caster.cast(self._zip_column_names(sample), schema.result) for sample in samples]
+            #: cast to result records
+            samples = Caster.cast_records([self._zip_column_names(sample) for sample in samples], Result)
 
             #: set datasource and spatial information
-            samples = [self._update_row(sample, self.datasource) for sample in samples]
+            samples = self._update_rows(samples, self.datasource)
 
             #: normalize chemical names and units
-            samples = list(map(Normalizer.normalize_sample, samples))
+            samples = Normalizer.normalize_samples(samples)
 
             #: create charge balance rows from sample
             charge_balances = ChargeBalancer.get_charge_balance(samples)
 
             samples.extend(charge_balances)
 
-            #: reorder and filter out any fields not in the schema
-            samples = list(map(partial(Normalizer.reorder_filter, schema=schema.result), samples))
-
-            samples = list(map(Caster.cast_for_sql, samples))
+            #: records are already in schema order
+            rows = [sample.values() for sample in samples]
 
-            rows = [list(sample.values()) for sample in samples]
-
-            if not hasattr(self, 'cursor') or not self.cursor:
-                self.cursor = self.cursor_factory(self.db['connection_string'])
-
-            #: TODO determine if this should this be batched in sets bigger than just a sample set?
-            self._insert_rows(rows, self.sql['result_insert'], self.cursor)
+            self._buffer_results(rows)
 
     def _get_samples_for_id(self, sample_id_or_key):
         #: updating
@@ -953,8 +1379,9 @@ class SdwisProgram(Program):
 
         #: seeding
         #: introduce another cursor so that seeding can continue to iterate over it's buffer
+        #: it reads sdwis so it never comes from the pooled cursor_factory of the database being seeded
         if not hasattr(self, 'second_source_cursor') or not self.second_source_cursor:
-            self.second_source_cursor = self.cursor_factory(self.source_db['connection_string'])
+            self.second_source_cursor = create_odbc_cursor(self.source_db['connection_string'])
 
         return self.second_source_cursor.execute(self.sql['result'] + self.sql['sample_id'], sample_id_or_key[0])
 
@@ -1019,37 +1446,32 @@ class SdwisProgram(Program):
         return unique_sample_ids
 
     def _remove_existing_results(self, results):
-        sample_ids = []
-        for key in list(results.keys()):
-            key = key.split('{-}')
-
-            sample_date = key[0]
-            sample_id = key[1]
-            param = key[2]
-            sample_ids.append('(\'{}\',\'{}\',\'{}\')'.format(sample_date,
-                                                              re.sub('\'', '\'\'', sample_id),
-                                                              re.sub('\'', '\'\'', param)))
+        sample_ids = [tuple(key.split('{-}')) for key in results.keys()]
 
         unique_sample_ids = self._get_unique_sample_ids(sample_ids)
 
-        #: munge back to stationid, date, param key
-        unique_sample_ids = ['{}{{-}}{}{{-}}{}'.format(item[0], item[1], item[2]) for item in unique_sample_ids]
+        #: munge back to date, sampleid, param key
+        keys = set()
+        for sample_date, sample_id, param in unique_sample_ids:
+            #: the dates come back from the temp table as datetimes
+            if hasattr(sample_date, 'strftime'):
+                sample_date = sample_date.strftime('%Y-%m-%d')
+
+            keys.add('{}{{-}}{}{{-}}{}'.format(sample_date, sample_id, param))
+
+        unique_sample_ids = keys
 
         return {key: results[key] for key in results if key in unique_sample_ids}
 
     def _get_unique_sample_ids(self, sample_ids):
+        '''returns the set of (date, sample id, param) keys that are not in the database yet'''
         if not hasattr(self, 'cursor') or not self.cursor:
             self.cursor = self.cursor_factory(self.db['connection_string'])
 
-        if len(sample_ids) == 0:
-            return None
-
-        statement = self.sql['new_results'].format(','.join(sample_ids))
-
-        return self.cursor.execute(statement)
+        return find_new_keys(sample_ids, self.sql['new_results'], self.cursor)
 
 
-class GdbProgram(object):
+class GdbProgram(Program):
     #: sql queries
     sql = {}
 
@@ -1060,27 +1482,34 @@ class GdbProgram(object):
                  source=None,
                  secrets=None,
                  sql_statements={},
-                 update_row=None,
+                 update_rows=None,
                  insert_rows=None,
                  cursor_factory=None,
-                 arcpy=None):
+                 arcpy=None,
+                 temp_location=None,
+                 workers=1,
+                 checkpoint=None):
         '''create a new DOGM program
         db - the connection string for the database to seed
         update - boolean value whether we are seeding or updating
         source - the path on disk to find the parent gdb folder to ETL
         secrets - ignored. for sdwis only
         sql_statements - common sql statements for inserting into stations and results
-        update_row - the function to reproject a point and set the DataSource
+        update_rows - the function to reproject the points of a batch of rows and set the DataSource
         insert_row - the function to batch insert rows
         cursor_factory - the function to create pyodbc connection_string
         arcpy - the arcpy module
+        temp_location - ignored. for wqp only
+        workers - ignored. for wqp only
+        checkpoint - the optional checkpoint store to record and skip committed work
         '''
         self.logger = logger
         self.db = db
-        self._update_row = update_row
+        self._update_rows = update_rows
         self._insert_rows = insert_rows
         self.arcpy = arcpy
         self.cursor_factory = cursor_factory
+        self.checkpoint = checkpoint
         self.sql.update(sql_statements)
 
         #: check that source exists wqp/results and wqp/stations
@@ -1125,18 +1554,23 @@ class GdbProgram(object):
         station_fields.append('Shape@XY')
 
         try:
-            self.source_cursor = self.arcpy.da.SearchCursor(self.station_table, field_names=station_fields,
-                                                            where_clause='1=1')
-            self._seed_stations(self.source_cursor, station_fields)
+            if not self._is_complete('stations'):
+                self.source_cursor = self.arcpy.da.SearchCursor(self.station_table, field_names=station_fields,
+                                                                where_clause='1=1')
+                self._seed_stations(self.source_cursor, station_fields)
+                self._complete('stations')
 
             self.logger.info('{} {} stations done.'.format(what, self.datasource))
             self.logger.info('{} {} results...'.format(what, self.datasource))
 
-            self.source_cursor = self.arcpy.da.SearchCursor(self.result_table,
-                                                            field_names=['SampleId'],
-                                                            sql_clause=('DISTINCT', None))
+            if not self._is_complete('results'):
+                self.source_cursor = self.arcpy.da.SearchCursor(self.result_table,
+                                                                field_names=['SampleId'],
+                                                                sql_clause=('DISTINCT', None))
 
-            self._seed_results(self.source_cursor)
+                self._seed_results(self._skip_completed_samples(self.source_cursor))
+                self._flush_results()
+                self._complete('results')
 
             self.logger.info('{} {} results done.'.format(what, self.datasource))
         finally:
@@ -1156,12 +1590,14 @@ class GdbProgram(object):
             #: zip column names with values
             row = self._zip_column_names(row, config)
 
-            #: cast
-            row = Caster.cast(row, schema.station)
+            #: cast into a station record
+            stations.append(Caster.cast_record(row, Station))
 
-            #: set datasource, reproject and update shape
-            row = self._update_row(row, self.datasource)
+        #: set datasource, reproject and update shape
+        rows = self._update_rows(stations, self.datasource)
+        stations = []
 
+        for row in rows:
             if row['Shape'] is None:
                 self.logger.warn('Skipping row because it has an invalid shape.')
                 self.logger.debug(row)
@@ -1171,14 +1607,8 @@ class GdbProgram(object):
             #: normalize data including stripping _WXP etc
             row = Normalizer.normalize_station(row)
 
-            #: reorder and filter out any fields not in the schema
-            row = Normalizer.reorder_filter(row, schema.station)
-
-            #: have to generate sql manually because of quoting on spatial WKT
-            row = Caster.cast_for_sql(row)
-
             #: store row for later
-            stations.append(list(row.values()))
+            stations.append(row.values())
 
         if not hasattr(self, 'cursor') or not self.cursor:
             self.cursor = self.cursor_factory(self.db['connection_string'])
@@ -1198,32 +1628,24 @@ class GdbProgram(object):
                 if hasattr(self, 'second_source_cursor'):
                     del self.second_source_cursor
 
-            #: cast
-            samples = [Caster.cast(self._zip_column_names(sample, result_fields), schema.result) for sample in samples]
+            #: cast to result records
+            samples = Caster.cast_records([self._zip_column_names(sample, result_fields) for sample in samples], Result)
 
             #: set datasource and spatial information
-            samples = [self._update_row(sample, self.datasource) for sample in samples]
+            samples = self._update_rows(samples, self.datasource)
 
             #: normalize chemical names and units
-            samples = list(map(Normalizer.normalize_sample, samples))
+            samples = Normalizer.normalize_samples(samples)
 
             #: create charge balance rows from sample
             charge_balances = ChargeBalancer.get_charge_balance(samples)
 
             samples.extend(charge_balances)
 
-            #: reorder and filter out any fields not in the schema
-            samples = list(map(partial(Normalizer.reorder_filter, schema=schema.result), samples))
+            #: records are already in schema order
+            rows = [sample.values() for sample in samples]
 
-            samples = list(map(Caster.cast_for_sql, samples))
-
-            rows = [list(sample.values()) for sample in samples]
-
-            if not hasattr(self, 'cursor') or not self.cursor:
-                self.cursor = self.cursor_factory(self.db['connection_string'])
-
-            #: TODO determine if this should this be batched in sets bigger than just a sample set?
-            self._insert_rows(rows, self.sql['result_insert'], self.cursor)
+            self._buffer_results(rows)
 
     def _get_samples_for_id(self, sample_id, result_fields):
         #: introduce another cursor so that seeding can continue to iterate over it's buffer
@@ -37,6 +37,7 @@ import os.path
 import getopt
 import csv
 import sqlite3
+from itertools import islice
 
 VERSION = "3.1.2"
 
@@ -98,25 +99,47 @@ def read_sqlfile(filename):
     return sqlcmds
 
 
+#: the statements that trade durability for import speed. the import database is a
+#: throw away copy of the csv file that can always be imported again
+bulk_load_pragmas = [
+    'PRAGMA journal_mode = MEMORY',
+    'PRAGMA synchronous = OFF',
+    'PRAGMA cache_size = -65536'
+]
+
+#: the number of csv rows sent to executemany at once
+bulk_load_chunk_size = 10000
+
+
 def csv_to_sqldb(db, filename, table_name):
-    reader = csv.reader(open(filename, "rt"), dialect=csv.excel)
-    column_names = next(reader)
-    colstr = ",".join("[{0}]".format(col) for col in column_names)
-    try:
-        db.execute("drop table %s;" % table_name)
-    except:
-        pass
-    db.execute("create table %s (%s);" % (table_name, colstr))
-    for row in reader:
-        params = list(zip(column_names, row))
-        insert_statement = ",".join(["{0}{1}{0}".format("'", t[0]) for t in params])
-        values = ",".join(["?" for t in params])
-        sql = "insert into {} ({}) VALUES ({});".format(table_name, insert_statement, values)
+    """
+    Import the csv file into a new table with one prepared insert statement
+    and executemany.
+    """
+    for pragma in bulk_load_pragmas:
+        db.execute(pragma)
+
+    with open(filename, "rt") as csv_file:
+        reader = csv.reader(csv_file, dialect=csv.excel)
+        column_names = next(reader)
+        width = len(column_names)
+        colstr = ",".join("[{0}]".format(col) for col in column_names)
 
         try:
-            db.execute(sql, [str(t[1]) for t in params])
-        except Exception as e:
-            raise e
+            db.execute("drop table %s;" % table_name)
+        except:
+            pass
+
+        db.execute("create table %s (%s);" % (table_name, colstr))
+
+        sql = "insert into {} ({}) VALUES ({});".format(table_name, colstr, ",".join(["?"] * width))
+
+        #: short rows are null filled and long rows are trimmed to the header
+        rows = (row[:width] + [None] * (width - len(row)) for row in reader)
+
+        for chunk in iter(lambda: list(islice(rows, bulk_load_chunk_size)), []):
+            db.executemany(sql, chunk)
+
     db.commit()
 
     # Mark CSV as imported
@@ -8,152 +8,297 @@ modules for acting on items
 '''
 
 import datetime
+import gzip
+import mmap
 import re
-from . import schema
+import sqlite3
 from collections import OrderedDict
-from csv import reader as csvreader
+from contextlib import ExitStack, contextmanager
+from csv import reader as csvreader, writer as csvwriter
 from dateutil.parser import parse
-from .models import Concentration
-from pyproj import Proj, transform
-from requests import get
+from functools import lru_cache
+from hashlib import sha1
+from heapq import merge
+from io import StringIO, TextIOWrapper
+from itertools import groupby, islice
+from operator import itemgetter
+from .models import Concentration, Result
+from pyproj import Transformer
+import numpy as np
+from locale import getpreferredencoding
+from os import getpid, makedirs, remove, replace, stat
+from os.path import exists, join
+from requests import get, head
+from tempfile import TemporaryFile, mkstemp
+from threading import get_ident, local
+from time import time
+from urllib.parse import parse_qsl, urlencode, urlsplit, urlunsplit
 from .paramGroups import param_groups
 
 
 class Reproject(object):
     '''A utility class for reprojecting points'''
 
-    input_system = Proj(init='epsg:4326')
-    ouput_system = Proj(init='epsg:26912')
+    input_system = 'epsg:4326'
+    ouput_system = 'epsg:26912'
+
+    #: transformers are not thread safe so there is one per thread and process
+    _local = local()
+
+    @classmethod
+    def get_transformer(cls):
+        '''returns the cached transformer from 4326 to 26912 in x, y order'''
+        cached = getattr(cls._local, 'transformer', None)
+
+        if cached is None or cached[0] != getpid():
+            cached = (getpid(), Transformer.from_crs(cls.input_system, cls.ouput_system, always_xy=True))
+            cls._local.transformer = cached
+
+        return cached[1]
 
     @classmethod
     def to_utm(cls, x, y):
         '''reproject x and y from 4326 to 26912'''
+        xs, ys = cls.to_utm_points([x], [y])
+
+        return xs[0], ys[0]
+
+    @classmethod
+    def to_utm_points(cls, xs, ys):
+        '''reproject lists of x and y from 4326 to 26912 in one call
+        returns a tuple of the lists of projected x and y
+        '''
+        if len(xs) == 0:
+            return [], []
+
+        #: the sources sometimes leave off the sign of the longitude
+        xs = [x * -1 if x > 0 else x for x in xs]
+
+        return cls.get_transformer().transform(xs, list(ys))
+
+
+def _strip(value):
+    #: try to remove all whitespace from strings
+    try:
+        return value.strip()
+    except AttributeError:
+        return value
+
+
+def _noop(value):
+    return value
+
+
+def _time_conversion(value):
+    return datetime.time(*list(map(int, value.split(':'))))
+
+
+#: dates after the run started are bad data
+_run_started = datetime.datetime.now()
+
+
+def _in_range(value):
+    if value > _run_started or value.year < 1800:
+        return None
+
+    return value
+
+
+def _fast_parse(value):
+    '''parse the formats found in the source data without dateutil. returns None for
+    anything else so dateutil can decide what it is'''
+    #: YYYY-MM-DD and YYYY-MM-DD HH:MM:SS
+    if len(value) in (10, 19) and value[4] == '-' and value[7] == '-':
+        parts = [value[:4], value[5:7], value[8:10]]
+
+        if len(value) == 19:
+            if value[10] not in ' T' or value[13] != ':' or value[16] != ':':
+                return None
+            parts.extend([value[11:13], value[14:16], value[17:19]])
+    #: M/D/YYYY
+    elif value.count('/') == 2:
+        month, day, year = value.split('/')
+
+        if len(year) != 4 or not 0 < len(month) < 3 or not 0 < len(day) < 3:
+            return None
+        parts = [year, month, day]
+    else:
+        return None
+
+    if not all(part.isdigit() for part in parts):
+        return None
+
+    try:
+        return datetime.datetime(*list(map(int, parts)))
+    except ValueError:
+        return None
+
+
+@lru_cache(maxsize=4096)
+def _parse_datetime(value):
+    '''parse and validate a date string. the same dates repeat for every result in a sample
+    so the answers are memoized'''
+    try:
+        return _in_range(_fast_parse(value) or parse(value))
+    except Exception:
+        return None
+
+
+@lru_cache(maxsize=4096)
+def _parse_time(value):
+    try:
+        return _time_conversion(value)
+    except Exception:
+        return None
+
+
+def _to_string(value):
+    value = str(_strip(value))
+
+    if value == '':
+        return None
+
+    return value
+
+
+def _to_number(cast):
+    def convert(value):
+        try:
+            return cast(_strip(value))
+        except Exception:
+            return None
+
+    return convert
+
+
+def _to_datetime(value):
+    value = _strip(value)
+
+    if isinstance(value, str):
+        if value == '':
+            return None
 
-        if x > 0:
-            x = x * -1
+        return _parse_datetime(value)
 
-        return transform(cls.input_system, cls.ouput_system, x, y)
+    try:
+        if not isinstance(value, datetime.datetime):
+            value = parse(value)
+
+        return _in_range(value)
+    except Exception:
+        return None
+
+
+def _to_time(value):
+    value = _strip(value)
+
+    if isinstance(value, datetime.time):
+        return value
+    elif value == '':
+        return None
+    elif isinstance(value, str):
+        return _parse_time(value)
+
+    try:
+        return _time_conversion(value)
+    except Exception:
+        return None
+
+
+def _to_none(value):
+    #: there is no cast for this type
+    return None
 
 
 class Caster(object):
     '''A utility class for casting data to its defined schema type'''
 
+    casts = {
+        'String': _to_string,
+        'Long Int': _to_number(int),
+        'Short Int': _to_number(int),
+        'Double': _to_number(float),
+        'Date': _to_datetime,
+        'Time': _to_time
+    }
+
+    #: the names a schema field can use in its actions
+    actions = {
+        'noop': _noop,
+        'date_conversion': _time_conversion
+    }
+
+    #: id(schema): (schema, plan)
+    _plans = {}
+
     @classmethod
-    def cast(cls, row, schema):
-        '''Given a {string, string} dictionary (row) and the schema
-        for the row (result or station) a new {string, string} dictionary
-        (row) is returned with the values properly formatted.
+    def compile(cls, schema):
+        '''Given the schema for a row (result or station) create the ordered list of
+        (field, converter) used to cast rows. Plans are cached for each schema.
         '''
-        def noop(arg):
-            return arg
+        #: keep a reference to the schema so its id is not reused
+        cached = cls._plans.get(id(schema))
+        if cached is not None and cached[0] is schema:
+            return cached[1]
 
-        def date_conversion(arg):
-            return datetime.time(*list(map(int, arg.split(':'))))
+        plan = [(name, cls._compile_field(field)) for name, field in schema.items()]
+        cls._plans[id(schema)] = (schema, plan)
 
-        for field in schema.items():
-            cast = None
-            #: if the value is not in the csv skip it
-            try:
-                value = row[field[0]]
-            except KeyError:
-                row[field[0]] = None
-                continue
+        return plan
 
-            #: try to remove all whitespace from strings
-            try:
-                value = value.strip()
-            except:
-                pass
+    @classmethod
+    def _compile_field(cls, field):
+        cast = cls.casts.get(field['type'], _to_none)
+        length = field.get('length')
 
-            if field[1]['type'] == 'String':
-                cast = str
-            elif field[1]['type'] == 'Long Int':
-                cast = int
-            elif field[1]['type'] == 'Short Int':
-                cast = int
-            elif field[1]['type'] == 'Double':
-                cast = float
-            elif field[1]['type'] == 'Date':
-                if isinstance(value, datetime.datetime):
-                    cast = noop
-                elif value == '':
-                    row[field[0]] = None
-                    continue
-                else:
-                    cast = parse
-            elif field[1]['type'] == 'Time':
-                if isinstance(value, datetime.time):
-                    cast = noop
-                elif value == '':
-                    row[field[0]] = None
-                    continue
-                else:
-                    cast = date_conversion
+        actions = []
+        for action in field.get('actions') or []:
+            if action not in cls.actions:
+                break
+            actions.append(cls.actions[action])
 
-            try:
-                value = cast(value)
-                if (isinstance(value, datetime.datetime) and
-                        (value > datetime.datetime.now() or
-                            value.year < 1800)):
-                    value = None
-            except:
-                row[field[0]] = None
-                continue
+        if not length and not actions:
+            return cast
 
-            if value == '':
-                row[field[0]] = None
-                continue
+        def convert(value):
+            value = cast(value)
 
-            try:
-                if field[1]['length']:
-                    value = value[:field[1]['length']]
-            except KeyError:
-                pass
-            except TypeError:
-                #: you can't trim a datetime object
-                #: but it has a length for some reason?
-                pass
+            if value is None:
+                return value
 
-            try:
-                if field[1]['actions']:
-                    for action in field[1]['actions']:
-                        value = locals()[action](value)
-            except KeyError:
-                pass
+            if length:
+                try:
+                    value = value[:length]
+                except TypeError:
+                    #: you can't trim a datetime or a number
+                    pass
 
-            row[field[0]] = value
+            for action in actions:
+                value = action(value)
 
-        return row
+            return value
+
+        return convert
 
     @classmethod
-    def cast_for_sql(cls, row):
-        '''
-        Format the values for the sql insert statement
+    def cast_record(cls, row, record_type):
+        '''Given a dictionary (row) and a Record type, create a record of the
+        cast values in schema order. keys outside of the schema are dropped unless
+        the record type carries them
         '''
+        record = record_type([convert(row[field]) if field in row else None
+                              for field, convert in cls.compile(record_type.schema)])
 
-        for key in list(row.keys()):
-            value = row[key]
-            if key == 'Shape':
-                continue
-            elif isinstance(value, str):
-                new_value = "'{}'".format(value.replace('\'', '\'\''))
-            elif isinstance(value, datetime.datetime):
-                try:
-                    new_value = 'Cast(\'{}\' as date)'.format(value.strftime('%Y-%m-%d'))
-                except ValueError:
-                    #: year is before 1900
-                    iso = value.isoformat()
-                    date_string = iso.strip().split('T')[0]
-                    new_value = 'Cast(\'{}\' as date)'.format(date_string)
-            elif isinstance(value, datetime.time):
-                new_value = "'{}'".format(str(value))
-            elif value is None:
-                new_value = 'Null'
-            else:
-                new_value = str(value)
-            row[key] = new_value
+        for extra in record_type.extras:
+            if extra in row:
+                record[extra] = row[extra]
 
-        return row
+        return record
+
+    @classmethod
+    def cast_records(cls, rows, record_type):
+        '''Given a list of dictionaries (rows) and a Record type, returns a list of records'''
+        return [cls.cast_record(row, record_type) for row in rows]
 
 
 class Normalizer(object):
@@ -230,6 +375,65 @@ class Normalizer(object):
         'IN': 'Surface Water'
     }
 
+    inorganics_major_metals = ['calcium', 'dissolved calcium', 'dissolved magnesium', 'dissolved potassium', 'dissolved sodium', 'magnesium', 'potassium', 'sodium', 'sodium adsorption ratio',  # noqa
+                               'sodium adsorption ratio [(na)/(sq root of 1/2 ca + mg)]', 'sodium plus potassium', 'sodium, percent total cations', 'total calcium', 'total magnesium', 'total potassium', 'total sodium', 'percent sodium', 'hypochlorite ion']  # noqa
+    inorganics_major_nonmetals = ['acidity as caco3', 'alkalinity', 'alkalinity, bicarbonate as caco3', 'alkalinity, carbonate as caco3', 'alkalinity, hydroxide as caco3', 'alkalinity, phenolphthalein (total hydroxide+1/2 carbonate)', 'alkalinity, total', 'alkalinity, total as caco3', 'bicarbonate', 'bicarbonate as caco3', 'bicarbonate as hco3', 'bromide', 'carbon dioxide', 'carbonate', 'carbonate (co3)', 'carbonate as caco3', 'carbonate as co3', 'chloride', 'chlorine', 'dissolved oxygen (do)', 'dissolved oxygen (field)', 'dissolved oxygen saturation', 'fluoride', 'fluorine', 'gran acid neutralizing capacity',  # noqa
+                                  'hydrogen', 'hydrogen ion', 'hydroxide', 'inorganic carbon', 'oxygen', 'silica', 'silicon', 'sulfate', 'sulfide', 'sulfur', 'total alkalinity as caco3', 'total carbon', 'silica d/sio2', 't. alk/caco3', 'alkalinity as cac03', 'silica, dis. si02', 'carbon, total', 'chlorine dioxide', 'chlorite', 'residual chlorine', 'hydroxide as calcium carbonate', 'hydrogen sulfide', 'alkalinity, caco3 stability', 'acidity, total (caco3)', 'acidity, m.o. (caco3)', 'alkalinity, bicarbonate', 'alkalinity, carbonate', 'alkalinity, phenolphthalein', 'total chlorine', 'combined chlorine', 'perchlorate', 'free residual chlorine']  # noqa
+    inorganics_minor_nonmetals = ['antimony', 'argon', 'arsenate (aso43-)', 'arsenic', 'arsenite', 'boron', 'bromine', 'cyanide', 'cyanides amenable to chlorination (hcn & cn)', 'dissolved arsenic', 'dissolved boron', 'dissolved selenium',  # noqa
+                                  'germanium', 'helium', 'iodide', 'krypton', 'neon', 'perchlorate', 'selenium', 'sulfur hexafluoride', 'tellurium', 'total arsenic', 'total boron', 'total selenium', 'xenon', 'chlorate', 'antimony, total', 'boron, total', 'asbestos']  # noqa
+    inorganics_minor_metals = ['aluminum', 'barium', 'beryllium', 'bismuth', 'cadmium', 'cerium', 'cesium', 'chromium', 'chromium(iii)', 'chromium(vi)', 'cobalt', 'copper', 'dissolved aluminum', 'dissolved barium', 'dissolved cadmium', 'dissolved chromium', 'dissolved copper', 'dissolved iron', 'dissolved lead', 'dissolved manganese', 'dissolved mercury', 'dissolved molybdenum', 'dissolved nickel', 'dissolved zinc', 'dysprosium', 'erbium', 'europium', 'gadolinium', 'gallium', 'holmium', 'iron', 'iron, ion (fe2+)', 'lanthanum', 'lead', 'lithium', 'lutetium', 'manganese', 'mercury', 'molybdenum', 'neodymium', 'nickel', 'niobium', 'praseodymium', 'rhenium', 'rubidium', 'samarium', 'scandium', 'silver',  # noqa
+                               'strontium', 'terbium', 'thallium', 'thulium', 'tin', 'titanium', 'total aluminum', 'total barium', 'total cadmium', 'total chromium', 'total copper', 'total iron', 'total iron-d max, dmr', 'total lead', 'total manganese', 'total mercury', 'total molybdenum', 'total nickel', 'total zinc', 'tungsten', 'vanadium', 'ytterbium', 'yttrium', 'zinc', 'zirconium', 'iron, dissolved', 'chromium, hex, as cr', 'copper, free', 'iron, suspended', 'manganese, suspended', 'beryllium, total', 'bismuth, total', 'chromium, hex', 'cobalt, total', 'lithium, total', 'molybdenum, total', 'thallium, total', 'tin, total', 'titanium, total', 'vanadium, total', 'lead summary', 'copper summary', 'manganese, dissolved']   # noqa
+    nutrient = ['ammonia', 'ammonia and ammonium', 'ammonia as n', 'ammonia as nh3', 'ammonia-nitrogen', 'ammonia-nitrogen as n', 'ammonium', 'ammonium as n', 'dissolved nitrate: no3', 'inorganic nitrogen (nitrate and nitrite)', 'inorganic nitrogen (nitrate and nitrite) as n', 'kjeldahl nitrogen', 'nitrate', 'nitrate as n', 'nitrate-nitrogen', 'nitrite', 'nitrite as n', 'nitrogen', 'orthophosphate', 'nitrogen, ammonium/ammonia ratio', 'dissolved nitrite: no2', 'nitrogen, mixed forms (nh3), (nh4), organic, (no2) and (no3)',  # noqa
+                'no2+no3 as n', 'organic nitrogen', 'ortho. phosphate', 'orthophosphate as p', 'phosphate', 'phosphate-phosphorus', 'phosphate-phosphorus as p', 'phosphate-phosphorus as po4', 'phosphorus', 'total phosphorus', 'nitrate + nitrite as n', 'phosphate, tot. dig. (as p)', 't.k.n.', 'phosphorus 0 as p', 'nitrogen-ammonia as (n)', 'nitrate-nitrite', 'phosphate, total', 'total kjeldahl nitrogen (in water mg/l)', 'phosphorus, soluble', 'phosphate, reactive', 'phosphorus, total']  # noqa
+
+    #: the unit conversions in the order they are checked. the first matching rule wins
+    #: (chemicals, units, datasource or None for all, conversion_rate, new_unit, new_chemical or None to keep it)
+    conversion_rules = [
+        (inorganics_major_metals + inorganics_major_nonmetals, ['ug/l'], None, 0.001, 'mg/l', None),
+        (inorganics_minor_metals + inorganics_minor_nonmetals, ['mg/l'], None, 1000, 'ug/l', None),
+        (nutrient, ['ug/l'], None, 0.001, 'mg/l', None),
+        (['nitrate'], ['mg/l as n'], None, 4.426802887, 'mg/l', None),
+        (['nitrite'], ['mg/l as n'], None, 3.284535258, 'mg/l', None),
+        (['phosphate'], ['mg/l as p'], None, 3.131265779, 'mg/l', None),
+        (['carbonate as caco3'], ['mg/l'], None, 0.60, 'mg/l', 'carbonate'),
+        (['bicarbonate as caco3'], ['mg/l', 'mg/l as caco3'], None, 1.22, 'mg/l', 'bicarbonate'),
+        (['alkalinity, bicarbonate as caco3'], ['mg/l'], None, 1.22, 'mg/l', 'bicarbonate'),
+        (['alkalinity, carbonate'], ['mg/l as caco3'], None, 0.60, 'mg/l', 'carbonate'),
+        (['carbonate as co3', 'carbonate (co3)'], ['mg/l'], None, None, None, 'carbonate'),
+        (['bicarbonate as hco3'], ['mg/l'], None, None, None, 'bicarbonate'),
+        (['alkalinity, carbonate as caco3'], ['mg/l as caco3'], None, 0.60, 'mg/l', 'carbonate based on alkalinity'),
+        (['alkalinity, bicarbonate', 'alkalinity'], ['mg/l as caco3'], None, 1.22, 'mg/l', 'bicarbonate based on alkalinity'),
+        (['t.alk/caco3', 'total alkalinity as caco3'], ['mg/l'], None, 1.22, 'mg/l', 'bicarbonate based on alkalinity'),
+        (['bicarbonate'], ['mg/l as caco3'], None, 1.22, 'mg/l', None),
+        (['phosphate-phosphorus'], ['mg/l as p', 'mg/l'], None, 3.131265779, 'mg/l', 'phosphate'),
+        (['sulfate as s'], ['mg/l'], None, 0.333792756, 'mg/l', 'sulfate'),
+        (['nitrate'], ['mg/l'], 'SDWIS', 4.426802887, 'mg/l', 'nitrate'),
+        (['nitrate-nitrogen'], ['mg/l as n'], None, 4.426802887, 'mg/l', 'nitrate'),
+        (['nitrate as n'], ['mg/l as n', 'mg/l'], None, 4.426802887, 'mg/l', 'nitrate'),
+        (['nitrate-nitrogen'], ['mg/l'], None, 4.426802887, 'mg/l', 'nitrite'),
+        (['nitrite as n'], ['mg/l as n', 'mg/l'], None, 3.284535258, 'mg/l', 'nitrite'),
+        (['nitrate-nitrite', 'inorganic nitrogen (nitrate and nitrite) as n', 'nitrate + nitrate as n', 'no2+no3 as n'],
+         ['mg/l as n', 'mg/l'], None, 4.426802887, 'mg/l', 'nitrate and nitrite as no3'),
+        (['phosphate-phosphorus as p', 'orthophosphate as p'], ['mg/l as p', 'mg/l'], None, 3.131265779, 'mg/l', 'phosphate'),
+        (['orthophosphate'], ['mg/l as p'], None, 3.131265779, 'mg/l', 'phosphate'),
+        (['ammonia and ammonium'], ['mg/l nh4'], None, 1.05918619, 'mg/l', 'ammonia'),
+        (['ammonia-nitrogen as n', 'ammonia-nitrogen'], ['mg/l as n', 'mg/l'], None, 1.21587526, 'mg/l', 'ammonia'),
+        (['ammonia'], ['mg/l as n'], None, 1.21587526, 'mg/l', 'ammonia'),
+        (['specific conductance'], ['ms/cm'], None, 1000, 'uS/cm', None),
+        (['specific conductance'], ['umho/cm'], None, None, 'uS/cm', None),
+        (['calcium'], ['ueq/l'], None, 20.039, 'mg/l', None),
+        (['magnesium'], ['ueq/l'], None, 12.1525, 'mg/l', None),
+        (['potassium'], ['ueq/l'], None, 39.0983, 'mg/l', None),
+        (['sodium'], ['ueq/l'], None, 22.9897, 'mg/l', None),
+        (['nitrate'], ['ueq/l'], None, 62.0049, 'mg/l', None),
+        (['chloride'], ['ueq/l'], None, 35.453, 'mg/l', None),
+        (['hydroxide'], ['ueq/l'], None, 17.0073, 'mg/l', None),
+        (['sulfate'], ['ueq/l'], None, 24.01565, 'mg/l', None)
+    ]
+
+    #: (chemical, unit): [(datasource, conversion_rate, new_unit, new_chemical)] built from the rules on first use
+    _conversions = None
+
     wqx_re = re.compile('(_WQX)-')
 
     @classmethod
@@ -259,180 +463,65 @@ class Normalizer(object):
         if chemical is None:
             return row
 
-        def calculate_amount(amount, conversion_rate):
+        conversion_rate, new_unit, chemical, pgroup = cls.get_conversion(chemical.lower(), unit, datasource)
+
+        row['Param'] = chemical
+
+        if new_unit is not None:
+            row['Unit'] = new_unit
+
+        if conversion_rate is not None:
+            amount = row['ResultValue']
+
             if amount is None:
-                return None
+                row['ResultValue'] = None
             elif not amount:
-                return 0
+                row['ResultValue'] = 0
+            else:
+                row['ResultValue'] = amount * conversion_rate
 
-            return amount * conversion_rate
+        if pgroup:
+            row['ParamGroup'] = pgroup
 
-        def calculate_paramgroup(chemical):
-            if chemical in param_groups:
-                paramgroup = param_groups[chemical]
+        return row
 
-                return paramgroup
+    @classmethod
+    def normalize_samples(cls, rows, datasource=None):
+        '''Given a list of rows, normalize all of them. returns a list of the normalized rows'''
+        return [cls.normalize_sample(row, datasource) for row in rows]
 
-        inorganics_major_metals = ['calcium', 'dissolved calcium', 'dissolved magnesium', 'dissolved potassium', 'dissolved sodium', 'magnesium', 'potassium', 'sodium', 'sodium adsorption ratio',  # noqa
-                                   'sodium adsorption ratio [(na)/(sq root of 1/2 ca + mg)]', 'sodium plus potassium', 'sodium, percent total cations', 'total calcium', 'total magnesium', 'total potassium', 'total sodium', 'percent sodium', 'hypochlorite ion']  # noqa
-        inorganics_major_nonmetals = ['acidity as caco3', 'alkalinity', 'alkalinity, bicarbonate as caco3', 'alkalinity, carbonate as caco3', 'alkalinity, hydroxide as caco3', 'alkalinity, phenolphthalein (total hydroxide+1/2 carbonate)', 'alkalinity, total', 'alkalinity, total as caco3', 'bicarbonate', 'bicarbonate as caco3', 'bicarbonate as hco3', 'bromide', 'carbon dioxide', 'carbonate', 'carbonate (co3)', 'carbonate as caco3', 'carbonate as co3', 'chloride', 'chlorine', 'dissolved oxygen (do)', 'dissolved oxygen (field)', 'dissolved oxygen saturation', 'fluoride', 'fluorine', 'gran acid neutralizing capacity',  # noqa
-                                      'hydrogen', 'hydrogen ion', 'hydroxide', 'inorganic carbon', 'oxygen', 'silica', 'silicon', 'sulfate', 'sulfide', 'sulfur', 'total alkalinity as caco3', 'total carbon', 'silica d/sio2', 't. alk/caco3', 'alkalinity as cac03', 'silica, dis. si02', 'carbon, total', 'chlorine dioxide', 'chlorite', 'residual chlorine', 'hydroxide as calcium carbonate', 'hydrogen sulfide', 'alkalinity, caco3 stability', 'acidity, total (caco3)', 'acidity, m.o. (caco3)', 'alkalinity, bicarbonate', 'alkalinity, carbonate', 'alkalinity, phenolphthalein', 'total chlorine', 'combined chlorine', 'perchlorate', 'free residual chlorine']  # noqa
-        inorganics_minor_nonmetals = ['antimony', 'argon', 'arsenate (aso43-)', 'arsenic', 'arsenite', 'boron', 'bromine', 'cyanide', 'cyanides amenable to chlorination (hcn & cn)', 'dissolved arsenic', 'dissolved boron', 'dissolved selenium',  # noqa
-                                      'germanium', 'helium', 'iodide', 'krypton', 'neon', 'perchlorate', 'selenium', 'sulfur hexafluoride', 'tellurium', 'total arsenic', 'total boron', 'total selenium', 'xenon', 'chlorate', 'antimony, total', 'boron, total', 'asbestos']  # noqa
-        inorganics_minor_metals = ['aluminum', 'barium', 'beryllium', 'bismuth', 'cadmium', 'cerium', 'cesium', 'chromium', 'chromium(iii)', 'chromium(vi)', 'cobalt', 'copper', 'dissolved aluminum', 'dissolved barium', 'dissolved cadmium', 'dissolved chromium', 'dissolved copper', 'dissolved iron', 'dissolved lead', 'dissolved manganese', 'dissolved mercury', 'dissolved molybdenum', 'dissolved nickel', 'dissolved zinc', 'dysprosium', 'erbium', 'europium', 'gadolinium', 'gallium', 'holmium', 'iron', 'iron, ion (fe2+)', 'lanthanum', 'lead', 'lithium', 'lutetium', 'manganese', 'mercury', 'molybdenum', 'neodymium', 'nickel', 'niobium', 'praseodymium', 'rhenium', 'rubidium', 'samarium', 'scandium', 'silver',  # noqa
-                                   'strontium', 'terbium', 'thallium', 'thulium', 'tin', 'titanium', 'total aluminum', 'total barium', 'total cadmium', 'total chromium', 'total copper', 'total iron', 'total iron-d max, dmr', 'total lead', 'total manganese', 'total mercury', 'total molybdenum', 'total nickel', 'total zinc', 'tungsten', 'vanadium', 'ytterbium', 'yttrium', 'zinc', 'zirconium', 'iron, dissolved', 'chromium, hex, as cr', 'copper, free', 'iron, suspended', 'manganese, suspended', 'beryllium, total', 'bismuth, total', 'chromium, hex', 'cobalt, total', 'lithium, total', 'molybdenum, total', 'thallium, total', 'tin, total', 'titanium, total', 'vanadium, total', 'lead summary', 'copper summary', 'manganese, dissolved']   # noqa
-        nutrient = ['ammonia', 'ammonia and ammonium', 'ammonia as n', 'ammonia as nh3', 'ammonia-nitrogen', 'ammonia-nitrogen as n', 'ammonium', 'ammonium as n', 'dissolved nitrate: no3', 'inorganic nitrogen (nitrate and nitrite)', 'inorganic nitrogen (nitrate and nitrite) as n', 'kjeldahl nitrogen', 'nitrate', 'nitrate as n', 'nitrate-nitrogen', 'nitrite', 'nitrite as n', 'nitrogen', 'orthophosphate', 'nitrogen, ammonium/ammonia ratio', 'dissolved nitrite: no2', 'nitrogen, mixed forms (nh3), (nh4), organic, (no2) and (no3)',  # noqa
-                    'no2+no3 as n', 'organic nitrogen', 'ortho. phosphate', 'orthophosphate as p', 'phosphate', 'phosphate-phosphorus', 'phosphate-phosphorus as p', 'phosphate-phosphorus as po4', 'phosphorus', 'total phosphorus', 'nitrate + nitrite as n', 'phosphate, tot. dig. (as p)', 't.k.n.', 'phosphorus 0 as p', 'nitrogen-ammonia as (n)', 'nitrate-nitrite', 'phosphate, total', 'total kjeldahl nitrogen (in water mg/l)', 'phosphorus, soluble', 'phosphate, reactive', 'phosphorus, total']  # noqa
+    @classmethod
+    def _compile_conversions(cls):
+        conversions = {}
 
-        chemical = chemical.lower()
-        milli_per_liter = 'mg/l'
-        conversion_rate = None
-        new_unit = None
+        for chemicals, units, datasource, conversion_rate, new_unit, new_chemical in cls.conversion_rules:
+            for chemical in chemicals:
+                for unit in units:
+                    conversions.setdefault((chemical, unit), []).append((datasource, conversion_rate, new_unit, new_chemical))
 
-        if (chemical in inorganics_major_metals or chemical in inorganics_major_nonmetals) and unit == 'ug/l':
-            conversion_rate = 0.001
-            new_unit = milli_per_liter
-        elif ((chemical in inorganics_minor_metals or chemical in inorganics_minor_nonmetals) and
-              unit == milli_per_liter):
-            conversion_rate = 1000
-            new_unit = 'ug/l'
-        elif chemical in nutrient and unit == 'ug/l':
-            conversion_rate = 0.001
-            new_unit = milli_per_liter
-        elif chemical == 'nitrate' and unit == 'mg/l as n':
-            conversion_rate = 4.426802887
-            new_unit = milli_per_liter
-        elif chemical == 'nitrite' and unit == 'mg/l as n':
-            conversion_rate = 3.284535258
-            new_unit = milli_per_liter
-        elif chemical == 'phosphate' and unit == 'mg/l as p':
-            conversion_rate = 3.131265779
-            new_unit = milli_per_liter
-        elif chemical == 'carbonate as caco3' and unit == milli_per_liter:
-            conversion_rate = 0.60
-            new_unit = milli_per_liter
-            chemical = 'carbonate'
-        elif ((chemical == 'bicarbonate as caco3' and (unit == milli_per_liter or unit == 'mg/l as caco3')) or
-              (chemical == 'alkalinity, bicarbonate as caco3' and unit == milli_per_liter)):
-            conversion_rate = 1.22
-            new_unit = milli_per_liter
-            chemical = 'bicarbonate'
-        elif chemical == 'alkalinity, carbonate' and unit == 'mg/l as caco3':
-            conversion_rate = 0.60
-            new_unit = milli_per_liter
-            chemical = 'carbonate'
-        elif (chemical == 'carbonate as co3' or chemical == 'carbonate (co3)') and unit == milli_per_liter:
-            chemical = 'carbonate'
-        elif chemical == 'bicarbonate as hco3' and unit == milli_per_liter:
-            chemical = 'bicarbonate'
-        elif chemical == 'alkalinity, carbonate as caco3' and unit == 'mg/l as caco3':
-            conversion_rate = 0.60
-            new_unit = milli_per_liter
-            chemical = 'carbonate based on alkalinity'
-        elif (((chemical == 'alkalinity, bicarbonate' or chemical == 'alkalinity') and unit == 'mg/l as caco3') or
-              ((chemical == 't.alk/caco3' or chemical == 'total alkalinity as caco3') and unit == milli_per_liter)):
-            conversion_rate = 1.22
-            new_unit = milli_per_liter
-            chemical = 'bicarbonate based on alkalinity'
-        elif chemical == 'bicarbonate' and unit == 'mg/l as caco3':
-            conversion_rate = 1.22
-            new_unit = milli_per_liter
-        elif chemical == 'phosphate-phosphorus' and (unit == 'mg/l as p' or unit == milli_per_liter):
-            conversion_rate = 3.131265779
-            new_unit = milli_per_liter
-            chemical = 'phosphate'
-        elif chemical == 'sulfate as s' and unit == milli_per_liter:
-            conversion_rate = 0.333792756
-            new_unit = milli_per_liter
-            chemical = 'sulfate'
-        elif chemical == 'nitrate' and unit == milli_per_liter and datasource == 'SDWIS':
-            conversion_rate = 4.426802887
-            new_unit = milli_per_liter
-            chemical = 'nitrate'
-        elif ((chemical == 'nitrate-nitrogen' and unit == 'mg/l as n') or
-              (chemical == 'nitrate as n' and (unit == 'mg/l as n' or unit == milli_per_liter))):
-            conversion_rate = 4.426802887
-            new_unit = milli_per_liter
-            chemical = 'nitrate'
-        elif chemical == 'nitrate-nitrogen' and unit == milli_per_liter:
-            conversion_rate = 4.426802887
-            new_unit = milli_per_liter
-            chemical = 'nitrite'
-        elif chemical == 'nitrite as n' and (unit == 'mg/l as n' or unit == milli_per_liter):
-            conversion_rate = 3.284535258
-            new_unit = milli_per_liter
-            chemical = 'nitrite'
-        elif ((chemical == 'nitrate-nitrite' or
-               chemical == 'inorganic nitrogen (nitrate and nitrite) as n' or
-               chemical == 'nitrate + nitrate as n' or
-               chemical == 'no2+no3 as n') and
-              (unit == 'mg/l as n' or unit == milli_per_liter)):
-            conversion_rate = 4.426802887
-            new_unit = milli_per_liter
-            chemical = 'nitrate and nitrite as no3'
-        elif ((chemical == 'phosphate-phosphorus as p' and unit == 'mg/l as p') or
-              (chemical == 'orthophosphate as p' and unit == 'mg/l as p') or
-              (chemical == 'phosphate-phosphorus as p' and unit == milli_per_liter) or
-              (chemical == 'orthophosphate as p' and unit == milli_per_liter) or
-              (chemical == 'orthophosphate' and unit == 'mg/l as p')):
-            conversion_rate = 3.131265779
-            new_unit = milli_per_liter
-            chemical = 'phosphate'
-        elif chemical == 'ammonia and ammonium' and unit == 'mg/l nh4':
-            conversion_rate = 1.05918619
-            new_unit = milli_per_liter
-            chemical = 'ammonia'
-        elif ((chemical == 'ammonia-nitrogen as n' and unit == 'mg/l as n') or
-              (chemical == 'ammonia-nitrogen' and unit == 'mg/l as n') or
-              (chemical == 'ammonia-nitrogen as n' and unit == milli_per_liter) or
-              (chemical == 'ammonia-nitrogen' and unit == milli_per_liter) or
-              (chemical == 'ammonia' and unit == 'mg/l as n')):
-            conversion_rate = 1.21587526
-            new_unit = milli_per_liter
-            chemical = 'ammonia'
-        elif chemical == 'specific conductance' and unit == 'ms/cm':
-            conversion_rate = 1000
-            new_unit = 'uS/cm'
-        elif chemical == 'specific conductance' and unit == 'umho/cm':
-            new_unit = 'uS/cm'
-        elif chemical == 'calcium' and unit == 'ueq/l':
-            conversion_rate = 20.039
-            new_unit = milli_per_liter
-        elif chemical == 'magnesium' and unit == 'ueq/l':
-            conversion_rate = 12.1525
-            new_unit = milli_per_liter
-        elif chemical == 'potassium' and unit == 'ueq/l':
-            conversion_rate = 39.0983
-            new_unit = milli_per_liter
-        elif chemical == 'sodium' and unit == 'ueq/l':
-            conversion_rate = 22.9897
-            new_unit = milli_per_liter
-        elif chemical == 'nitrate' and unit == 'ueq/l':
-            conversion_rate = 62.0049
-            new_unit = milli_per_liter
-        elif chemical == 'chloride' and unit == 'ueq/l':
-            conversion_rate = 35.453
-            new_unit = milli_per_liter
-        elif chemical == 'hydroxide' and unit == 'ueq/l':
-            conversion_rate = 17.0073
-            new_unit = milli_per_liter
-        elif chemical == 'sulfate' and unit == 'ueq/l':
-            conversion_rate = 24.01565
-            new_unit = milli_per_liter
+        return conversions
 
-        row['Param'] = chemical
+    @classmethod
+    @lru_cache(maxsize=8192)
+    def get_conversion(cls, chemical, unit, datasource=None):
+        '''Given a lowercase chemical, its unit and the datasource
+        returns (conversion_rate, new_unit, new_chemical, param_group)
+        '''
+        if cls._conversions is None:
+            cls._conversions = cls._compile_conversions()
 
-        if new_unit is not None:
-            row['Unit'] = new_unit
+        conversion_rate = None
+        new_unit = None
 
-        if conversion_rate is not None:
-            row['ResultValue'] = calculate_amount(row['ResultValue'], conversion_rate)
+        for rule_datasource, rule_rate, rule_unit, rule_chemical in cls._conversions.get((chemical, unit), []):
+            if rule_datasource is None or rule_datasource == datasource:
+                conversion_rate = rule_rate
+                new_unit = rule_unit
+                chemical = rule_chemical or chemical
 
-        pgroup = calculate_paramgroup(chemical)
-        if pgroup:
-            row['ParamGroup'] = pgroup
+                break
 
-        return row
+        return conversion_rate, new_unit, chemical, param_groups.get(chemical)
 
     @classmethod
     def normalize_station(cls, row):
@@ -448,19 +537,6 @@ class Normalizer(object):
 
         return row
 
-    @classmethod
-    def reorder_filter(cls, row, schema):
-        new_row = OrderedDict()
-        for field in schema:
-            #: SDWIS is a partial schema
-            #: add null values to missing fields
-            if field not in row:
-                row[field] = None
-
-            new_row[field] = row[field]
-
-        return new_row
-
 
 class ChargeBalancer(object):
     '''https://github.com/agrc/ugs-chemistry/issues/22'''
@@ -477,6 +553,10 @@ class ChargeBalancer(object):
                     'no2': 0.021736513,
                     'no3': 0.016129032}
 
+    #: the column of each ion in the batch matrix
+    _ions = ['ca', 'mg', 'na', 'k', 'cl', 'hco3', 'co3', 'so4', 'no2', 'no3', 'na+k']
+    _ion_columns = None
+
     @classmethod
     def calculate_charge_balance(cls, concentration, sampleId):
         calcium = cls._conversions['ca'] * (concentration.calcium or 0)
@@ -503,10 +583,16 @@ class ChargeBalancer(object):
         except ZeroDivisionError:
             balance = 0
 
+        return cls._get_rows(sampleId, balance, cation, anion)
+
+    @staticmethod
+    def _get_rows(sampleId, balance, cation, anion):
         def get_row(values):
-            #: add all fields from result schema with None as the default value
-            new_row = dict([(field, None) for field in list(schema.result.keys())])
-            new_row.update(values)
+            #: all fields from the result schema are None by default
+            new_row = Result()
+            for key, value in values.items():
+                new_row[key] = value
+
             return new_row
 
         return [get_row({
@@ -538,20 +624,834 @@ class ChargeBalancer(object):
         else:
             return []
 
+    @classmethod
+    def _get_ion_columns(cls):
+        '''the matrix column of every chemical name that is part of a charge balance'''
+        if cls._ion_columns is None:
+            chemical_map = Concentration().chemical_map
+            chemical_map.update((ion, ion) for ion in cls._ions)
+
+            cls._ion_columns = dict((chemical, cls._ions.index(ion)) for chemical, ion in chemical_map.items())
+
+        return cls._ion_columns
+
+    @classmethod
+    def get_charge_balances(cls, rows):
+        '''the charge balance rows for the normalized result rows of many samples.
+        the same as calling get_charge_balance for the rows of each sample
+        '''
+        ion_columns = cls._get_ion_columns()
+
+        samples = OrderedDict()
+        sample_indexes = []
+        ion_indexes = []
+        amounts = []
+
+        for row in rows:
+            index = samples.setdefault(row['SampleId'], len(samples))
+
+            #: the same rules as Concentration.set
+            if row.get('DetectCond') or row['ResultValue'] is None or row['Param'] is None:
+                continue
+
+            column = ion_columns.get(row['Param'].lower())
+
+            if column is None:
+                continue
+
+            sample_indexes.append(index)
+            ion_indexes.append(column)
+            amounts.append(row['ResultValue'])
+
+        if not samples:
+            return []
+
+        shape = (len(samples), len(cls._ions))
+        sums = np.zeros(shape)
+        counts = np.zeros(shape, dtype=int)
+
+        #: add.at sums duplicate chemicals in row order like the per sample mean
+        np.add.at(sums, (sample_indexes, ion_indexes), amounts)
+        np.add.at(counts, (sample_indexes, ion_indexes), 1)
+
+        found = counts > 0
+        means = np.divide(sums, counts, out=np.zeros(shape), where=found)
+
+        def ion(name):
+            column = cls._ions.index(name)
+
+            return means[:, column], found[:, column]
+
+        ca, has_ca = ion('ca')
+        mg, has_mg = ion('mg')
+        na, has_na = ion('na')
+        k, has_k = ion('k')
+        cl, has_cl = ion('cl')
+        hco3, has_hco3 = ion('hco3')
+        co3, _ = ion('co3')
+        so4, has_so4 = ion('so4')
+        no2, _ = ion('no2')
+        no3, _ = ion('no3')
+        na_k, has_na_k = ion('na+k')
+
+        #: the sodium, potassium and sodium_plus_potassium rules of Concentration
+        sodium = np.where(has_na, na, np.where(has_na_k & has_k, na_k - k, 0))
+        potassium = np.where(has_k, k, np.where(has_na_k & has_na, na_k - na, 0))
+        sodium_plus_potassium_is_zero = (has_na_k & has_na) | has_k
+        sodium_plus_potassium = np.where(sodium_plus_potassium_is_zero, 0, na_k)
+
+        has_sodium = has_na | (has_na_k & has_k)
+        has_major_params = (has_ca & has_mg & has_cl & has_hco3 & has_so4 &
+                            (has_sodium | sodium_plus_potassium_is_zero | has_na_k))
+
+        weights = cls._conversions
+
+        #: add in the same order as the per sample sums
+        cation = (0 + weights['ca'] * ca + weights['mg'] * mg + weights['na'] * sodium + weights['k'] * potassium +
+                  weights['na+k'] * sodium_plus_potassium)
+        anion = (0 + weights['cl'] * cl + weights['hco3'] * hco3 + weights['co3'] * co3 + weights['so4'] * so4 +
+                 weights['no3'] * no3 + weights['no2'] * no2)
+
+        total = cation + anion
+        with np.errstate(divide='ignore', invalid='ignore'):
+            balance = 100 * ((cation - anion) / total)
+
+        #: python floats so the rows round like the per sample path
+        values = zip(samples, has_major_params.tolist(), balance.tolist(), cation.tolist(), anion.tolist(), total.tolist())
+
+        balance_rows = []
+        for sample_id, valid, sample_balance, sample_cation, sample_anion, sample_total in values:
+            if not valid:
+                continue
+
+            if sample_total == 0:
+                sample_balance = 0
+
+            balance_rows.extend(cls._get_rows(sample_id, sample_balance, sample_cation, sample_anion))
+
+        return balance_rows
+
+
+class StationRegistry(object):
+    '''A utility class for looking up the coordinates of stations by their normalized StationId'''
+
+    def __init__(self):
+        #: station id: (Lon_X, Lat_Y)
+        self.coordinates = {}
+        self.loaded = False
+
+    @staticmethod
+    def canonical(station_id):
+        return str(station_id).strip()
+
+    def add(self, station_id, x, y):
+        if station_id is None or x is None or y is None:
+            return
+
+        self.coordinates[self.canonical(station_id)] = (x, y)
+
+    def add_stations(self, rows):
+        '''register the coordinates of station rows as they are seeded'''
+        for row in rows:
+            self.add(row['StationId'], row['Lon_X'], row['Lat_Y'])
+
+    def load(self, rows):
+        '''register (StationId, Lon_X, Lat_Y) rows read from the Stations table'''
+        for station_id, x, y in rows:
+            if station_id is not None and self.canonical(station_id) not in self.coordinates:
+                self.add(station_id, x, y)
+
+        self.loaded = True
+
+    def fill(self, rows):
+        '''set Lon_X and Lat_Y on the rows without coordinates from their station. returns the rows'''
+        for row in rows:
+            if row['StationId'] is None or row['Lon_X'] is not None or row['Lat_Y'] is not None:
+                continue
+
+            coordinates = self.coordinates.get(self.canonical(row['StationId']))
+
+            if coordinates is not None:
+                row['Lon_X'], row['Lat_Y'] = coordinates
+
+        return rows
+
+
+class CsvGrouper(object):
+    '''A utility class for reading the rows of a csv file grouped by a column in one pass.
+    the rows are sorted in runs of run_size rows that are spilled to temporary files and merged
+    so memory is bounded by the run size and not the file size.
+    '''
+
+    def __init__(self, file_path, column, run_size=100000, temp_location=None, where=None):
+        '''where - an optional function of the column value to choose the rows to group'''
+        self.file_path = file_path
+        self.column = column
+        self.run_size = run_size
+        self.temp_location = temp_location
+        self.where = where
+        self.header = None
+
+    def groups(self):
+        '''yields (value, rows) for every value of the column. the rows are tuples the width of the header
+        in the order of the file and self.header is set before the first group
+        '''
+        with ExitStack() as stack:
+            reader = csvreader(stack.enter_context(open(self.file_path, 'r')))
+
+            try:
+                self.header = next(reader)
+            except StopIteration:
+                return
+
+            index = self.header.index(self.column)
+            width = len(self.header)
+            key = itemgetter(index)
+
+            #: rows without the column cannot be grouped
+            rows = (row for row in reader if len(row) > index)
+
+            if self.where:
+                rows = (row for row in rows if self.where(row[index]))
+
+            runs = []
+            while True:
+                #: sorted is stable so rows keep their file order within a group
+                run = sorted(islice(rows, self.run_size), key=key)
+
+                if not runs and len(run) < self.run_size:
+                    #: the file fits in one run
+                    ordered = run
+                    break
+
+                if not run:
+                    #: merge prefers the earlier runs for equal values
+                    ordered = merge(*runs, key=key)
+                    break
+
+                runs.append(self._spill(run, stack))
+
+            for value, group in groupby(ordered, key=key):
+                #: pad and trim rows to the header like querycsv
+                yield value, [tuple(row[:width]) + (None,) * (width - len(row)) for row in group]
+
+    def _spill(self, rows, stack):
+        '''write the rows to a temporary file that is removed when the stack closes. returns a reader'''
+        run = stack.enter_context(TemporaryFile('w+', newline='', dir=self.temp_location))
+
+        csvwriter(run).writerows(rows)
+        run.seek(0)
+
+        return csvreader(run)
+
+
+class CsvIndex(object):
+    '''A utility class for reading the rows of chosen ids from a csv file through a sidecar index of the byte
+    offsets of every id. the index is built in one pass and built again when the size or mtime of the file changes
+    '''
+
+    tables = [
+        'CREATE TABLE Meta (Size INTEGER, MTime INTEGER, Id TEXT, HeaderEnd INTEGER)',
+        'CREATE TABLE Offsets (Id TEXT, Start INTEGER, End INTEGER)'
+    ]
+
+    #: the most ids in one sqlite query
+    query_size = 500
+
+    def __init__(self, file_path, column, index_path=None):
+        '''file_path - the csv file
+        column - the column with the ids
+        index_path - the sidecar file. defaults to the csv file with an .index.sqlite3 suffix
+        '''
+        self.file_path = file_path
+        self.column = column
+        self.index_path = index_path or file_path + '.index.sqlite3'
+        #: the encoding open uses for the csv file everywhere else
+        self.encoding = getpreferredencoding(False)
+
+    def is_current(self):
+        '''whether the index exists and was built for the current file'''
+        if not exists(self.index_path):
+            return False
+
+        try:
+            with sqlite3.connect(self.index_path) as connection:
+                meta = connection.execute('SELECT Size, MTime, Id FROM Meta').fetchone()
+        except sqlite3.Error:
+            return False
+
+        return meta == self._get_meta()
+
+    def build(self):
+        '''index the byte ranges of the ids in one streaming pass over the file'''
+        building = self.index_path + '.building'
+        if exists(building):
+            remove(building)
+
+        connection = sqlite3.connect(building)
+
+        try:
+            for table in self.tables:
+                connection.execute(table)
+
+            with open(self.file_path, 'rb') as csv_file:
+                records = self._records(csv_file)
+                header = next(records, None)
+                header_end = 0
+
+                if header:
+                    header_end = header[1]
+                    index = self._parse(header[2])[0].index(self.column)
+
+                    connection.executemany('INSERT INTO Offsets VALUES (?, ?, ?)', self._ranges(records, index))
+
+            connection.execute('INSERT INTO Meta VALUES (?, ?, ?, ?)', self._get_meta() + (header_end,))
+            connection.execute('CREATE INDEX Offsets_Id ON Offsets (Id)')
+            connection.commit()
+        finally:
+            connection.close()
+
+        #: an index is only current once it is complete
+        replace(building, self.index_path)
+
+    def get_rows(self, ids):
+        '''returns the header and a dictionary of id: the row tuples with that id in file order.
+        the rows are padded and trimmed to the header like querycsv
+        '''
+        if not self.is_current():
+            self.build()
+
+        ids = list(set(ids))
+        ranges = []
+
+        with sqlite3.connect(self.index_path) as connection:
+            header_end = connection.execute('SELECT HeaderEnd FROM Meta').fetchone()[0]
+
+            for start in range(0, len(ids), self.query_size):
+                chunk = ids[start:start + self.query_size]
+                ranges.extend(connection.execute('SELECT Id, Start, End FROM Offsets WHERE Id IN ({})'.format(
+                    ', '.join(['?'] * len(chunk))), chunk).fetchall())
+
+        rows = OrderedDict()
+        if header_end == 0:
+            return [], rows
+
+        with open(self.file_path, 'rb') as csv_file, mmap.mmap(csv_file.fileno(), 0, access=mmap.ACCESS_READ) as data:
+            header = self._parse(data[:header_end])[0]
+            width = len(header)
+            index = header.index(self.column)
+
+            for id, start, end in sorted(ranges, key=itemgetter(1)):
+                rows.setdefault(id, []).extend(tuple(row[:width]) + (None,) * (width - len(row))
+                                               for row in self._parse(data[start:end]) if len(row) > index)
+
+        return header, rows
+
+    def _get_meta(self):
+        file_stat = stat(self.file_path)
+
+        return (file_stat.st_size, file_stat.st_mtime_ns, self.column)
+
+    def _parse(self, data):
+        '''parse csv bytes with the newline translation of a file opened for reading'''
+        text = data.decode(self.encoding).replace('\r\n', '\n').replace('\r', '\n')
+
+        return list(csvreader(StringIO(text)))
+
+    def _ranges(self, records, index):
+        '''yields (id, start, end) for every run of records with the same id'''
+        current = None
+
+        for start, end, record in records:
+            row = self._parse(record)
+
+            if not row or len(row[0]) <= index:
+                continue
+
+            id = row[0][index]
+
+            if current and current[0] == id and current[2] == start:
+                current[2] = end
+
+                continue
+
+            if current:
+                yield tuple(current)
+
+            current = [id, start, end]
+
+        if current:
+            yield tuple(current)
+
+    @staticmethod
+    def _records(csv_file):
+        '''yields (start, end, bytes) for every csv record of a binary file. quoted fields can span lines'''
+        start = 0
+        position = 0
+        quotes = 0
+        parts = []
+
+        for line in csv_file:
+            parts.append(line)
+            position += len(line)
+            #: quotes are escaped by doubling them so an odd count is an open field
+            quotes += line.count(b'"')
+
+            if quotes % 2 == 0:
+                yield start, position, b''.join(parts)
+
+                start = position
+                quotes = 0
+                parts = []
+
+        if parts:
+            yield start, position, b''.join(parts)
+
+
+class HttpCache(object):
+    '''A utility class for keeping gzipped response bodies on disk with the headers to revalidate them.
+    the least recently used responses are removed once the cache is larger than max_bytes
+    '''
+
+    tables = [
+        'CREATE TABLE IF NOT EXISTS Responses (Key TEXT PRIMARY KEY, Url TEXT, ETag TEXT, LastModified TEXT,'
+        ' Encoding TEXT, Size INTEGER, Used REAL) WITHOUT ROWID',
+        'CREATE TABLE IF NOT EXISTS Counts (Key TEXT, Header TEXT, Count INTEGER, PRIMARY KEY (Key, Header)) WITHOUT ROWID'
+    ]
+
+    def __init__(self, location, max_bytes=2 * 1024 ** 3, offline=False):
+        '''location - the folder for the cached responses
+        max_bytes - the most bytes of compressed bodies to keep
+        offline - only replay cached responses instead of making requests
+        '''
+        self.location = location
+        self.max_bytes = max_bytes
+        self.offline = offline
+
+        makedirs(location, exist_ok=True)
+
+        with self._connect() as connection:
+            for table in self.tables:
+                connection.execute(table)
+
+    @staticmethod
+    def key(url):
+        '''the key of url with its scheme and host lower case and its query sorted'''
+        parts = urlsplit(url)
+        query = urlencode(sorted(parse_qsl(parts.query, keep_blank_values=True)))
+        url = urlunsplit((parts.scheme.lower(), parts.netloc.lower(), parts.path or '/', query, ''))
+
+        return sha1(url.encode('utf-8')).hexdigest()
+
+    @staticmethod
+    def conditional_headers(entry):
+        '''the request headers to revalidate a cached entry'''
+        headers = {}
+
+        if entry and entry['etag']:
+            headers['If-None-Match'] = entry['etag']
+
+        if entry and entry['last_modified']:
+            headers['If-Modified-Since'] = entry['last_modified']
+
+        return headers
+
+    def get(self, url):
+        '''returns the cached entry for url or None'''
+        key = self.key(url)
+
+        with self._connect() as connection:
+            row = connection.execute('SELECT ETag, LastModified, Encoding FROM Responses WHERE Key = ?', (key,)).fetchone()
+
+        if not row or not exists(self._body_path(key)):
+            return None
+
+        return {'key': key, 'etag': row[0], 'last_modified': row[1], 'encoding': row[2]}
+
+    def get_count(self, url, header):
+        '''returns a tuple of the recorded count of the header for url or None when it was never recorded'''
+        with self._connect() as connection:
+            return connection.execute('SELECT Count FROM Counts WHERE Key = ? AND Header = ?',
+                                      (self.key(url), header)).fetchone()
+
+    def store_count(self, url, header, count):
+        '''record the count of the header from a HEAD request so the same requests can be planned offline'''
+        with self._connect() as connection:
+            connection.execute('INSERT OR REPLACE INTO Counts VALUES (?, ?, ?)', (self.key(url), header, count))
+
+    def read(self, entry, writer, chunk_size=1024 * 1024):
+        '''write the cached body of entry to writer. returns the number of bytes'''
+        size = 0
+
+        with gzip.open(self._body_path(entry['key']), 'rb') as body:
+            for chunk in iter(lambda: body.read(chunk_size), b''):
+                size += len(chunk)
+                writer.write(chunk)
+
+        with self._connect() as connection:
+            connection.execute('UPDATE Responses SET Used = ? WHERE Key = ?', (time(), entry['key']))
+
+        return size
+
+    @contextmanager
+    def store(self, url, headers, encoding):
+        '''yields a file to write the body of url to. the body is cached once the block completes'''
+        key = self.key(url)
+        handle, path = mkstemp(suffix='.part', dir=self.location)
+
+        try:
+            with open(handle, 'wb') as part, gzip.GzipFile(fileobj=part, mode='wb', compresslevel=1) as body:
+                yield body
+
+            replace(path, self._body_path(key))
+        except BaseException:
+            remove(path)
+
+            raise
+
+        with self._connect() as connection:
+            connection.execute('INSERT OR REPLACE INTO Responses VALUES (?, ?, ?, ?, ?, ?, ?)',
+                               (key, url, headers.get('ETag'), headers.get('Last-Modified'), encoding,
+                                stat(self._body_path(key)).st_size, time()))
+
+        self.evict()
+
+    def evict(self):
+        '''remove the least recently used responses until the cache fits in max_bytes.
+        the most recent response is always kept
+        '''
+        with self._connect() as connection:
+            rows = connection.execute('SELECT Key, Size FROM Responses ORDER BY Used DESC').fetchall()
+
+        total = 0
+        evicted = []
+        for index, (key, size) in enumerate(rows):
+            total += size
+
+            if index > 0 and total > self.max_bytes:
+                evicted = [row[0] for row in rows[index:]]
+
+                break
+
+        if not evicted:
+            return
+
+        with self._connect() as connection:
+            connection.executemany('DELETE FROM Responses WHERE Key = ?', [(key,) for key in evicted])
+
+        for key in evicted:
+            try:
+                remove(self._body_path(key))
+            except OSError:
+                pass
+
+    def _body_path(self, key):
+        return join(self.location, key + '.gz')
+
+    @contextmanager
+    def _connect(self):
+        #: requests are made from many threads so every call has its own connection
+        connection = sqlite3.connect(join(self.location, 'index.sqlite3'), timeout=300)
+
+        try:
+            with connection:
+                yield connection
+        finally:
+            connection.close()
+
 
 class HttpClient(object):
     """A wrapper around requests for testing"""
 
+    #: the bytes read from the response at a time
+    chunk_size = 1024 * 1024
+
+    #: the optional HttpCache to replay and revalidate responses with
+    cache = None
+
     @staticmethod
-    def get_csv(url, logger):
-        response = get(url)
+    def get_csv(url, logger, temp_location=None, compress=False):
+        '''download the csv at url to a temporary file and return a csv reader over it
+        temp_location - the folder for the temporary file. defaults to the system temp folder
+        compress - gzip the temporary file to trade cpu for disk
+        '''
+        spool, encoding, metrics = HttpClient.download(url, logger, temp_location=temp_location, compress=compress)
+
+        logger.info('downloaded {} bytes in {} seconds ({} bytes per second)'.format(
+            metrics['bytes'], round(metrics['seconds'], 3), round(metrics['bytes_per_second'])))
+
+        return csvreader(TextIOWrapper(spool, encoding=encoding, newline=''))
+
+    @staticmethod
+    def get_count(url, header='total-result-count'):
+        '''the count the service reports in the header of a HEAD request for url. None when it is missing.
+        the counts are recorded in the cache and replayed from it when it is offline
+        '''
+        cache = HttpClient.cache
+
+        if cache and cache.offline:
+            count = cache.get_count(url, header)
+
+            if not count:
+                raise Exception('the count of {} is not cached and the cache is offline.'.format(url))
+
+            return count[0]
+
+        response = head(url)
         response.raise_for_status()
 
         try:
-            logger.info('query completed in {}'.format(response.elapsed))
-            logger.info('new sites found {}'.format(response.headers['total-site-count']))
-            logger.info('new results found {}'.format(response.headers['total-result-count']))
-        except:
-            pass
+            count = int(response.headers[header])
+        except (KeyError, ValueError):
+            count = None
+
+        if cache:
+            cache.store_count(url, header, count)
+
+        return count
+
+    @staticmethod
+    def download(url, logger, temp_location=None, compress=False):
+        '''stream the response body of url, or replay it from the cache, to a temporary file in chunks.
+        returns the binary file at its start, the text encoding and a dictionary of the download metrics
+        '''
+        spool = TemporaryFile('w+b', dir=temp_location)
+        writer = spool
+        if compress:
+            writer = gzip.GzipFile(fileobj=spool, mode='wb', compresslevel=1)
+
+        size = 0
+        start = time()
+        cache = HttpClient.cache
+        entry = cache.get(url) if cache else None
+
+        if cache and cache.offline:
+            if not entry:
+                raise Exception('{} is not cached and the cache is offline.'.format(url))
+
+            size = cache.read(entry, writer)
+        else:
+            with get(url, stream=True, headers=HttpCache.conditional_headers(entry)) as response:
+                if entry and response.status_code == 304:
+                    logger.info('cached response is current')
+
+                    size = cache.read(entry, writer)
+                else:
+                    entry = None
+
+                    response.raise_for_status()
+
+                    try:
+                        logger.info('query completed in {}'.format(response.elapsed))
+                        logger.info('new sites found {}'.format(response.headers['total-site-count']))
+                        logger.info('new results found {}'.format(response.headers['total-result-count']))
+                    except:
+                        pass
+
+                    encoding = response.encoding or 'utf-8'
+
+                    with ExitStack() as stack:
+                        writers = [writer]
+                        if cache:
+                            writers.append(stack.enter_context(cache.store(url, response.headers, encoding)))
+
+                        for chunk in response.iter_content(chunk_size=HttpClient.chunk_size):
+                            size += len(chunk)
+
+                            for body in writers:
+                                body.write(chunk)
+
+        seconds = time() - start
+
+        if entry:
+            encoding = entry['encoding']
+
+        if compress:
+            #: closing the gzip file writes its trailer but leaves the temporary file open
+            writer.close()
+
+        spool.seek(0)
+
+        if compress:
+            spool = gzip.GzipFile(fileobj=spool, mode='rb')
+
+        return spool, encoding, {
+            'bytes': size,
+            'seconds': seconds,
+            'bytes_per_second': size / seconds if seconds else 0,
+            'cached': entry is not None
+        }
+
+
+class RowBuffer(object):
+    '''A utility class for collecting rows across many samples and flushing them in batches'''
+
+    def __init__(self, flush, size=5000, seconds=60):
+        '''create a new row buffer
+        flush - the function to call with the buffered rows
+        size - the number of rows to collect before flushing
+        seconds - the longest time rows can wait in the buffer before flushing
+        '''
+        self._flush = flush
+        self.size = size
+        self.seconds = seconds
+        self.rows = []
+        self.flushed_at = time()
+
+    def extend(self, rows):
+        '''add rows to the buffer and flush when it is full or has waited too long'''
+        self.rows.extend(rows)
+
+        if len(self.rows) >= self.size or time() - self.flushed_at >= self.seconds:
+            self.flush()
+
+    def flush(self):
+        '''send all of the buffered rows to the flush function'''
+        rows = self.rows
+
+        self.rows = []
+        self.flushed_at = time()
+
+        if len(rows) > 0:
+            self._flush(rows)
+
+
+class ConnectionPool(object):
+    '''A utility class for sharing one connection per database, process and thread across programs'''
+
+    def __init__(self, cursor_factory, logger, session_statements=[]):
+        '''create a new connection pool
+        cursor_factory - the backend function to connect to a database and create a cursor
+        logger - where to report connect and idle times
+        session_statements - the statements to run once on every new connection
+        '''
+        self._cursor_factory = cursor_factory
+        self.logger = logger
+        self.session_statements = session_statements
+        self.cursors = {}
+        self.used_at = {}
+
+    def cursor(self, connection_string):
+        '''a drop in cursor_factory that reuses an open connection when there is one'''
+        #: workers in other processes or threads get their own connection
+        key = (connection_string, getpid(), get_ident())
+
+        if key in self.cursors:
+            self.logger.debug('reusing connection idle for {} ms'.format(round((time() - self.used_at[key]) * 1000, 5)))
+            self.used_at[key] = time()
+
+            return self.cursors[key]
+
+        start = time()
+
+        cursor = self._cursor_factory(connection_string)
+        for statement in self.session_statements:
+            cursor.execute(statement)
+
+        self.logger.info('connected in {} ms'.format(round((time() - start) * 1000, 5)))
+
+        self.cursors[key] = cursor
+        self.used_at[key] = time()
+
+        return cursor
+
+    def close_all(self):
+        '''close every connection so no sessions are left open on the server. uncommitted work is rolled back'''
+        cursors = self.cursors
+
+        self.cursors = {}
+
+        for key, cursor in cursors.items():
+            self.logger.info('closing connection idle for {} ms'.format(round((time() - self.used_at.pop(key)) * 1000, 5)))
+
+            try:
+                cursor.close()
+                cursor.connection.close()
+            except Exception as e:
+                self.logger.warning('could not close connection. {}'.format(e))
+
+    def __getstate__(self):
+        #: connections cannot be shared with other processes
+        state = self.__dict__.copy()
+        state['cursors'] = {}
+        state['used_at'] = {}
+
+        return state
+
+
+class Checkpoint(object):
+    '''A utility class for recording the seeding work that is committed so a failed seed can resume'''
+
+    tables = [
+        'CREATE TABLE IF NOT EXISTS Samples (Program TEXT, Source TEXT, SampleId TEXT, PRIMARY KEY (Program, Source, SampleId))'
+        ' WITHOUT ROWID',
+        'CREATE TABLE IF NOT EXISTS Steps (Program TEXT, Step TEXT, PRIMARY KEY (Program, Step)) WITHOUT ROWID'
+    ]
+
+    def __init__(self, path):
+        '''path - the sqlite file holding the checkpoints'''
+        self.path = path
+        self.connections = {}
+
+    @staticmethod
+    def key(sample_id):
+        '''the sample id as it is cast into a result row'''
+        return str(sample_id).strip()
+
+    @property
+    def connection(self):
+        #: worker processes open their own connection and wait on each other to write
+        pid = getpid()
+
+        if pid not in self.connections:
+            connection = sqlite3.connect(self.path, timeout=300)
+
+            for table in self.tables:
+                connection.execute(table)
+
+            self.connections[pid] = connection
+
+        return self.connections[pid]
+
+    def complete_samples(self, program, source, sample_ids):
+        '''record the sample ids whose results are committed'''
+        with self.connection as connection:
+            connection.executemany('INSERT OR IGNORE INTO Samples VALUES (?, ?, ?)',
+                                   [(program, source, self.key(sample_id)) for sample_id in sample_ids])
+
+    def get_completed_samples(self, program, source):
+        '''returns the set of sample ids whose results are committed'''
+        rows = self.connection.execute('SELECT SampleId FROM Samples WHERE Program = ? AND Source = ?', (program, source))
+
+        return set(row[0] for row in rows)
+
+    def complete(self, program, step):
+        '''record that all of the work of a step, such as a file, is committed'''
+        with self.connection as connection:
+            connection.execute('INSERT OR IGNORE INTO Steps VALUES (?, ?)', (program, step))
+
+    def is_complete(self, program, step):
+        rows = self.connection.execute('SELECT 1 FROM Steps WHERE Program = ? AND Step = ?', (program, step))
+
+        return rows.fetchone() is not None
+
+    def clear(self):
+        '''forget all of the work to start a new seed'''
+        with self.connection as connection:
+            connection.execute('DELETE FROM Samples')
+            connection.execute('DELETE FROM Steps')
+
+    def close(self):
+        connections = self.connections
+
+        self.connections = {}
+
+        for connection in connections.values():
+            connection.close()
+
+    def __getstate__(self):
+        #: connections cannot be shared with other processes
+        state = self.__dict__.copy()
+        state['connections'] = {}
 
-        return csvreader((txt for txt in response.text.splitlines()))
+        return state
@@ -3,10 +3,15 @@
 '''
 sql.py
 ----------------------------------
-sql queries shared between programs
+sql queries shared between programs and the sql server backend
 '''
-import pyodbc
+from . import schema
 from .services import Reproject
+try:
+    import pyodbc
+except ImportError:
+    #: the driver manager is only needed for sql server and sdwis
+    pyodbc = None
 
 
 sql_statements = {
@@ -14,73 +19,213 @@ sql_statements = {
                        ' HUC8, Lon_X, Lat_Y, HorAcc, HorAccUnit, HorCollMeth, HorRef, Elev, ElevUnit, ElevAcc,' +
                        ' ElevAccUnit, ElevMeth, ElevRef, StateCode, CountyCode, Aquifer, FmType, AquiferType,' +
                        ' ConstDate, Depth, DepthUnit, HoleDepth, HoleDUnit, demELEVm, DataSource, WIN, Shape)' +
-                       ' values ({})'),
+                       ' values ({}, geometry::STGeomFromText(?, 26912))').format(', '.join(['?'] * 32)),
     'result_insert': ('insert into Results (AnalysisDate, AnalytMeth, AnalytMethId, AutoQual, CAS_Reg, Chrg,' +
                       ' DataSource, DetectCond, IdNum, LabComments, LabName, Lat_Y, LimitType, Lon_X, MDL,' +
                       ' MDLUnit, MethodDescript, OrgId, OrgName, Param, ParamGroup, ProjectId, QualCode,' +
                       ' ResultComment, ResultStatus, ResultValue, SampComment, SampDepth, SampDepthRef,' +
                       ' SampDepthU, SampEquip, SampFrac, SampleDate, SampleTime, SampleId, SampMedia, SampMeth,' +
-                      ' SampMethName, SampType, StationId, Unit, USGSPCode) values ({})'),
+                      ' SampMethName, SampType, StationId, Unit, USGSPCode) values ({})').format(', '.join(['?'] * 42)),
 }
 
+index_statements = {
+    'enabled': ('SELECT i.name, t.name FROM sys.indexes i JOIN sys.tables t ON i.object_id = t.object_id'
+                ' WHERE t.name IN (\'Results\', \'Stations\') AND i.type_desc IN (\'NONCLUSTERED\', \'SPATIAL\')'
+                ' AND i.is_disabled = 0'),
+    'disable': 'ALTER INDEX [{}] ON [{}] DISABLE',
+    'rebuild': 'ALTER INDEX [{}] ON [{}] REBUILD'
+}
+
+#: the (index, table) that the merge statements match new rows with. they stay enabled while resuming
+merge_indices = [('SampleId_index', 'Results'), ('StationId_index', 'Stations')]
+
+
+#: run once on every pooled connection
+#: no row count messages for each insert and roll back the whole transaction when a statement fails
+session_statements = [
+    'SET NOCOUNT ON',
+    'SET XACT_ABORT ON'
+]
+
+#: the files in the scripts folder to create and maintain the schema
+scripts = {
+    'tables': 'createTables.sql',
+    'indices': 'createIndices.sql',
+    'params': 'populateParamsTable.sql'
+}
+
+
+def _merge(table, fields, keys):
+    '''Given a table, its ordered fields and the natural key of a row, create the statements
+    to stage rows in a session temp table and insert the ones not already in the table'''
+
+    staging = '#{}Staging'.format(table)
+    columns = ', '.join(fields)
+    values = ', '.join(['geometry::STGeomFromText(?, 26912)' if field == 'Shape' else '?' for field in fields])
+    #: charge balance rows have no SampleDate so the keys match when both are null
+    matches = ' AND '.join(['(t.[{0}] = s.[{0}] OR (t.[{0}] IS NULL AND s.[{0}] IS NULL))'.format(key) for key in keys])
+
+    return {
+        'create': 'IF OBJECT_ID(\'tempdb..{0}\') IS NULL SELECT TOP 0 {1} INTO {0} FROM {2}'.format(staging, columns, table),
+        'truncate': 'TRUNCATE TABLE {}'.format(staging),
+        'stage': 'insert into {} ({}) values ({})'.format(staging, columns, values),
+        'merge': ('insert into {2} ({1}) SELECT {1} FROM {0} s WHERE NOT EXISTS('
+                  'SELECT 1 FROM {2} t WHERE {3})').format(staging, columns, table, matches)
+    }
+
+
+def merge_statements(result_keys):
+    '''Given the fields that identify a result for a program, create the statements for
+    loading stations and results without duplicating existing rows'''
+
+    return {
+        'station_insert': _merge('Stations', list(schema.station.keys()), ['StationId']),
+        'result_insert': _merge('Results', list(schema.result.keys()), result_keys)
+    }
+
+
+def key_statements(table, keys):
+    '''Given a table and the fields of its natural key, create the statements to stage candidate
+    keys in a session temp table and select the ones not already in the table'''
+
+    staging = '#{}Keys'.format(table)
+    columns = ', '.join(['[{}]'.format(key) for key in keys])
+    matches = ' AND '.join(['t.[{0}] = s.[{0}]'.format(key) for key in keys])
+
+    return {
+        'drop': 'IF OBJECT_ID(\'tempdb..{0}\') IS NOT NULL DROP TABLE {0}'.format(staging),
+        'create': 'SELECT TOP 0 {1} INTO {0} FROM {2}'.format(staging, columns, table),
+        'stage': 'insert into {} ({}) values ({})'.format(staging, columns, ', '.join(['?'] * len(keys))),
+        'index': 'CREATE CLUSTERED INDEX [IX_{}Keys] ON {} ({})'.format(table, staging, columns),
+        'select': 'SELECT DISTINCT {1} FROM {0} s WHERE NOT EXISTS(SELECT 1 FROM {2} t WHERE {3})'.format(
+            staging, columns, table, matches)
+    }
+
 
 def create_cursor(connection_string):
     c = pyodbc.connect(connection_string)
     return c.cursor()
 
 
-def insert_rows(rows, insert_statement, cursor):
-    '''Given a list of fields and a sql statement, execute the statement after `batch_size` number of statements'''
-    batch_size = 5000
+def execute_script(script, cursor):
+    '''Given the contents of a sql file, run all of its statements as one batch'''
 
-    i = 1
-    #: format and stage sql statements
-    for row in rows:
-        try:
-            statement = insert_statement.format(','.join(row))
-            cursor.execute(statement)
-            i += 1
+    cursor.execute(script)
+    cursor.commit()
+
+
+def insert_rows(rows, insert_statement, cursor, batch_size=5000):
+    '''Given a list of rows and a parameterized sql statement, send the rows to the server
+    `batch_size` rows at a time using one transaction per batch'''
+
+    #: bind all of the parameters for a batch in one round trip
+    cursor.fast_executemany = True
 
-            #: commit commands to database
-            if i % batch_size == 0:
-                cursor.commit()
+    for start in range(0, len(rows), batch_size):
+        batch = rows[start:start + batch_size]
 
+        try:
+            cursor.executemany(insert_statement, batch)
             cursor.commit()
         except Exception as e:
-            del cursor
-            print(statement)
-            print(row)
+            cursor.rollback()
 
             raise e
 
 
-def update_row(row, datasource):
-    '''Given a dictionary as a row, take the lat and long field,
-    an arcpy x,y tuple, possibly project it to UTM, and transform to WKT'''
+def merge_rows(rows, merge, cursor, batch_size=5000):
+    '''Given a list of rows and the statements from `merge_statements`, load the rows
+    `batch_size` at a time into a session temp table and insert the rows that do not
+    exist yet with one set based statement for all of the rows'''
+
+    cursor.fast_executemany = True
+
+    cursor.execute(merge['create'])
+    cursor.commit()
+
+    try:
+        cursor.execute(merge['truncate'])
+
+        for start in range(0, len(rows), batch_size):
+            cursor.executemany(merge['stage'], rows[start:start + batch_size])
+
+        #: the rows of a sample can span batches so they are only matched against the table once
+        cursor.execute(merge['merge'])
+        cursor.commit()
+    except Exception as e:
+        cursor.rollback()
+
+        raise e
+
+
+def find_new_keys(keys, statements, cursor, batch_size=5000):
+    '''Given a list of key tuples and the statements from `key_statements`, load the keys
+    `batch_size` at a time into a session temp table and return the set of keys that are not
+    in the table yet from one indexed anti join'''
+
+    if len(keys) == 0:
+        return set()
+
+    cursor.fast_executemany = True
+
+    try:
+        cursor.execute(statements['drop'])
+        cursor.execute(statements['create'])
 
-    template = 'geometry::STGeomFromText(\'POINT ({} {})\', 26912)'
+        for start in range(0, len(keys), batch_size):
+            cursor.executemany(statements['stage'], keys[start:start + batch_size])
+
+        cursor.execute(statements['index'])
+
+        new_keys = set(tuple(row) for row in cursor.execute(statements['select']).fetchall())
+
+        cursor.execute(statements['drop'])
+        cursor.commit()
+    except Exception as e:
+        cursor.rollback()
+
+        raise e
+
+    return new_keys
+
+
+def update_rows(rows, datasource):
+    '''Given a list of dictionaries as rows, set the DataSource and take the lat and long
+    fields or an arcpy x,y tuple, project them to UTM in one batch, and transform to WKT'''
+
+    template = 'POINT ({} {})'
+
+    points = []
+    xs = []
+    ys = []
+
+    for row in rows:
+        row['DataSource'] = datasource
 
-    row['DataSource'] = datasource
+        if 'Shape@XY' in row:
+            row['Shape'] = None
 
-    if 'Shape@XY' in row:
-        row['Shape'] = None
+            x = row['Shape@XY'][0]
+            y = row['Shape@XY'][1]
 
-        x = row['Shape@XY'][0]
-        y = row['Shape@XY'][1]
+            del row['Shape@XY']
+        else:
+            x = row['Lon_X']
+            y = row['Lat_Y']
 
-        del row['Shape@XY']
-    else:
-        x = row['Lon_X']
-        y = row['Lat_Y']
+        if not (x and y):
+            continue
 
-    if not (x and y):
-        return row
+        if 'Shape' not in row:
+            continue
 
-    if 'Shape' not in row:
-        return row
+        points.append(row)
+        xs.append(x)
+        ys.append(y)
 
-    shape = Reproject.to_utm(x, y)
+    xs, ys = Reproject.to_utm_points(xs, ys)
 
-    row['Shape'] = template.format(shape[0], shape[1])
+    for row, x, y in zip(points, xs, ys):
+        row['Shape'] = template.format(x, y)
 
-    return row
+    return rows
@@ -0,0 +1,103 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+'''
+sqlite.py
+----------------------------------
+an embedded database backend for local seeds and offline snapshots
+'''
+import sqlite3
+from . import schema
+from .sql import insert_rows, merge_rows, update_rows  # noqa
+from datetime import date, datetime, time
+
+#: store dates and times as iso 8601 text like the sql server string representation
+sqlite3.register_adapter(date, lambda value: value.isoformat())
+sqlite3.register_adapter(datetime, lambda value: value.isoformat(' '))
+sqlite3.register_adapter(time, lambda value: value.isoformat())
+
+
+sql_statements = {
+    #: the shape is stored as well known text
+    'station_insert': 'insert into Stations ({}) values ({})'.format(', '.join(schema.station.keys()),
+                                                                     ', '.join(['?'] * len(schema.station))),
+    'result_insert': 'insert into Results ({}) values ({})'.format(', '.join(schema.result.keys()),
+                                                                   ', '.join(['?'] * len(schema.result)))
+}
+
+#: sqlite cannot disable an index so it is dropped and created again from its definition
+index_statements = {
+    'enabled': ('SELECT name, tbl_name, sql FROM sqlite_master WHERE type = \'index\''
+                ' AND tbl_name IN (\'Results\', \'Stations\') AND sql IS NOT NULL'),
+    'disable': 'DROP INDEX [{0}]',
+    'rebuild': '{2}'
+}
+
+#: the (index, table) that the merge statements match new rows with. they stay enabled while resuming
+merge_indices = [('Results_SampleId_index', 'Results'), ('Stations_StationId_index', 'Stations')]
+
+#: a seed can always be run again so trade durability for load speed
+session_statements = [
+    'PRAGMA synchronous = OFF',
+    'PRAGMA cache_size = -65536'
+]
+
+#: the seconds a connection waits for another writer
+busy_timeout = 300
+
+scripts = {
+    'tables': 'createTables.sqlite.sql',
+    'indices': 'createIndices.sqlite.sql',
+    'params': 'populateParamsTable.sqlite.sql'
+}
+
+
+class Cursor(sqlite3.Cursor):
+    '''a sqlite cursor that commits and rolls back like a pyodbc cursor'''
+
+    def commit(self):
+        self.connection.commit()
+
+    def rollback(self):
+        self.connection.rollback()
+
+
+def _merge(table, fields, keys):
+    '''Given a table, its ordered fields and the natural key of a row, create the statements
+    to stage rows in a temp table and insert the ones not already in the table'''
+
+    staging = '{}Staging'.format(table)
+    columns = ', '.join(fields)
+    #: IS matches nulls like the charge balance rows without a SampleDate
+    matches = ' AND '.join(['t.[{0}] IS s.[{0}]'.format(key) for key in keys])
+
+    return {
+        'create': 'CREATE TEMP TABLE IF NOT EXISTS {0} AS SELECT {1} FROM {2} WHERE 0'.format(staging, columns, table),
+        'truncate': 'DELETE FROM {}'.format(staging),
+        'stage': 'insert into {} ({}) values ({})'.format(staging, columns, ', '.join(['?'] * len(fields))),
+        'merge': ('insert into {2} ({1}) SELECT {1} FROM {0} s WHERE NOT EXISTS('
+                  'SELECT 1 FROM {2} t WHERE {3})').format(staging, columns, table, matches)
+    }
+
+
+def merge_statements(result_keys):
+    '''Given the fields that identify a result for a program, create the statements for
+    loading stations and results without duplicating existing rows'''
+
+    return {
+        'station_insert': _merge('Stations', list(schema.station.keys()), ['StationId']),
+        'result_insert': _merge('Results', list(schema.result.keys()), result_keys)
+    }
+
+
+def create_cursor(connection_string):
+    '''the connection string is the path to the database file or :memory:'''
+    #: wait for the other worker processes to commit instead of failing as locked
+    c = sqlite3.connect(connection_string, timeout=busy_timeout)
+    return c.cursor(Cursor)
+
+
+def execute_script(script, cursor):
+    '''Given the contents of a sql file, run all of its statements'''
+
+    cursor.executescript(script)
+    cursor.commit()
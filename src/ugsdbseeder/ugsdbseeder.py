@@ -7,12 +7,14 @@ dbseeder.py
 the main entry point module for database ETL
 '''
 
-import pyodbc
 from . import factory
 import logging
 import requests
 from . import sql
+from . import sqlite
 import sys
+from .benchmarking import get_milliseconds
+from .services import Checkpoint, ConnectionPool, HttpCache, HttpClient
 from os.path import join, dirname
 try:
     from . import ugssecrets
@@ -26,6 +28,9 @@ except ImportError:
 
 class Seeder(object):
 
+    #: the file recording the committed work of a seed so it can resume
+    checkpoint_location = '{}.checkpoint.sqlite3'
+
     def __init__(self, logger_name=None):
         if logger_name is None:
             self.logger = logging.getLogger('ugs-db')
@@ -41,157 +46,269 @@ class Seeder(object):
         else:
             self.logger = logging.getLogger(logger_name)
 
+        #: the connection pool for each backend shared by every step of a command
+        self.pools = {}
+
     def _get_db(self, who):
         db = ugssecrets.dev
         if who == 'stage':
             db = ugssecrets.stage
         elif who == 'prod':
             db = ugssecrets.prod
+        elif who == 'local':
+            db = ugssecrets.local
         return db
 
+    def _get_backend(self, db):
+        '''returns the module that writes to the database type in the `backend` key of db'''
+        backends = {
+            'mssql': sql,
+            'sqlite': sqlite
+        }
+
+        name = db.get('backend', 'mssql')
+        if name not in backends:
+            raise Exception('{} is not a supported backend. Use one of {}'.format(name, ', '.join(backends.keys())))
+
+        return backends[name]
+
+    def _get_pool(self, db):
+        '''returns the connection pool for the backend of db'''
+        backend = self._get_backend(db)
+
+        if backend.__name__ not in self.pools:
+            self.pools[backend.__name__] = ConnectionPool(backend.create_cursor, self.logger, backend.session_statements)
+
+        return self.pools[backend.__name__]
+
+    def _close_pools(self):
+        '''close every pooled connection once a command is done or has failed'''
+        pools = self.pools
+
+        self.pools = {}
+
+        for pool in pools.values():
+            pool.close_all()
+
+    def _read_script(self, name):
+        script_dir = dirname(__file__)
+
+        with open(join(script_dir, join('..', '..', 'scripts', name)), 'r') as f:
+            return f.read()
+
     def create_tables(self, who):
         db = self._get_db(who)
+        backend = self._get_backend(db)
 
         self.logger.info('connecting to {} database'.format(who))
 
-        script_dir = dirname(__file__)
-
-        with open(join(script_dir, join('..', '..', 'scripts', 'createTables.sql')), 'r') as f:
-            create_tables_sql = f.read()
-        with open(join(script_dir, join('..', '..', 'scripts', 'createIndices.sql')), 'r') as f:
-            create_indices_sql = f.read()
+        create_tables_sql = self._read_script(backend.scripts['tables'])
+        create_indices_sql = self._read_script(backend.scripts['indices'])
 
-        c = None
-        cursor = None
         try:
-            c = pyodbc.connect(db['connection_string'])
-            cursor = c.cursor()
-            cursor.execute(create_tables_sql)
-            cursor.execute(create_indices_sql)
-            cursor.commit()
-        except Exception as e:
-            raise e
+            cursor = self._get_pool(db).cursor(db['connection_string'])
+            backend.execute_script(create_tables_sql, cursor)
+            backend.execute_script(create_indices_sql, cursor)
         finally:
-            if cursor is not None:
-                del cursor
-            if c is not None:
-                del c
+            self._close_pools()
 
         self.logger.info('done')
 
         return True
 
-    def seed(self, source, file_location, who):
+    def seed(self, source, file_location, who, defer_indices=False, temp_location=None, workers=1, resume=False):
         db = self._get_db(who)
+        backend = self._get_backend(db)
 
         programs = self._parse_source_args(source)
+        pool = self._get_pool(db)
 
-        for program in programs:
-            seederClass = factory.get(program)
+        checkpoint = Checkpoint(self.checkpoint_location.format(who))
+        if not resume:
+            checkpoint.clear()
 
+        indices = []
+        try:
+            if defer_indices:
+                #: resuming matches rows on these indices so they are kept
+                indices = self._disable_indices(db, keep=backend.merge_indices if resume else [])
+
+            for program in programs:
+                seederClass = factory.get(program)
+
+                sql_statements = backend.sql_statements
+                insert_rows = backend.insert_rows
+
+                if resume:
+                    #: rows committed right before a failure may be missing their checkpoint
+                    sql_statements = backend.merge_statements(seederClass.result_keys)
+                    insert_rows = backend.merge_rows
+
+                seeder = seederClass(self.logger,
+                                     db=db,
+                                     update=False,
+                                     source=file_location,
+                                     secrets=ugssecrets.sdwis,
+                                     sql_statements=sql_statements,
+                                     update_rows=backend.update_rows,
+                                     insert_rows=insert_rows,
+                                     cursor_factory=pool.cursor,
+                                     arcpy=arcpy,
+                                     temp_location=temp_location,
+                                     workers=workers,
+                                     checkpoint=checkpoint)
+                seeder.seed()
+        finally:
+            try:
+                #: never leave the tables without their indices
+                if len(indices) > 0:
+                    self._rebuild_indices(db, indices)
+            finally:
+                checkpoint.close()
+                self._close_pools()
+
+    def reseed_samples(self, file_location, who, sample_ids):
+        '''replace the WQP results of the sample ids with their rows from the result csv files'''
+        db = self._get_db(who)
+        backend = self._get_backend(db)
+
+        seederClass = factory.get('WQP')
+
+        try:
             seeder = seederClass(self.logger,
                                  db=db,
                                  update=False,
                                  source=file_location,
-                                 secrets=ugssecrets.sdwis,
-                                 sql_statements=sql.sql_statements,
-                                 update_row=sql.update_row,
-                                 insert_rows=sql.insert_rows,
-                                 cursor_factory=sql.create_cursor,
-                                 arcpy=arcpy)
-            seeder.seed()
+                                 sql_statements=backend.sql_statements,
+                                 update_rows=backend.update_rows,
+                                 insert_rows=backend.insert_rows,
+                                 cursor_factory=self._get_pool(db).cursor)
+
+            sample_sets = seeder.reseed_samples(sample_ids)
+        finally:
+            self._close_pools()
+
+        self.logger.info('reseeded {} of {} samples'.format(sample_sets, len(set(sample_ids))))
 
     def post_process(self, who):
         '''
         Calculate StateCode, CountyCode, Populate Elev, ElevUnit, & ElevMeth only for records that have missing or bad data
         '''
-        stations_fc = 'UGSWaterChemistry.ugswaterchemistry.Stations'
-        stations_identity = 'Stations_identity'
-        epqs_service_url = r'http://nationalmap.gov/epqs/pqs.php'
-
-        arcpy.env.workspace = dirname(__file__)
-        db = r'connection_files\{}.sde'.format(who)
-
-        #: FIPS
-        self.logger.info('creating stations layer')
-        stationsLyr = arcpy.MakeFeatureLayer_management(join(db, stations_fc), 'StationsLyr', 'StateCode IS NULL OR CountyCode IS NULL')
-
-        self.logger.info('identity on counties')
-        stationsIdent = arcpy.Identity_analysis(stationsLyr,
-                                                r'ReferenceData.gdb\US_Counties',
-                                                join('in_memory', stations_identity))
-
-        self.logger.info('joining to layer')
-        arcpy.AddJoin_management(stationsLyr, 'Id', stationsIdent, 'FID_' + stations_fc.split('.')[2])
-
-        self.logger.info('calculating state')
-        arcpy.CalculateField_management(stationsLyr, 'StateCode', '!STATE_FIPS!', 'PYTHON')
-        self.logger.info('calculating county')
-        arcpy.CalculateField_management(stationsLyr, 'CountyCode', '!FIPS!', 'PYTHON')
-
-        self.logger.info('removing join')
-        arcpy.RemoveJoin_management(stationsLyr, stations_identity)
-
-        #: Elevation
-        self.logger.info('looping through points with null elevation values')
-        connection = pyodbc.connect(self._get_db(who)['connection_string'])
-        cursor = connection.cursor()
-        cursor.execute('''
-            SELECT Lon_X, Lat_Y, Id
-            FROM Stations
-            WHERE Elev IS NULL OR Elev = 0 OR Elev > 20000
-        ''')
-        i = 0
-        batch_size = 100
-        rows = cursor.fetchall()
-        total = len(rows)
-        for row in rows:
-            payload = {'x': row.Lon_X, 'y': row.Lat_Y, 'units': 'Meters', 'output': 'json'}
-            r = requests.get(epqs_service_url, params=payload)
-            try:
-                elev = r.json()['USGS_Elevation_Point_Query_Service']['Elevation_Query']['Elevation']
-            except:
-                self.logger.info('error retrieving elevation for Lon: {} & Lat: {}. Skipping'.format(row.Lon_X, row.Lat_Y))
-                continue
+        try:
+            if self._get_backend(self._get_db(who)) is not sql:
+                #: the spatial steps need an sde connection. offline snapshots only get their params
+                self.logger.info('populating params table')
+
+                return self._update_params_table(who)
+
+            stations_fc = 'UGSWaterChemistry.ugswaterchemistry.Stations'
+            stations_identity = 'Stations_identity'
+            epqs_service_url = r'http://nationalmap.gov/epqs/pqs.php'
+
+            arcpy.env.workspace = dirname(__file__)
+            db = r'connection_files\{}.sde'.format(who)
+
+            #: FIPS
+            self.logger.info('creating stations layer')
+            stationsLyr = arcpy.MakeFeatureLayer_management(join(db, stations_fc), 'StationsLyr', 'StateCode IS NULL OR CountyCode IS NULL')
+
+            self.logger.info('identity on counties')
+            stationsIdent = arcpy.Identity_analysis(stationsLyr,
+                                                    r'ReferenceData.gdb\US_Counties',
+                                                    join('in_memory', stations_identity))
 
-            unit = 'meters'
-            method = 'Other'
+            self.logger.info('joining to layer')
+            arcpy.AddJoin_management(stationsLyr, 'Id', stationsIdent, 'FID_' + stations_fc.split('.')[2])
+
+            self.logger.info('calculating state')
+            arcpy.CalculateField_management(stationsLyr, 'StateCode', '!STATE_FIPS!', 'PYTHON')
+            self.logger.info('calculating county')
+            arcpy.CalculateField_management(stationsLyr, 'CountyCode', '!FIPS!', 'PYTHON')
+
+            self.logger.info('removing join')
+            arcpy.RemoveJoin_management(stationsLyr, stations_identity)
+
+            #: Elevation
+            self.logger.info('looping through points with null elevation values')
+            connection = self._get_db(who)
+            cursor = self._get_pool(connection).cursor(connection['connection_string'])
             cursor.execute('''
-                UPDATE Stations set Elev=?, ElevUnit=?, ElevMeth=?
-                WHERE Id=?
-            ''', elev, unit, method, row.Id)
+                SELECT Lon_X, Lat_Y, Id
+                FROM Stations
+                WHERE Elev IS NULL OR Elev = 0 OR Elev > 20000
+            ''')
+            i = 0
+            batch_size = 100
+            rows = cursor.fetchall()
+            total = len(rows)
+            for row in rows:
+                payload = {'x': row.Lon_X, 'y': row.Lat_Y, 'units': 'Meters', 'output': 'json'}
+                r = requests.get(epqs_service_url, params=payload)
+                try:
+                    elev = r.json()['USGS_Elevation_Point_Query_Service']['Elevation_Query']['Elevation']
+                except:
+                    self.logger.info('error retrieving elevation for Lon: {} & Lat: {}. Skipping'.format(row.Lon_X, row.Lat_Y))
+                    continue
+
+                unit = 'meters'
+                method = 'Other'
+                cursor.execute('''
+                    UPDATE Stations set Elev=?, ElevUnit=?, ElevMeth=?
+                    WHERE Id=?
+                ''', elev, unit, method, row.Id)
+
+                i += 1
+                if i % batch_size == 0:
+                    cursor.commit()
+                    self.logger.info('{} out of {} completed ({}%)'.format(i, total, (i/float(total)*100.00)))
 
-            i += 1
-            if i % batch_size == 0:
-                connection.commit()
-                self.logger.info('{} out of {} completed ({}%)'.format(i, total, (i/float(total)*100.00)))
+            cursor.commit()
 
-        self._update_params_table(who)
+            self._update_params_table(who)
+        finally:
+            self._close_pools()
 
-    def update(self, source, who, location, postprocess):
+    def update(self, source, who, location, postprocess, cache_location=None, offline=False):
+        '''cache_location - the optional folder to cache and revalidate the service responses in
+        offline - only replay the cached responses
+        '''
         db = self._get_db(who)
 
-        programs = self._parse_source_args(source)
+        if self._get_backend(db) is not sql:
+            raise Exception('Updates are only supported for sql server. Seed the {} database again instead.'.format(who))
 
-        for program in programs:
-            seederClass = factory.get(program)
+        if offline and not cache_location:
+            raise Exception('Pass in a cache location to update offline.')
 
-            seeder = seederClass(self.logger,
-                                 db=db,
-                                 update=True,
-                                 source=location,
-                                 secrets=ugssecrets.sdwis,
-                                 sql_statements=sql.sql_statements,
-                                 update_row=sql.update_row,
-                                 insert_rows=sql.insert_rows,
-                                 cursor_factory=sql.create_cursor,
-                                 arcpy=arcpy)
-            seeder.update()
+        programs = self._parse_source_args(source)
+        pool = self._get_pool(db)
 
-        self._update_params_table(who)
+        if cache_location:
+            HttpClient.cache = HttpCache(cache_location, offline=offline)
 
-        if postprocess:
-            self.post_process(who)
+        try:
+            for program in programs:
+                seederClass = factory.get(program)
+
+                seeder = seederClass(self.logger,
+                                     db=db,
+                                     update=True,
+                                     source=location,
+                                     secrets=ugssecrets.sdwis,
+                                     sql_statements=sql.merge_statements(seederClass.result_keys),
+                                     update_rows=sql.update_rows,
+                                     insert_rows=sql.merge_rows,
+                                     cursor_factory=pool.cursor,
+                                     arcpy=arcpy)
+                seeder.update()
+
+            self._update_params_table(who)
+
+            if postprocess:
+                self.post_process(who)
+        finally:
+            HttpClient.cache = None
+            self._close_pools()
 
     def _parse_source_args(self, source):
         all_sources = ['WQP', 'SDWIS', 'DOGM', 'UDWR', 'UGS']
@@ -206,18 +323,50 @@ class Seeder(object):
                 return None
 
     def _update_params_table(self, who):
-        script_dir = dirname(__file__)
-        with open(join(script_dir, join('..', '..', 'scripts', 'populateParamsTable.sql')), 'r') as f:
-            sql = f.read()
+        db = self._get_db(who)
+        backend = self._get_backend(db)
 
-        try:
-            c = pyodbc.connect(self._get_db(who)['connection_string'])
-            cursor = c.cursor()
-            cursor.execute(sql)
-        except Exception as e:
-            raise e
-        finally:
-            if cursor:
-                del cursor
-            if c:
-                del c
+        script = self._read_script(backend.scripts['params'])
+
+        backend.execute_script(script, self._get_pool(db).cursor(db['connection_string']))
+
+    def _disable_indices(self, db, keep=[]):
+        '''disable the nonclustered and spatial indices on Stations and Results so they are not
+        maintained for every row while seeding
+        keep: list((index, table)) to leave enabled
+
+        returns a list of (index, table, ...) that were disabled
+        '''
+        backend = self._get_backend(db)
+
+        cursor = self._get_pool(db).cursor(db['connection_string'])
+
+        indices = [tuple(row) for row in cursor.execute(backend.index_statements['enabled']).fetchall()
+                   if tuple(row[:2]) not in keep]
+
+        for index in indices:
+            self.logger.info('disabling {} on {}'.format(index[0], index[1]))
+            cursor.execute(backend.index_statements['disable'].format(*index))
+
+        cursor.commit()
+
+        return indices
+
+    def _rebuild_indices(self, db, indices):
+        '''rebuild the disabled indices once all of the data is loaded
+        indices: list((index, table, ...))
+        '''
+        backend = self._get_backend(db)
+
+        cursor = self._get_pool(db).cursor(db['connection_string'])
+
+        total = get_milliseconds()
+        for index in indices:
+            start = get_milliseconds()
+
+            cursor.execute(backend.index_statements['rebuild'].format(*index))
+            cursor.commit()
+
+            self.logger.info('rebuilt {} on {} in {} ms'.format(index[0], index[1], round(get_milliseconds() - start, 5)))
+
+        self.logger.info('rebuilt {} indices in {} ms'.format(len(indices), round(get_milliseconds() - total, 5)))
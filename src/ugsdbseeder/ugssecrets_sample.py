@@ -10,6 +10,11 @@ prod = {
     'connection_string': 'DRIVER={SQL Server};SERVER=localhost;DATABASE=testdb;UID=me;PWD=pass',
 }
 
+local = {
+    'backend': 'sqlite',
+    'connection_string': 'ugswaterchemistry.sqlite3',
+}
+
 sdwis = {
     'connection_string': 'UID=<username>;PWD=<password>;DBQ=(DESCRIPTION=(ADDRESS_LIST=(ADDRESS=(PROTOCOL=TCP)(HOST=<dns>)(PORT=<port>)))(CONNECT_DATA=(SERVICE_NAME=<name>)));Driver={Oracle in instantclient_19_3}'
 }
@@ -7,6 +7,9 @@ test the ugsdbseeder module
 '''
 
 import unittest
+from mock import Mock, patch
+from nose.tools import raises
+from ugsdbseeder import sql, sqlite
 from ugsdbseeder.ugsdbseeder import Seeder
 
 
@@ -52,3 +55,95 @@ class TestParseSourceArgs(unittest.TestCase):
         self.assertEqual(self.patient._parse_source_args(' wqp, sdwis'), ['WQP', 'SDWIS'])
         self.assertEqual(self.patient._parse_source_args(' wqp , sdwis '), ['WQP', 'SDWIS'])
         self.assertEqual(self.patient._parse_source_args('wqp, sdwis, NOT A SOURCE'), ['WQP', 'SDWIS'])
+
+
+class TestIndices(unittest.TestCase):
+
+    def setUp(self):
+        self.patient = Seeder()
+        self.patient.checkpoint_location = ':memory:'
+        self.db = {'connection_string': ''}
+
+    @patch('ugsdbseeder.sql.create_cursor')
+    def test_disable_indices_returns_disabled_indices(self, create_cursor):
+        cursor = create_cursor.return_value
+        cursor.execute.return_value.fetchall.return_value = [('Param_index', 'Results'), ('FDO_Shape', 'Stations')]
+
+        indices = self.patient._disable_indices(self.db)
+
+        self.assertEqual(indices, [('Param_index', 'Results'), ('FDO_Shape', 'Stations')])
+        #: after the session statements and the enabled index query
+        self.assertEqual(cursor.execute.call_args_list[3][0][0], 'ALTER INDEX [Param_index] ON [Results] DISABLE')
+        self.assertEqual(cursor.execute.call_args_list[4][0][0], 'ALTER INDEX [FDO_Shape] ON [Stations] DISABLE')
+
+    @patch('ugsdbseeder.sql.create_cursor')
+    def test_disable_indices_keeps_indices(self, create_cursor):
+        cursor = create_cursor.return_value
+        cursor.execute.return_value.fetchall.return_value = [('SampleId_index', 'Results'), ('FDO_Shape', 'Stations')]
+
+        indices = self.patient._disable_indices(self.db, keep=[('SampleId_index', 'Results')])
+
+        self.assertEqual(indices, [('FDO_Shape', 'Stations')])
+
+    def test_seed_keeps_the_merge_indices_when_resuming(self):
+        self.patient._disable_indices = Mock(return_value=[])
+
+        with self.assertRaises(Exception):
+            self.patient.seed('WQP', 'not a folder', 'dev', defer_indices=True, resume=True)
+
+        self.patient._disable_indices.assert_called_once_with(self.patient._get_db('dev'), keep=sql.merge_indices)
+
+    @patch('ugsdbseeder.sql.create_cursor')
+    def test_rebuild_indices_rebuilds_each_index(self, create_cursor):
+        cursor = create_cursor.return_value
+
+        self.patient._rebuild_indices(self.db, [('Param_index', 'Results'), ('FDO_Shape', 'Stations')])
+
+        self.assertEqual([c[0][0] for c in cursor.execute.call_args_list],
+                         ['SET NOCOUNT ON', 'SET XACT_ABORT ON',
+                          'ALTER INDEX [Param_index] ON [Results] REBUILD', 'ALTER INDEX [FDO_Shape] ON [Stations] REBUILD'])
+
+    def test_seed_rebuilds_indices_when_a_program_fails(self):
+        self.patient._disable_indices = Mock(return_value=[('Param_index', 'Results')])
+        self.patient._rebuild_indices = Mock()
+
+        with self.assertRaises(Exception):
+            self.patient.seed('WQP', 'not a folder', 'dev', defer_indices=True)
+
+        self.patient._rebuild_indices.assert_called_once_with(self.patient._get_db('dev'), [('Param_index', 'Results')])
+
+    @patch('ugsdbseeder.sql.create_cursor')
+    def test_seed_closes_connections_when_a_program_fails(self, create_cursor):
+        with self.assertRaises(Exception):
+            self.patient.seed('WQP', 'not a folder', 'dev', defer_indices=True)
+
+        create_cursor.assert_called_once_with(self.patient._get_db('dev')['connection_string'])
+        create_cursor.return_value.connection.close.assert_called_once_with()
+        self.assertEqual(self.patient.pools, {})
+
+    @patch('ugsdbseeder.ugsdbseeder.Checkpoint')
+    def test_seed_starts_over_unless_resuming(self, checkpoint):
+        for resume in [False, True]:
+            with self.assertRaises(Exception):
+                self.patient.seed('WQP', 'not a folder', 'dev', resume=resume)
+
+        checkpoint.assert_called_with(':memory:')
+        checkpoint.return_value.clear.assert_called_once_with()
+        self.assertEqual(checkpoint.return_value.close.call_count, 2)
+
+
+class TestBackends(unittest.TestCase):
+
+    def setUp(self):
+        self.patient = Seeder()
+
+    def test_sql_server_is_the_default_backend(self):
+        self.assertEqual(self.patient._get_backend({'connection_string': ''}), sql)
+        self.assertEqual(self.patient._get_backend({'backend': 'mssql', 'connection_string': ''}), sql)
+
+    def test_gets_sqlite_backend(self):
+        self.assertEqual(self.patient._get_backend({'backend': 'sqlite', 'connection_string': ''}), sqlite)
+
+    @raises(Exception)
+    def test_unknown_backend_raises(self):
+        self.patient._get_backend({'backend': 'oracle', 'connection_string': ''})
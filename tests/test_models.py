@@ -136,3 +136,53 @@ class TestConcentrationModel(unittest.TestCase):
     def tearDown(self):
         self.patient = None
         del self.patient
+
+
+class TestRecord(unittest.TestCase):
+
+    def test_values_are_in_schema_order(self):
+        patient = models.Result()
+        patient['StationId'] = 'a'
+        patient['AnalysisDate'] = 'b'
+
+        self.assertEqual(len(patient.values()), len(models.Result.fields))
+        self.assertEqual(patient.values()[0], 'b')
+        self.assertEqual(patient.values()[-3], 'a')
+        self.assertEqual(patient.keys(), models.Result.fields)
+
+    def test_schema_fields_are_always_present(self):
+        patient = models.Result()
+
+        self.assertIn('Param', patient)
+        self.assertIsNone(patient['Param'])
+        self.assertIsNone(patient.get('Param', 'default'))
+
+    def test_missing_keys_raise(self):
+        patient = models.Result()
+
+        self.assertNotIn('not a field', patient)
+        self.assertEqual(patient.get('not a field', 'default'), 'default')
+        with self.assertRaises(KeyError):
+            patient['not a field']
+
+    def test_extras(self):
+        patient = models.Station()
+        patient['Shape@XY'] = (1, 2)
+
+        self.assertIn('Shape@XY', patient)
+        self.assertEqual(patient['Shape@XY'], (1, 2))
+        self.assertEqual(len(patient.values()), len(models.Station.fields))
+
+        del patient['Shape@XY']
+
+        self.assertNotIn('Shape@XY', patient)
+
+    def test_equals_dictionaries(self):
+        patient = models.Result()
+        patient['Param'] = 'calcium'
+
+        expected = dict.fromkeys(models.Result.fields)
+        expected['Param'] = 'calcium'
+
+        self.assertEqual(patient, expected)
+        self.assertNotEqual(patient, {'Param': 'calcium'})
@@ -8,19 +8,50 @@ test the programs module
 '''
 
 import unittest
-from ugsdbseeder.programs import WqpProgram, DogmProgram
-from ugsdbseeder import sql, arcpy_mock
+from ugsdbseeder.programs import WqpProgram, DogmProgram, SdwisProgram
+from ugsdbseeder import schema, sql, sqlite, arcpy_mock
+from ugsdbseeder.services import Checkpoint, ConnectionPool, HttpCache, HttpClient
 from collections import OrderedDict
-from csv import reader as csvreader
-from mock import Mock
+from csv import reader as csvreader, writer as csvwriter
+from datetime import date, datetime, time
+from mock import MagicMock, Mock, patch
 from nose.tools import raises
-from os.path import join, basename
+from os import listdir
+from os.path import join, basename, exists
+from shutil import copytree, rmtree
+from tempfile import mkdtemp
 import logging
 
 
 logger = logging.getLogger('test')
 
 
+def seed_sqlite(database, source=join('tests', 'data'), **kwargs):
+    '''seed the wqp test data into a sqlite database and return the sorted result rows without their ids'''
+    db = {'connection_string': database}
+    pool = ConnectionPool(sqlite.create_cursor, logger)
+
+    if not exists(database):
+        with open(join('scripts', sqlite.scripts['tables'])) as script:
+            sqlite.execute_script(script.read(), pool.cursor(db['connection_string']))
+
+    program = WqpProgram(logger,
+                         db=db,
+                         update=False,
+                         source=source,
+                         sql_statements=sqlite.sql_statements,
+                         update_rows=sqlite.update_rows,
+                         insert_rows=sqlite.insert_rows,
+                         cursor_factory=pool.cursor,
+                         **kwargs)
+    program.seed()
+
+    results = pool.cursor(db['connection_string']).execute('SELECT * FROM Results').fetchall()
+    pool.close_all()
+
+    return sorted((result[1:] for result in results), key=repr)
+
+
 class TestWqpProgram(unittest.TestCase):
     def setUp(self):
         self.test_get_files_folder = join('tests', 'data', 'WQP', 'get_files')
@@ -62,13 +93,12 @@ class TestWqpProgram(unittest.TestCase):
     def test_folder_without_required_child_folders_throws(self):
         self.patient = WqpProgram(db=None, file_location=join('tests', 'data', 'WQP', 'incorrect_child_structure'))
 
-    def test_get_samples_for_id_returns_correct_list(self):
-        self.patient.sample_id_field = 'id'
+    def test_get_sample_sets_returns_correct_list(self):
         config = OrderedDict([('a', 'eh'), ('b', 'bee'), ('c', 'sea')])
-        sample_id_set = (1,)
         file_path = join('tests', 'data', 'WQP', 'get_sample_ids.csv')
 
-        rows = self.patient._get_samples_for_id(sample_id_set, file_path, config=config)
+        rows = [rows for rows in self.patient._get_sample_sets(file_path, config=config)
+                if rows[0]['ActivityIdentifier'] == '1'][0]
 
         self.assertEqual(len(rows), 2)
         self.assertCountEqual([
@@ -76,18 +106,189 @@ class TestWqpProgram(unittest.TestCase):
                               {'eh': 'a2', 'bee': 'b2', 'sea': 'c2', 'ActivityIdentifier': '1'}
                               ], rows)
 
-    def test_get_distict_samples(self):
-        self.patient.sample_id_field = 'id'
-        rows = self.patient._get_distinct_sample_ids_from(join('tests', 'data', 'WQP', 'distinct_sampleids.csv'))
+    def test_get_sample_sets_groups_by_sample_id(self):
+        sample_sets = list(self.patient._get_sample_sets(join('tests', 'data', 'WQP', 'distinct_sampleids.csv')))
 
-        self.assertEqual(len(rows), 2)
-        self.assertCountEqual([('1',), ('2',)], rows)
+        self.assertEqual(len(sample_sets), 2)
+        self.assertCountEqual(['1', '2'], [rows[0]['SampleId'] for rows in sample_sets])
 
     def test_get_wqx_duplicate_ids(self):
         ids = self.patient._get_wqx_duplicate_ids(join('tests', 'data', 'WQP', 'wqxids.csv'))
 
         self.assertCountEqual(set(['UTAHDWQ-4904410', 'UTAHDWQ-4904640', 'UTAHDWQ-4904610']), ids)
 
+    def test_temp_database_is_unique_and_removed(self):
+        temp_location = mkdtemp()
+
+        try:
+            self.patient.temp_location = temp_location
+
+            with self.patient._temp_database() as first, self.patient._temp_database() as second:
+                self.assertNotEqual(first, second)
+                self.assertTrue(first.startswith(temp_location))
+
+            ids = self.patient._get_wqx_duplicate_ids(join('tests', 'data', 'WQP', 'wqxids.csv'))
+
+            self.assertEqual(len(ids), 3)
+            self.assertEqual(listdir(temp_location), [])
+        finally:
+            rmtree(temp_location)
+
+    def test_temp_database_in_memory(self):
+        self.patient.temp_location = ':memory:'
+
+        with self.patient._temp_database() as temp_database:
+            self.assertEqual(temp_database, ':memory:')
+
+        ids = self.patient._get_wqx_duplicate_ids(join('tests', 'data', 'WQP', 'wqxids.csv'))
+
+        self.assertEqual(len(ids), 3)
+        self.assertIsNone(self.patient._get_temp_folder())
+
+    def test_sample_set_shards_partition_the_file(self):
+        file_path = join('tests', 'data', 'WQP', 'Results', 'sample_chemistry.csv')
+
+        def sample_ids(shard=None):
+            return [rows[0]['SampleId'] for rows in self.patient._get_sample_sets(file_path, shard=shard)]
+
+        shards = [sample_ids((index, 3)) for index in range(3)]
+
+        self.assertCountEqual([sample_id for shard in shards for sample_id in shard], sample_ids())
+        self.assertEqual(len(set(shards[0]) & set(shards[1])), 0)
+
+    def test_seed_with_workers_matches_one_process(self):
+        temp_location = mkdtemp()
+
+        try:
+            serial = seed_sqlite(join(temp_location, 'serial.sqlite3'))
+
+            self.assertEqual(len(serial), 100)
+            self.assertEqual(seed_sqlite(join(temp_location, 'parallel.sqlite3'), workers=4), serial)
+        finally:
+            rmtree(temp_location)
+
+    def test_seed_records_and_skips_checkpoints(self):
+        temp_location = mkdtemp()
+
+        try:
+            checkpoint = Checkpoint(join(temp_location, 'checkpoint.sqlite3'))
+            database = join(temp_location, 'seed.sqlite3')
+
+            results = seed_sqlite(database, checkpoint=checkpoint)
+
+            self.assertTrue(checkpoint.is_complete('WQP', 'results/sample_chemistry.csv'))
+            self.assertEqual(len(checkpoint.get_completed_samples('WQP', 'sample_chemistry2.csv')), 8)
+
+            #: resuming a finished seed loads nothing
+            self.assertEqual(seed_sqlite(database, checkpoint=checkpoint), results)
+            checkpoint.close()
+        finally:
+            rmtree(temp_location)
+
+    def test_seed_skips_checkpointed_samples(self):
+        temp_location = mkdtemp()
+
+        try:
+            checkpoint = Checkpoint(join(temp_location, 'checkpoint.sqlite3'))
+            checkpoint.complete_samples('WQP', 'sample_chemistry2.csv', ['952307_WQX-D56163-1'])
+
+            results = seed_sqlite(join(temp_location, 'seed.sqlite3'), checkpoint=checkpoint)
+            checkpoint.close()
+
+            sample_id = list(schema.result.keys()).index('SampleId') - 1
+
+            self.assertEqual(len(results), 95)
+            self.assertNotIn('952307_WQX-D56163-1', [result[sample_id] for result in results])
+        finally:
+            rmtree(temp_location)
+
+    def test_reseed_samples_replaces_their_results(self):
+        temp_location = mkdtemp()
+
+        try:
+            database = join(temp_location, 'seed.sqlite3')
+            db = {'connection_string': database}
+
+            #: the sidecar indexes are written next to the result files
+            copytree(join('tests', 'data', 'WQP'), join(temp_location, 'WQP'))
+
+            #: add a sample with enough major ions for charge balance rows
+            csv_file = join(temp_location, 'WQP', 'Results', 'sample_chemistry.csv')
+            with open(csv_file, 'r') as f:
+                header = next(csvreader(f))
+
+            with open(csv_file, 'a', newline='') as f:
+                for chemical, value in [('Calcium', '40'), ('Magnesium', '12'), ('Sodium', '20'), ('Chloride', '30'),
+                                        ('Sulfate', '50'), ('Bicarbonate', '150')]:
+                    row = dict.fromkeys(header, '')
+                    row.update({'ActivityIdentifier': 'balanced', 'MonitoringLocationIdentifier': 'UTAHDWQ-1',
+                                'ActivityStartDate': '2015-01-02', 'CharacteristicName': chemical,
+                                'ResultMeasureValue': value, 'ResultMeasure/MeasureUnitCode': 'mg/l'})
+                    csvwriter(f).writerow([row[column] for column in header])
+
+            results = seed_sqlite(database, source=temp_location)
+            balances = 'SELECT count(*) FROM Results WHERE SampleId = \'balanced\' AND Param = \'Charge Balance\''
+
+            pool = ConnectionPool(sqlite.create_cursor, logger)
+            cursor = pool.cursor(database)
+            self.assertEqual(cursor.execute(balances).fetchone()[0], 1)
+            cursor.execute('DELETE FROM Results WHERE SampleId = ?', ('952307_WQX-D56163-1',))
+            cursor.execute('UPDATE Results SET ResultValue = -1 WHERE SampleId = ?', ('1119USBR_WQX-14-A391',))
+            cursor.commit()
+
+            patient = WqpProgram(logger,
+                                 db=db,
+                                 update=False,
+                                 source=temp_location,
+                                 sql_statements=sqlite.sql_statements,
+                                 update_rows=sqlite.update_rows,
+                                 insert_rows=sqlite.insert_rows,
+                                 cursor_factory=pool.cursor)
+
+            sample_sets = patient.reseed_samples(['952307_WQX-D56163-1', '1119USBR_WQX-14-A391', 'balanced', 'missing'])
+            self.assertEqual(cursor.execute(balances).fetchone()[0], 1)
+            reseeded = sorted((result[1:] for result in cursor.execute('SELECT * FROM Results').fetchall()), key=repr)
+            pool.close_all()
+
+            self.assertEqual(sample_sets, 3)
+            self.assertEqual(reseeded, results)
+            self.assertTrue(exists(join(temp_location, 'WQP', 'Results', 'sample_chemistry.csv.index.sqlite3')))
+        finally:
+            rmtree(temp_location)
+
+    def test_reseed_samples_keeps_their_results_when_the_insert_fails(self):
+        temp_location = mkdtemp()
+
+        def insert_rows(rows, statement, cursor, batch_size=5000):
+            #: the last row is malformed so the batch fails after the first rows are written
+            sqlite.insert_rows(rows + [[None]], statement, cursor, batch_size=batch_size + 1)
+
+        try:
+            database = join(temp_location, 'seed.sqlite3')
+            copytree(join('tests', 'data', 'WQP'), join(temp_location, 'WQP'))
+
+            results = seed_sqlite(database, source=temp_location)
+
+            pool = ConnectionPool(sqlite.create_cursor, logger)
+            patient = WqpProgram(logger,
+                                 db={'connection_string': database},
+                                 update=False,
+                                 source=temp_location,
+                                 sql_statements=sqlite.sql_statements,
+                                 update_rows=sqlite.update_rows,
+                                 insert_rows=insert_rows,
+                                 cursor_factory=pool.cursor)
+
+            with self.assertRaises(Exception):
+                patient.reseed_samples(['952307_WQX-D56163-1', '1119USBR_WQX-14-A391'])
+
+            kept = pool.cursor(database).execute('SELECT * FROM Results').fetchall()
+            pool.close_all()
+
+            self.assertEqual(sorted((result[1:] for result in kept), key=repr), results)
+        finally:
+            rmtree(temp_location)
+
     def test_wqx_duplicates_for_update(self):
         rows = [{'StationId': 'UTAHDWQ_WQX-4904410'},
                 {'StationId': 'UTAHDWQ_WQX-4904610'},
@@ -101,6 +302,8 @@ class TestWqpProgram(unittest.TestCase):
         self.maxDiff = None
         insert_mock = Mock()
         cursor_mock = Mock()
+        #: no stations are in the database yet
+        cursor_mock.return_value.execute.return_value.fetchall.return_value = []
         db = {
             'connection_string': ''
         }
@@ -109,12 +312,9 @@ class TestWqpProgram(unittest.TestCase):
                                   source=join('tests', 'data', 'WQP', 'insert'),
                                   update=False,
                                   insert_rows=insert_mock,
-                                  update_row=sql.update_row,
+                                  update_rows=sql.update_rows,
                                   cursor_factory=cursor_mock)
 
-        #: prevent sql error for missing table
-        self.patient._add_sample_index = lambda x: None
-
         self.patient.seed()
 
         self.assertEqual(insert_mock.call_count, 2)
@@ -124,86 +324,90 @@ class TestWqpProgram(unittest.TestCase):
 
         station_row = station_call[0][0][0]
 
-        self.assertEqual(station_row, [
-            "'orgid'",
-            "'orgname'",
-            "'stationid'",
-            "'stationname'",
-            "'stationtype'",
-            "'stationcomment'",
-            "'huc8'",
-            "-114.0",  #: Longitude
-            "42.0",  #: latitude
-            "0.0",  #: HorAcc
-            "'hunit'",  #: HorAccUnit
-            "'horcollmeth'",
-            "'horref'",
-            "1.0",  #: Elev
-            "'elevunit'",
-            "2.0",
-            "'euni'",
-            "'elevmeth'",
-            "'elevref'",
-            "3",  #: StateCode
-            "4",  #: CountyCode
-            "'aquifer'",
-            "'fmtype'",
-            "'aquifertype'",
-            "Cast('2011-01-01' as date)",
-            "5.0",  #: depth
-            "'dunit'",
-            "6.0",  #: HoleDepth
-            "'hdunit'",
-            'Null',  #: demELEVm
-            "'WQP'",  #: DataSource
-            'Null',  #: WIN
-            "geometry::STGeomFromText('POINT (251535.07928578724 4654130.8912068475)', 26912)"
+        #: the projected shape is compared with a tolerance below
+        self.assertEqual(station_row[:-1], [
+            'orgid',
+            'orgname',
+            'stationid',
+            'stationname',
+            'stationtype',
+            'stationcomment',
+            'huc8',
+            -114.0,  #: Longitude
+            42.0,  #: latitude
+            0.0,  #: HorAcc
+            'hunit',  #: HorAccUnit
+            'horcollmeth',
+            'horref',
+            1.0,  #: Elev
+            'elevunit',
+            2.0,
+            'euni',
+            'elevmeth',
+            'elevref',
+            3,  #: StateCode
+            4,  #: CountyCode
+            'aquifer',
+            'fmtype',
+            'aquifertype',
+            datetime(2011, 1, 1),
+            5.0,  #: depth
+            'dunit',
+            6.0,  #: HoleDepth
+            'hdunit',
+            None,  #: demELEVm
+            'WQP',  #: DataSource
+            None,  #: WIN
         ])
 
+        x, y = station_row[-1][len('POINT ('):-1].split()
+        self.assertAlmostEqual(float(x), 251535.07928578724, places=6)
+        self.assertAlmostEqual(float(y), 4654130.8912068475, places=6)
+
         result_rows = result_call[0][0][0]
         self.assertEqual(result_rows, [
-            "Cast('2011-01-01' as date)",  #: analysis date
-            "'analythmeth'",
-            "'analythmethid'",
-            'Null',  #: AutoQual
-            'Null',  #: CAS_Reg
-            'Null',  #: Chrg
-            "'WQP'",  #: DataSource
-            "'detectcondition'",
-            'Null',  #: IdNum
-            "'labcomments'",
-            "'labname'",
-            'Null',  #: Lat
-            "'limittype'",
-            'Null',  #: Long
-            '0.0',  #: MDL
-            "'mdlunit'",
-            "'methoddescript'",
-            "'origid'",
-            "'orgname'",
-            "'param'",
-            'Null',  #: ParamGroup
-            "'projectid'",
-            "'qualcode'",
-            "'resultcomment'",
-            "'resultstatus'",
-            '1.0',  #: ResultValue
-            "'sampcomment'",
-            '2.0',  #: SampDepth
-            "'sampdepthref'",
-            "'sampdepthu'",
-            "'sampequip'",
-            "'sampfrac'",
-            "Cast('2011-01-02' as date)",  #: activity date
-            "'12:00:00'",  #: activity Time
-            "'sampleid'",
-            "'sampmedia'",
-            "'sampmeth'",
-            "'sampmethname'",
-            "'samptype'",
-            "'stationid'",
-            "'unit'",
-            "'usgspcode'"
+            datetime(2011, 1, 1),  #: analysis date
+            'analythmeth',
+            'analythmethid',
+            None,  #: AutoQual
+            None,  #: CAS_Reg
+            None,  #: Chrg
+            'WQP',  #: DataSource
+            'detectcondition',
+            None,  #: IdNum
+            'labcomments',
+            'labname',
+            42.0,  #: Lat from the station
+            'limittype',
+            -114.0,  #: Long from the station
+            0.0,  #: MDL
+            'mdlunit',
+            'methoddescript',
+            'origid',
+            'orgname',
+            'param',
+            None,  #: ParamGroup
+            'projectid',
+            'qualcode',
+            'resultcomment',
+            'resultstatus',
+            1.0,  #: ResultValue
+            'sampcomment',
+            2.0,  #: SampDepth
+            'sampdepthref',
+            'sampdepthu',
+            'sampequip',
+            'sampfrac',
+            datetime(2011, 1, 2),  #: activity date
+            time(12, 0, 0),  #: activity Time
+            'sampleid',
+            'sampmedia',
+            'sampmeth',
+            'sampmethname',
+            'samptype',
+            'stationid',
+            'unit',
+            'usgspcode'
         ])
 
     @raises(Exception)
@@ -216,6 +420,137 @@ class TestWqpProgram(unittest.TestCase):
         self.assertEqual(self.patient._format_url(template, 'Result', '01/01/1999', today='01/01/2000'),
                          'type=Result&lastupdated=01-01-1999&today=01-01-2000')
 
+    def test_get_date_windows(self):
+        self.patient.update_window_days = 10
+
+        self.assertEqual(self.patient._get_date_windows('01/01/2000', today='01/25/2000'),
+                         [(date(2000, 1, 1), date(2000, 1, 10)),
+                          (date(2000, 1, 11), date(2000, 1, 20)),
+                          (date(2000, 1, 21), date(2000, 1, 25))])
+        self.assertEqual(self.patient._get_date_windows('01/01/2000', today='01/01/2000'),
+                         [(date(2000, 1, 1), date(2000, 1, 1))])
+
+    def test_fetch_results_removes_duplicates_across_windows(self):
+        responses = {
+            '01-01-2000': [['ActivityIdentifier', 'ResultMeasureValue'], ['1', 'a'], ['2', 'b']],
+            '01-11-2000': [['ActivityIdentifier', 'ResultMeasureValue'], ['2', 'b'], ['3', 'c']],
+            '01-21-2000': []
+        }
+        self.patient.update_window_days = 10
+        self.patient.tile_grid = (1, 1)
+        self.patient.wqp_url = '{}|{}|{}'
+
+        with patch('ugsdbseeder.programs.HttpClient.get_count', return_value=10), \
+                patch('ugsdbseeder.programs.HttpClient.get_csv') as get_csv:
+            get_csv.side_effect = lambda url, logger, **kwargs: iter(responses[url.split('|')[1]])
+
+            new_results = self.patient._fetch_results('01/01/2000', today='01/25/2000')
+
+        self.assertEqual(get_csv.call_count, 3)
+        self.assertEqual(sorted(new_results.keys()), ['1', '2', '3'])
+        self.assertEqual(new_results['2'], [{'SampleId': '2', 'ResultValue': 'b'}])
+
+    def test_format_url_with_bbox(self):
+        template = 'type={}&lo={}&hi={}&bBox={}'
+
+        self.assertEqual(self.patient._format_url(template, 'Result', '01/01/1999', today='01/01/2000',
+                                                  bbox=(-115, 35.5, -111.5, 39)),
+                         'type=Result&lo=01-01-1999&hi=01-01-2000&bBox=-115%2C35.5%2C-111.5%2C39')
+
+        url = self.patient._format_url(self.patient.wqp_url, 'Result', '01/01/1999')
+        self.assertIn('bBox=-115%2C35.5%2C-108%2C42.5', url)
+
+    def test_split_bbox(self):
+        self.assertEqual(self.patient._split_bbox((0, 0, 4, 2), 2, 1), [(0, 0, 2, 2), (2, 0, 4, 2)])
+
+    def test_plan_tiles_splits_busy_tiles_and_skips_empty_ones(self):
+        counts = {'0.0%2C0.0%2C2.0%2C2.0': 0, '2.0%2C0.0%2C4.0%2C2.0': 500}
+        self.patient.bbox = (0, 0, 4, 2)
+        self.patient.tile_grid = (2, 1)
+        self.patient.tile_max_results = 100
+        self.patient.wqp_url = '{}|{}|{}|{}'
+
+        with patch('ugsdbseeder.programs.HttpClient.get_count') as get_count:
+            get_count.side_effect = lambda url: counts.get(url.split('|')[3], 50)
+
+            self.assertEqual(self.patient._plan_tiles('01/01/2000', '01/02/2000'),
+                             [(2.0, 0.0, 3.0, 1.0), (3.0, 0.0, 4.0, 1.0), (2.0, 1.0, 3.0, 2.0), (3.0, 1.0, 4.0, 2.0)])
+
+            self.patient.tile_max_depth = 0
+
+            self.assertEqual(self.patient._plan_tiles('01/01/2000', '01/02/2000'), [(2.0, 0.0, 4.0, 2.0)])
+
+    def test_update_offline_replays_the_tile_plan(self):
+        temp_location = mkdtemp()
+
+        def respond(url, **kwargs):
+            response = MagicMock(status_code=200, encoding='utf-8', headers={})
+            response.__enter__.return_value = response
+            #: one sample in each tile
+            response.iter_content.return_value = iter([
+                'ActivityIdentifier,ResultMeasureValue\n{},1\n'.format(url.split('bBox=')[1][:10]).encode('utf-8')])
+
+            return response
+
+        try:
+            HttpClient.cache = HttpCache(join(temp_location, 'cache'))
+            self.patient.update_window_days = 100000
+            self.patient.tile_grid = (2, 1)
+            self.patient._get_most_recent_result_date = Mock(return_value='2000-01-01')
+            self.patient._remove_existing_results = lambda results: results
+            self.patient._find_new_station_ids = Mock(return_value=[])
+            self.patient._seed_sample_sets = Mock()
+            self.patient._flush_results = Mock()
+
+            with patch('ugsdbseeder.services.head', return_value=Mock(headers={'total-result-count': '10'})), \
+                    patch('ugsdbseeder.services.get', side_effect=respond):
+                self.patient.update()
+
+            online = self.patient._seed_sample_sets.call_args[0][0]
+            HttpClient.cache.offline = True
+
+            with patch('ugsdbseeder.services.head', side_effect=Exception('offline')) as head, \
+                    patch('ugsdbseeder.services.get', side_effect=Exception('offline')) as get:
+                self.patient.update()
+
+            self.assertFalse(head.called)
+            self.assertFalse(get.called)
+            self.assertEqual(len(online), 2)
+            self.assertCountEqual(self.patient._seed_sample_sets.call_args[0][0], online)
+        finally:
+            HttpClient.cache = None
+            rmtree(temp_location)
+
+    def test_get_station_urls_stay_under_the_url_length(self):
+        self.patient.station_url = 'siteid={}'
+        self.patient.station_url_length = 20
+
+        self.assertEqual(self.patient._get_station_urls(['UT-1', 'UT-2', 'UT 3', 'UTAHDWQ_WQX-4900440']),
+                         ['siteid=UT-1%3BUT-2', 'siteid=UT%203', 'siteid=UTAHDWQ_WQX-4900440'])
+
+    def test_fetch_stations_seeds_each_batch(self):
+        responses = {
+            'a': [['MonitoringLocationIdentifier', 'LatitudeMeasure'], ['a', '1'], ['c', '3']],
+            'b_WQX-1': [['MonitoringLocationIdentifier', 'LatitudeMeasure'], ['b_WQX-1', '2']],
+            'b-1': []
+        }
+        self.patient.station_url = '{}'
+        self.patient.station_url_length = 1
+        self.patient._seed_stations = Mock()
+
+        with patch('ugsdbseeder.programs.HttpClient.get_csv') as get_csv:
+            get_csv.side_effect = lambda url, logger, **kwargs: iter(responses[url])
+
+            found = self.patient._fetch_stations(['b_WQX-1', 'a', 'b-1'])
+
+        self.assertEqual(found, 2)
+        self.assertEqual(get_csv.call_count, 3)
+        self.assertEqual(self.patient._seed_stations.call_count, 2)
+        self.assertCountEqual([call[1]['wqx'] for call in self.patient._seed_stations.call_args_list],
+                              [set(['b-1']), set(['b-1'])])
+        self.assertCountEqual([station['StationId'] for call in self.patient._seed_stations.call_args_list
+                               for station in call[0][0]], ['a', 'b_WQX-1'])
+
     def test_group_sample_ids(self):
         sample_response = join('tests', 'data', 'WQP', 'webservice.csv.as.txt')
         with open(sample_response, 'r') as f:
@@ -331,12 +666,11 @@ class TestWqpProgram(unittest.TestCase):
 
         self.assertCountEqual(list(new_results.keys()), ['sampleid1', 'sampleid2'])
 
-    def test_get_samples_for_id_returns_correct_list_when_quoted(self):
-        self.patient.sample_id_field = 'id'
-        sample_id_set = ('nwisnv.01.00901373',)
+    def test_get_sample_sets_returns_correct_list_when_quoted(self):
         file_path = join('tests', 'data', 'WQP', 'quotes_in_csv.csv')
 
-        rows = self.patient._get_samples_for_id(sample_id_set, file_path, config=self.patient.result_config)
+        rows = [rows for rows in self.patient._get_sample_sets(file_path, config=self.patient.result_config)
+                if rows[0]['SampleId'] == 'nwisnv.01.00901373'][0]
 
         self.assertEqual(len(rows), 1)
 
@@ -351,6 +685,58 @@ class TestWqpProgram(unittest.TestCase):
         self.assertEqual(result['Param'], 'Specific conductance')
 
 
+class TestSdwisProgram(unittest.TestCase):
+    def setUp(self):
+        with patch('ugsdbseeder.programs.create_odbc_cursor'):
+            self.patient = SdwisProgram(logger,
+                                        db={'connection_string': 'db'},
+                                        update=True,
+                                        source=None,
+                                        secrets={'connection_string': 'sdwis'},
+                                        cursor_factory=Mock())
+
+    def test_second_source_cursor_reads_sdwis_over_odbc(self):
+        with patch('ugsdbseeder.programs.create_odbc_cursor') as create_odbc_cursor:
+            self.patient._get_samples_for_id(('1',))
+            self.patient._get_samples_for_id(('2',))
+
+        create_odbc_cursor.assert_called_once_with('sdwis')
+        self.assertFalse(self.patient.cursor_factory.called)
+
+    def test_second_source_cursor_ignores_the_sqlite_backend(self):
+        temp_location = mkdtemp()
+        connection_string = join(temp_location, 'sdwis')
+
+        try:
+            with patch('ugsdbseeder.programs.create_odbc_cursor'):
+                patient = SdwisProgram(logger,
+                                       db={'connection_string': join(temp_location, 'seed.sqlite3')},
+                                       update=False,
+                                       source=None,
+                                       secrets={'connection_string': connection_string},
+                                       cursor_factory=sqlite.create_cursor)
+
+                patient._get_samples_for_id(('1',))
+
+            self.assertFalse(exists(connection_string))
+        finally:
+            rmtree(temp_location)
+
+    def test_remove_existing_results(self):
+        results = {'2015-01-02{-}1{-}Calcium': [], '2015-01-02{-}2{-}Calcium': [], '2015-01-03{-}1{-}Calcium': []}
+
+        mock = Mock()
+        mock.return_value = set([(datetime(2015, 1, 2), '1', 'Calcium'), ('2015-01-03', '1', 'Calcium')])
+
+        self.patient._get_unique_sample_ids = mock
+
+        new_results = self.patient._remove_existing_results(results)
+
+        self.assertCountEqual(list(new_results.keys()), ['2015-01-02{-}1{-}Calcium', '2015-01-03{-}1{-}Calcium'])
+        self.assertCountEqual(mock.call_args[0][0], [('2015-01-02', '1', 'Calcium'), ('2015-01-02', '2', 'Calcium'),
+                                                     ('2015-01-03', '1', 'Calcium')])
+
+
 class TestDogmProgram(unittest.TestCase):
     def setUp(self):
         self.test_get_files_folder = join('tests', 'data')
@@ -0,0 +1,39 @@
+#!usr/bin/env python
+# -*- coding: utf-8 -*-
+
+'''
+test_querycsv.py
+----------------------------------
+test the csv import
+'''
+
+import sqlite3
+import unittest
+from os.path import join
+from ugsdbseeder import querycsv
+
+
+class TestCsvToSqlDb(unittest.TestCase):
+
+    def setUp(self):
+        self.db = sqlite3.connect(':memory:')
+        querycsv.imported_filetimes(self.db)
+
+    def tearDown(self):
+        self.db.close()
+
+    def test_imports_every_row(self):
+        querycsv.csv_to_sqldb(self.db, join('tests', 'data', 'WQP', 'get_sample_ids.csv'), 'samples')
+
+        self.assertEqual(self.db.execute('select * from samples').fetchall(),
+                         [('a1', 'b1', 'c1', '1'), ('a2', 'b2', 'c2', '1'), ('no', 'nope', 'no', '2')])
+
+    def test_imports_in_chunks(self):
+        querycsv.bulk_load_chunk_size = 1
+
+        try:
+            querycsv.csv_to_sqldb(self.db, join('tests', 'data', 'WQP', 'get_sample_ids.csv'), 'samples')
+        finally:
+            querycsv.bulk_load_chunk_size = 10000
+
+        self.assertEqual(self.db.execute('select count(*) from samples').fetchone()[0], 3)
@@ -9,9 +9,25 @@ test the services module
 
 import unittest
 from collections import OrderedDict
-from ugsdbseeder.services import Caster, Reproject, ChargeBalancer, Normalizer
-from ugsdbseeder.models import Concentration
+from csv import reader as csvreader
+from ugsdbseeder.services import (Caster, Reproject, ChargeBalancer, Normalizer, RowBuffer, ConnectionPool,
+                                  StationRegistry, CsvGrouper, CsvIndex, Checkpoint, HttpCache, HttpClient)
+from ugsdbseeder.services import _fast_parse, _parse_datetime
+from ugsdbseeder.models import Concentration, Result, Station
 import datetime
+import pickle
+from mock import MagicMock, Mock, patch
+from io import BytesIO
+from nose.tools import raises
+from os import stat
+from os.path import exists, join
+from shutil import rmtree
+from tempfile import mkdtemp
+
+
+def _cast(row, schema):
+    #: run a row through the compiled plan for schema
+    return {field: convert(row[field]) if field in row else None for field, convert in Caster.compile(schema)}
 
 
 class TestCaster_Cast(unittest.TestCase):
@@ -27,7 +43,7 @@ class TestCaster_Cast(unittest.TestCase):
             })
         ])
 
-        actual = Caster.cast(simple_row, schema)
+        actual = _cast(simple_row, schema)
         self.assertEqual(actual, {
             'OrgId': '12'
         })
@@ -48,28 +64,12 @@ class TestCaster_Cast(unittest.TestCase):
             })
         ])
 
-        actual = Caster.cast(simple_row, schema)
+        actual = _cast(simple_row, schema)
         self.assertEqual(actual, {
             'OrgId': '12',
             'StationId': 'ABC-abc'
         })
 
-    def test_returns_none_for_missing_schema_items(self):
-        simple_row = {
-            'Something': 'does not get removed'
-        }
-        schema = OrderedDict([
-            ('Missing', {
-                'type': 'String'
-            })
-        ])
-
-        actual = Caster.cast(simple_row, schema)
-        self.assertEqual(actual, {
-            'Something': 'does not get removed',
-            'Missing': None
-        })
-
     def test_strips_whitespace(self):
         simple_row = {
             'Something': '    padded    '
@@ -80,7 +80,7 @@ class TestCaster_Cast(unittest.TestCase):
             })
         ])
 
-        actual = Caster.cast(simple_row, schema)
+        actual = _cast(simple_row, schema)
         self.assertEqual(actual, {
             'Something': 'padded',
         })
@@ -95,7 +95,7 @@ class TestCaster_Cast(unittest.TestCase):
             })
         ])
 
-        actual = Caster.cast(simple_row, schema)
+        actual = _cast(simple_row, schema)
         self.assertEqual(actual, {
             'Something': None,
         })
@@ -110,62 +110,95 @@ class TestCaster_Cast(unittest.TestCase):
             })
         ])
 
-        actual = Caster.cast(simple_row, schema)
+        actual = _cast(simple_row, schema)
         self.assertEqual(actual, {
             'Something': None,
         })
 
 
-class TestCaster_CastForSQL(unittest.TestCase):
-    def test_doesnt_touch_shape(self):
-        input = {'Shape': 'blah'}
-        actual = Caster.cast_for_sql(input)
+class TestCaster_Compile(unittest.TestCase):
+    def test_plan_is_in_schema_order(self):
+        schema = OrderedDict([
+            ('B', {'type': 'String'}),
+            ('A', {'type': 'Double'})
+        ])
 
-        self.assertEqual(actual['Shape'], 'blah')
+        self.assertEqual([field for field, convert in Caster.compile(schema)], ['B', 'A'])
 
-    def test_quotes_strings(self):
-        input = {'hello': 'blah', 'hello2': 'blah2'}
-        actual = Caster.cast_for_sql(input)
+    def test_plan_is_cached_per_schema(self):
+        schema = OrderedDict([('A', {'type': 'String'})])
 
-        self.assertEqual(actual['hello'], "'blah'")
-        self.assertEqual(actual['hello2'], "'blah2'")
+        self.assertIs(Caster.compile(schema), Caster.compile(schema))
 
-    def test_escape_quotes_in_strings(self):
-        input = {'hello': 'bl\'ah', 'hello2': 'bl\'\'ah2'}
-        actual = Caster.cast_for_sql(input)
+    def test_types_without_a_cast_are_none(self):
+        schema = OrderedDict([
+            ('Chrg', {'type': 'Float'}),
+            ('Shape', {'type': 'Geometry'})
+        ])
 
-        self.assertEqual(actual['hello'], "'bl''ah'")
-        self.assertEqual(actual['hello2'], "'bl''''ah2'")
+        self.assertEqual(_cast({'Chrg': 1.5, 'Shape': 'POINT (1 2)'}, schema), {'Chrg': None, 'Shape': None})
+
+    def test_applies_actions(self):
+        schema = OrderedDict([
+            ('SampleTime', {'type': 'String', 'length': 5, 'actions': ['date_conversion']})
+        ])
+
+        self.assertEqual(_cast({'SampleTime': ' 10:30:00 '}, schema), {'SampleTime': datetime.time(10, 30)})
 
-    def test_casts_dates(self):
-        input = {'date': datetime.datetime(2015, 8, 11)}
-        actual = Caster.cast_for_sql(input)
 
-        self.assertEqual(actual['date'], "Cast('2015-08-11' as date)")
+class TestCaster_CastRecords(unittest.TestCase):
+    def test_casts_into_records(self):
+        rows = [{'ResultValue': ' 1.5 ', 'Param': 'Calcium', 'Not In Schema': 'dropped'}]
 
-    def test_casts_old_dates(self):
-        input = {'date': datetime.datetime(1800, 8, 11)}
-        actual = Caster.cast_for_sql(input)
+        actual = Caster.cast_records(rows, Result)
 
-        self.assertEqual(actual['date'], "Cast('1800-08-11' as date)")
+        self.assertIsInstance(actual[0], Result)
+        self.assertEqual(actual[0]['ResultValue'], 1.5)
+        self.assertEqual(actual[0]['Param'], 'Calcium')
+        self.assertIsNone(actual[0]['SampleId'])
+        self.assertNotIn('Not In Schema', actual[0])
 
-    def test_times(self):
-        input = {'time': datetime.time(4, 30, 11)}
-        actual = Caster.cast_for_sql(input)
+    def test_carries_extras(self):
+        actual = Caster.cast_record({'Shape@XY': (1, 2), 'StationId': 'a'}, Station)
 
-        self.assertEqual(actual['time'], "'04:30:11'")
+        self.assertEqual(actual['Shape@XY'], (1, 2))
+        self.assertEqual(actual['StationId'], 'a')
 
-    def test_null_for_none(self):
-        input = {'test': None}
-        actual = Caster.cast_for_sql(input)
 
-        self.assertEqual(actual['test'], 'Null')
+class TestCaster_Dates(unittest.TestCase):
+    def setUp(self):
+        self.schema = OrderedDict([
+            ('SampleDate', {'type': 'Date'}),
+            ('SampleTime', {'type': 'Time'})
+        ])
 
-    def test_convert_numbers_to_strings(self):
-        input = {'num': 1.2345}
-        actual = Caster.cast_for_sql(input)
+    def test_parses_known_formats_without_dateutil(self):
+        self.assertEqual(_fast_parse('2015-01-02'), datetime.datetime(2015, 1, 2))
+        self.assertEqual(_fast_parse('2015-01-02 10:11:12'), datetime.datetime(2015, 1, 2, 10, 11, 12))
+        self.assertEqual(_fast_parse('2015-01-02T10:11:12'), datetime.datetime(2015, 1, 2, 10, 11, 12))
+        self.assertEqual(_fast_parse('9/12/2015'), datetime.datetime(2015, 9, 12))
 
-        self.assertEqual(actual['num'], '1.2345')
+    def test_leaves_other_formats_to_dateutil(self):
+        self.assertIsNone(_fast_parse('2015-02-30'))
+        self.assertIsNone(_fast_parse('01/02/99'))
+        self.assertIsNone(_fast_parse('2015-01-01T10:11:12Z'))
+
+        actual = _cast({'SampleDate': '01/02/99', 'SampleTime': '10:30'}, self.schema)
+        self.assertEqual(actual, {'SampleDate': datetime.datetime(1999, 1, 2), 'SampleTime': datetime.time(10, 30)})
+
+    def test_memoizes_repeated_values(self):
+        _parse_datetime.cache_clear()
+
+        for _ in range(3):
+            _cast({'SampleDate': '2015-01-02', 'SampleTime': ''}, self.schema)
+
+        self.assertEqual(_parse_datetime.cache_info().hits, 2)
+        self.assertEqual(_parse_datetime.cache_info().misses, 1)
+
+    def test_validates_datetimes(self):
+        actual = _cast({'SampleDate': datetime.datetime(1700, 1, 1), 'SampleTime': datetime.time(1, 2)}, self.schema)
+
+        self.assertEqual(actual, {'SampleDate': None, 'SampleTime': datetime.time(1, 2)})
 
 
 class TestReproject(unittest.TestCase):
@@ -237,6 +270,38 @@ class TestNormalizer_NormalizeSample(unittest.TestCase):
         self.assertEqual(row['StationId'], 'ABC-abc')
 
 
+class TestNormalizer_Conversions(unittest.TestCase):
+    def test_converts_units(self):
+        self.assertEqual(Normalizer.get_conversion('calcium', 'ug/l'), (0.001, 'mg/l', 'calcium', 'inorganics, major, metals'))
+        self.assertEqual(Normalizer.get_conversion('carbonate (co3)', 'mg/l'), (None, None, 'carbonate', 'inorganics, major, non-metals'))
+
+    def test_unknown_conversions_keep_the_chemical(self):
+        self.assertEqual(Normalizer.get_conversion('not a chemical', 'mg/l'), (None, None, 'not a chemical', None))
+
+    def test_first_matching_rule_wins(self):
+        #: nitrate-nitrogen mg/l is both a nutrient and renamed to nitrite later in the rules
+        self.assertEqual(Normalizer.get_conversion('nitrate-nitrogen', 'mg/l')[:3], (4.426802887, 'mg/l', 'nitrite'))
+        self.assertEqual(Normalizer.get_conversion('nitrate-nitrogen', 'ug/l')[:3], (0.001, 'mg/l', 'nitrate-nitrogen'))
+
+    def test_datasource_rules(self):
+        self.assertEqual(Normalizer.get_conversion('nitrate', 'mg/l', 'SDWIS')[0], 4.426802887)
+        self.assertIsNone(Normalizer.get_conversion('nitrate', 'mg/l', 'WQP')[0])
+
+    def test_normalize_samples(self):
+        rows = [
+            {'StationId': 'ABC_WQX-abc', 'Param': 'Calcium', 'Unit': 'ug/l', 'ResultValue': 1000},
+            {'StationId': 'ABC', 'Param': 'Calcium', 'Unit': 'ug/l', 'ResultValue': 0},
+            {'StationId': 'ABC', 'Param': 'Calcium', 'Unit': 'ug/l', 'ResultValue': None}
+        ]
+
+        actual = Normalizer.normalize_samples(rows)
+
+        self.assertEqual([row['ResultValue'] for row in actual], [1.0, 0, None])
+        self.assertEqual([row['Param'] for row in actual], ['calcium'] * 3)
+        self.assertEqual(actual[0]['ParamGroup'], 'inorganics, major, metals')
+        self.assertEqual(actual[0]['StationId'], 'ABC-abc')
+
+
 class TestNormalizer_NormlizeStation(unittest.TestCase):
     def setUp(self):
         self.patient = Normalizer()
@@ -255,29 +320,6 @@ class TestNormalizer_NormlizeStation(unittest.TestCase):
         self.assertEqual(row['StationType'], 'Other Groundwater')
 
 
-class TestNormalizer_ReorderFilter(unittest.TestCase):
-    schema = OrderedDict([
-        ('a', {}),
-        ('b', {}),
-        ('c', {})
-    ])
-
-    def setUp(self):
-        self.patient = Normalizer()
-
-    def test_reorders_row_according_to_schema(self):
-        row = {'a': 1, 'c': 3, 'b': 2}
-        expected = {'a': 1, 'b': 2, 'c': 3}
-
-        self.assertEqual(self.patient.reorder_filter(row, self.schema), expected)
-
-    def test_filters_values_not_in_schema(self):
-        row = {'a': 1, 'c': 3, 'b': 2, 'd': 5}
-        expected = {'a': 1, 'b': 2, 'c': 3}
-
-        self.assertEqual(self.patient.reorder_filter(row, self.schema), expected)
-
-
 class TestChargeBalancer(unittest.TestCase):
 
     def setUp(self):
@@ -356,3 +398,395 @@ class TestChargeBalancer(unittest.TestCase):
 
         self.assertEqual(len(rows[0]), 42)
         self.assertIsNone(rows[0]['AnalysisDate'])
+
+    def result(self, sample_id, param, value, detect_cond=None):
+        result = Result()
+        result['SampleId'], result['Param'], result['ResultValue'], result['DetectCond'] = sample_id, param, value, detect_cond
+
+        return result
+
+    def test_get_charge_balances_matches_each_sample(self):
+        samples = [
+            [self.result('1', 'Bicarbonate', 188.0), self.result('1', 'Calcium', 66.0), self.result('1', 'Chloride', 57.0),
+             self.result('1', 'Magnesium', 27.0), self.result('1', 'Nitrate', 0.8), self.result('1', 'Potassium', 7.4),
+             self.result('1', 'Sodium', 109.0), self.result('1', 'Sulfate', 273.0), self.result('1', 'Sulfate', 270.1)],
+            #: missing chloride
+            [self.result('2', 'Bicarbonate', 188.0), self.result('2', 'Calcium', 66.0), self.result('2', 'Magnesium', 27.0),
+             self.result('2', 'Sodium', 109.0), self.result('2', 'Sulfate', 273.0)],
+            [self.result('3', 'Bicarbonate', 139.0), self.result('3', 'Calcium', 46.0), self.result('3', 'Chloride', 12.0),
+             self.result('3', 'Magnesium', 10.0), self.result('3', 'Nitrate', 0.5, 'Not Detected'),
+             self.result('3', 'Sodium plus potassium', 25.0), self.result('3', 'Potassium', 2.0),
+             self.result('3', 'Sulfate', 76.0), self.result('3', 'Iron', 1.0)],
+            #: all zero
+            [self.result('4', param, 0.0) for param in ['Bicarbonate', 'Calcium', 'Chloride', 'Magnesium', 'Sodium', 'Sulfate']]
+        ]
+
+        expected = [row for sample in samples for row in self.patient.get_charge_balance(sample)]
+        actual = self.patient.get_charge_balances([row for sample in samples for row in sample])
+
+        self.assertEqual(len(actual), 9)
+        self.assertEqual([list(row.items()) for row in actual], [list(row.items()) for row in expected])
+
+    def test_get_charge_balances_without_rows(self):
+        self.assertEqual(self.patient.get_charge_balances([]), [])
+
+
+class TestStationRegistry(unittest.TestCase):
+    def setUp(self):
+        self.patient = StationRegistry()
+
+    def record(self, record_type, station_id=None, x=None, y=None):
+        record = record_type()
+        record['StationId'], record['Lon_X'], record['Lat_Y'] = station_id, x, y
+
+        return record
+
+    def test_fills_results_from_seeded_stations(self):
+        self.patient.add_stations([self.record(Station, 'UTAHDWQ-1', -111.5, 40.5),
+                                   self.record(Station, 'UTAHDWQ-2')])
+
+        results = self.patient.fill([self.record(Result, 'UTAHDWQ-1'), self.record(Result, 'UTAHDWQ-2'), Result()])
+
+        self.assertEqual([(r['Lon_X'], r['Lat_Y']) for r in results], [(-111.5, 40.5), (None, None), (None, None)])
+
+    def test_does_not_replace_result_coordinates(self):
+        self.patient.add('1', -111.5, 40.5)
+
+        result = self.patient.fill([self.record(Result, '1', -112.0, 41.0)])[0]
+
+        self.assertEqual((result['Lon_X'], result['Lat_Y']), (-112.0, 41.0))
+
+    def test_load_keeps_seeded_stations(self):
+        self.patient.add('1', -111.5, 40.5)
+
+        self.patient.load([('1', -100.0, 30.0), (' 2 ', -112.0, 41.0)])
+
+        self.assertTrue(self.patient.loaded)
+        self.assertEqual(self.patient.coordinates, {'1': (-111.5, 40.5), '2': (-112.0, 41.0)})
+
+
+class TestCsvGrouper(unittest.TestCase):
+    def setUp(self):
+        self.file_path = join('tests', 'data', 'WQP', 'Results', 'sample_chemistry.csv')
+
+    def test_merged_runs_match_one_run(self):
+        one_run = CsvGrouper(self.file_path, 'ActivityIdentifier')
+        many_runs = CsvGrouper(self.file_path, 'ActivityIdentifier', run_size=3)
+
+        expected = list(one_run.groups())
+
+        self.assertEqual(list(many_runs.groups()), expected)
+        self.assertEqual(many_runs.header, one_run.header)
+
+    def test_groups_every_row_once_in_file_order(self):
+        patient = CsvGrouper(self.file_path, 'ActivityIdentifier', run_size=3)
+
+        groups = list(patient.groups())
+        index = patient.header.index('ActivityIdentifier')
+
+        with open(self.file_path, 'r') as csv_file:
+            rows = [tuple(row) for row in list(csvreader(csv_file))[1:]]
+
+        self.assertEqual(len(groups), len(set(row[index] for row in rows)))
+        for sample_id, group in groups:
+            self.assertEqual(group, [row for row in rows if row[index] == sample_id])
+
+
+class TestCsvIndex(unittest.TestCase):
+    def setUp(self):
+        self.temp_location = mkdtemp()
+        self.file_path = join('tests', 'data', 'WQP', 'Results', 'sample_chemistry.csv')
+
+    def tearDown(self):
+        rmtree(self.temp_location)
+
+    def write_csv(self, content):
+        file_path = join(self.temp_location, 'results.csv')
+
+        with open(file_path, 'wb') as csv_file:
+            csv_file.write(content)
+
+        return file_path
+
+    def test_rows_match_csv_grouper(self):
+        patient = CsvIndex(self.file_path, 'ActivityIdentifier', join(self.temp_location, 'index.sqlite3'))
+        grouper = CsvGrouper(self.file_path, 'ActivityIdentifier')
+        groups = list(grouper.groups())
+
+        header, rows = patient.get_rows([sample_id for sample_id, group in groups] + ['missing'])
+
+        self.assertEqual(header, grouper.header)
+        self.assertEqual(dict(rows), dict(groups))
+        self.assertTrue(patient.is_current())
+
+    def test_reads_quoted_newlines_and_split_samples(self):
+        file_path = self.write_csv(b'Id,Value\r\n1,"a\r\nb"\r\n2,c\r\n1,"d ""e"""\r\n3\r\n')
+        patient = CsvIndex(file_path, 'Id')
+
+        header, rows = patient.get_rows(['1', '3'])
+
+        self.assertEqual(header, ['Id', 'Value'])
+        self.assertEqual(rows, {'1': [('1', 'a\nb'), ('1', 'd "e"')], '3': [('3', None)]})
+        self.assertTrue(exists(file_path + '.index.sqlite3'))
+
+    def test_rebuilds_when_the_file_changes(self):
+        file_path = self.write_csv(b'Id,Value\n1,a\n')
+        patient = CsvIndex(file_path, 'Id')
+
+        self.assertFalse(patient.is_current())
+        self.assertEqual(patient.get_rows(['2'])[1], {})
+
+        with open(file_path, 'ab') as csv_file:
+            csv_file.write(b'2,b\n')
+
+        self.assertFalse(patient.is_current())
+        self.assertEqual(patient.get_rows(['2'])[1], {'2': [('2', 'b')]})
+
+    def test_empty_file(self):
+        patient = CsvIndex(self.write_csv(b''), 'Id')
+
+        self.assertEqual(patient.get_rows(['1']), ([], {}))
+
+
+class TestHttpClient(unittest.TestCase):
+    def setUp(self):
+        self.logger = Mock()
+        self.response = MagicMock()
+        self.response.__enter__.return_value = self.response
+        self.response.encoding = 'utf-8'
+        self.response.iter_content.return_value = iter([b'Id,Value\r\n1,"a\r\nb"\r\n2,', b'\xc3\xa9\r\n'])
+
+    def test_get_csv_streams_to_a_reader(self):
+        with patch('ugsdbseeder.services.get', return_value=self.response) as get:
+            rows = list(HttpClient.get_csv('url', self.logger))
+
+        get.assert_called_once_with('url', stream=True, headers={})
+        self.assertEqual(rows, [['Id', 'Value'], ['1', 'a\r\nb'], ['2', '\xe9']])
+
+    def test_get_csv_compressed(self):
+        with patch('ugsdbseeder.services.get', return_value=self.response):
+            rows = list(HttpClient.get_csv('url', self.logger, compress=True))
+
+        self.assertEqual(rows, [['Id', 'Value'], ['1', 'a\r\nb'], ['2', '\xe9']])
+
+    def test_get_count(self):
+        response = Mock(headers={'total-result-count': '12'})
+
+        with patch('ugsdbseeder.services.head', return_value=response):
+            self.assertEqual(HttpClient.get_count('url'), 12)
+
+        response.headers = {}
+
+        with patch('ugsdbseeder.services.head', return_value=response):
+            self.assertIsNone(HttpClient.get_count('url'))
+
+    def test_download_metrics(self):
+        with patch('ugsdbseeder.services.get', return_value=self.response):
+            spool, encoding, metrics = HttpClient.download('url', self.logger)
+
+        self.assertEqual(metrics['bytes'], 26)
+        self.assertEqual(len(spool.read()), 26)
+        spool.close()
+        self.assertEqual(encoding, 'utf-8')
+        self.assertIn('bytes_per_second', metrics)
+
+
+class TestHttpCache(unittest.TestCase):
+    def setUp(self):
+        self.location = mkdtemp()
+        self.patient = HttpCache(join(self.location, 'cache'))
+        self.logger = Mock()
+
+    def tearDown(self):
+        HttpClient.cache = None
+        rmtree(self.location)
+
+    def respond(self, get, body=b'Id\n1\n', status_code=200):
+        response = MagicMock(status_code=status_code, encoding='utf-8', headers={'ETag': '"1"'})
+        response.__enter__.return_value = response
+        response.iter_content.return_value = iter([body])
+        get.return_value = response
+
+    def store(self, url, body):
+        with self.patient.store(url, {'ETag': '"1"', 'Last-Modified': 'Sat, 01 Jan 2000 00:00:00 GMT'}, 'utf-8') as f:
+            f.write(body)
+
+    def test_key_normalizes_urls(self):
+        self.assertEqual(HttpCache.key('HTTP://Example.com/search?b=2&a=1#top'),
+                         HttpCache.key('http://example.com/search?a=1&b=2'))
+        self.assertNotEqual(HttpCache.key('http://example.com/search?a=1'), HttpCache.key('http://example.com/search?a=2'))
+
+    def test_stores_and_reads_bodies(self):
+        self.store('http://example.com/a', b'body')
+        entry = self.patient.get('http://example.com/a')
+        writer = BytesIO()
+
+        self.assertEqual(self.patient.read(entry, writer), 4)
+        self.assertEqual(writer.getvalue(), b'body')
+        self.assertEqual(HttpCache.conditional_headers(entry), {'If-None-Match': '"1"',
+                                                                'If-Modified-Since': 'Sat, 01 Jan 2000 00:00:00 GMT'})
+        self.assertIsNone(self.patient.get('http://example.com/b'))
+
+    def test_evicts_least_recently_used(self):
+        self.store('http://example.com/a', b'a')
+        size = stat(join(self.patient.location, HttpCache.key('http://example.com/a') + '.gz')).st_size
+        self.patient.max_bytes = size * 2
+
+        self.store('http://example.com/b', b'b')
+        self.patient.read(self.patient.get('http://example.com/a'), BytesIO())
+        self.store('http://example.com/c', b'c')
+
+        self.assertIsNotNone(self.patient.get('http://example.com/a'))
+        self.assertIsNone(self.patient.get('http://example.com/b'))
+        self.assertIsNotNone(self.patient.get('http://example.com/c'))
+
+    def test_download_revalidates_cached_responses(self):
+        HttpClient.cache = self.patient
+
+        with patch('ugsdbseeder.services.get') as get:
+            self.respond(get)
+            self.assertEqual(list(HttpClient.get_csv('http://example.com/a', self.logger)), [['Id'], ['1']])
+
+            self.respond(get, body=b'', status_code=304)
+            spool, encoding, metrics = HttpClient.download('http://example.com/a', self.logger)
+
+        get.assert_called_with('http://example.com/a', stream=True, headers={'If-None-Match': '"1"'})
+        self.assertEqual(spool.read(), b'Id\n1\n')
+        self.assertTrue(metrics['cached'])
+        spool.close()
+
+    def test_counts_are_replayed_offline(self):
+        HttpClient.cache = self.patient
+
+        with patch('ugsdbseeder.services.head', return_value=Mock(headers={})):
+            self.assertIsNone(HttpClient.get_count('http://example.com/a'))
+
+        self.patient.offline = True
+
+        with patch('ugsdbseeder.services.head') as head:
+            self.assertIsNone(HttpClient.get_count('http://example.com/a'))
+            self.assertRaises(Exception, HttpClient.get_count, 'http://example.com/b')
+
+        self.assertFalse(head.called)
+
+    @raises(Exception)
+    def test_offline_requires_a_cached_response(self):
+        HttpClient.cache = self.patient
+        self.store('http://example.com/a', b'Id\n1\n')
+        self.patient.offline = True
+
+        with patch('ugsdbseeder.services.get') as get:
+            self.assertEqual(list(HttpClient.get_csv('http://example.com/a', self.logger)), [['Id'], ['1']])
+            self.assertFalse(get.called)
+
+            HttpClient.get_csv('http://example.com/b', self.logger)
+
+
+class TestRowBuffer(unittest.TestCase):
+    def test_flushes_when_full(self):
+        flush = Mock()
+        patient = RowBuffer(flush, size=3)
+
+        patient.extend([[1], [2]])
+        self.assertFalse(flush.called)
+
+        patient.extend([[3], [4]])
+        flush.assert_called_once_with([[1], [2], [3], [4]])
+        self.assertEqual(patient.rows, [])
+
+    def test_flushes_when_rows_have_waited(self):
+        flush = Mock()
+        patient = RowBuffer(flush, size=100, seconds=0)
+
+        patient.extend([[1]])
+
+        flush.assert_called_once_with([[1]])
+
+    def test_flush_sends_remaining_rows(self):
+        flush = Mock()
+        patient = RowBuffer(flush, size=100)
+
+        patient.extend([[1]])
+        patient.flush()
+
+        flush.assert_called_once_with([[1]])
+
+    def test_flush_skips_empty_buffer(self):
+        flush = Mock()
+        patient = RowBuffer(flush)
+
+        patient.flush()
+
+        self.assertFalse(flush.called)
+
+
+class TestConnectionPool(unittest.TestCase):
+
+    def setUp(self):
+        self.factory = Mock(side_effect=lambda connection_string: Mock())
+        self.patient = ConnectionPool(self.factory, Mock(), ['SET NOCOUNT ON'])
+
+    def test_reuses_connection(self):
+        cursor = self.patient.cursor('db')
+
+        self.assertIs(self.patient.cursor('db'), cursor)
+        self.assertEqual(self.factory.call_count, 1)
+        cursor.execute.assert_called_once_with('SET NOCOUNT ON')
+
+    def test_connects_per_connection_string(self):
+        self.assertIsNot(self.patient.cursor('db'), self.patient.cursor('other db'))
+        self.assertEqual(self.factory.call_count, 2)
+
+    def test_close_all_closes_connections(self):
+        cursor = self.patient.cursor('db')
+
+        self.patient.close_all()
+
+        cursor.connection.close.assert_called_once_with()
+        self.assertIsNot(self.patient.cursor('db'), cursor)
+
+    def test_pickles_without_connections(self):
+        self.patient.cursor('db')
+
+        state = self.patient.__getstate__()
+
+        self.assertEqual(state['cursors'], {})
+        self.assertEqual(len(self.patient.cursors), 1)
+
+
+class TestCheckpoint(unittest.TestCase):
+    def setUp(self):
+        self.patient = Checkpoint(':memory:')
+
+    def tearDown(self):
+        self.patient.close()
+
+    def test_records_samples_by_program_and_source(self):
+        self.patient.complete_samples('WQP', 'a.csv', ['1', ' 2 ', 3])
+        self.patient.complete_samples('WQP', 'a.csv', ['1'])
+        self.patient.complete_samples('SDWIS', '', ['4'])
+
+        self.assertEqual(self.patient.get_completed_samples('WQP', 'a.csv'), set(['1', '2', '3']))
+        self.assertEqual(self.patient.get_completed_samples('WQP', 'b.csv'), set())
+
+    def test_records_steps(self):
+        self.assertFalse(self.patient.is_complete('WQP', 'stations'))
+
+        self.patient.complete('WQP', 'stations')
+
+        self.assertTrue(self.patient.is_complete('WQP', 'stations'))
+        self.assertFalse(self.patient.is_complete('SDWIS', 'stations'))
+
+    def test_clear_forgets_everything(self):
+        self.patient.complete('WQP', 'stations')
+        self.patient.complete_samples('WQP', 'a.csv', ['1'])
+
+        self.patient.clear()
+
+        self.assertFalse(self.patient.is_complete('WQP', 'stations'))
+        self.assertEqual(self.patient.get_completed_samples('WQP', 'a.csv'), set())
+
+    def test_pickles_without_connections(self):
+        self.patient.complete('WQP', 'stations')
+
+        self.assertEqual(pickle.loads(pickle.dumps(self.patient)).connections, {})
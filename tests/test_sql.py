@@ -8,10 +8,18 @@ test the sql module
 '''
 
 import unittest
-from ugsdbseeder.sql import update_row
+from ugsdbseeder.sql import find_new_keys, insert_rows, key_statements, merge_rows, merge_statements, update_rows
+from ugsdbseeder import sqlite
+from mock import Mock
 
 
-class TestSqlFunctions(unittest.TestCase):
+class TestUpdateRows(unittest.TestCase):
+    def assertPointAlmostEqual(self, shape, x, y):
+        actual_x, actual_y = shape[len('POINT ('):-1].split()
+
+        self.assertAlmostEqual(float(actual_x), x, places=6)
+        self.assertAlmostEqual(float(actual_y), y, places=6)
+
     def test_update_row_with_valid_lat_lon(self):
         row = {
             'Shape': None,
@@ -19,10 +27,9 @@ class TestSqlFunctions(unittest.TestCase):
             'Lat_Y': 40
         }
         datasource = 'testing'
-        actual = update_row(row, datasource)
-        expected = 'geometry::STGeomFromText(\'POINT ({} {})\', 26912)'.format(243900.35202798274, 4432069.056784666)
+        actual = update_rows([row], datasource)[0]
 
-        self.assertEqual(actual['Shape'], expected)
+        self.assertPointAlmostEqual(actual['Shape'], 243900.35202798274, 4432069.056784666)
         self.assertEqual(actual['DataSource'], datasource)
 
     def test_shape_is_none_with_invalid_lat_lon(self):
@@ -32,7 +39,7 @@ class TestSqlFunctions(unittest.TestCase):
             'Lat_Y': 40
         }
         datasource = 'testing'
-        actual = update_row(row, datasource)
+        actual = update_rows([row], datasource)[0]
 
         self.assertIsNone(actual['Shape'])
         self.assertEqual(actual['DataSource'], datasource)
@@ -45,10 +52,173 @@ class TestSqlFunctions(unittest.TestCase):
         }
 
         datasource = 'testing'
-        actual = update_row(row, datasource)
-
-        expected = 'geometry::STGeomFromText(\'POINT ({} {})\', 26912)'.format(243900.35202798274, 4432069.056784666)
+        actual = update_rows([row], datasource)[0]
 
-        self.assertEqual(actual['Shape'], expected)
+        self.assertPointAlmostEqual(actual['Shape'], 243900.35202798274, 4432069.056784666)
         self.assertEqual(actual['DataSource'], datasource)
         self.assertFalse('Shape@XY' in actual)
+
+    def test_reprojects_a_batch(self):
+        rows = [
+            {'Shape': None, 'Lon_X': -114, 'Lat_Y': 40},
+            {'Shape': None, 'Lon_X': None, 'Lat_Y': 40},
+            {'Shape': None, 'Shape@XY': (114, 40), 'Lon_X': 4, 'Lat_Y': 5},
+            {'Lon_X': -114, 'Lat_Y': 40}
+        ]
+
+        actual = update_rows(rows, 'testing')
+
+        self.assertEqual([row['DataSource'] for row in actual], ['testing'] * 4)
+        self.assertTrue(actual[0]['Shape'].startswith('POINT (243900.352'))
+        self.assertIsNone(actual[1]['Shape'])
+        #: positive longitudes are flipped
+        self.assertEqual(actual[2]['Shape'], actual[0]['Shape'])
+        self.assertNotIn('Shape@XY', actual[2])
+        #: results do not have a shape
+        self.assertNotIn('Shape', actual[3])
+
+    def test_empty_batch(self):
+        self.assertEqual(update_rows([], 'testing'), [])
+
+
+class TestInsertRows(unittest.TestCase):
+    def test_sends_rows_in_batches(self):
+        cursor = Mock()
+        rows = [[i] for i in range(5)]
+
+        insert_rows(rows, 'insert into Test (a) values (?)', cursor, batch_size=2)
+
+        self.assertTrue(cursor.fast_executemany)
+        self.assertEqual(cursor.executemany.call_count, 3)
+        self.assertEqual(cursor.executemany.call_args_list[0][0], ('insert into Test (a) values (?)', [[0], [1]]))
+        self.assertEqual(cursor.executemany.call_args_list[2][0], ('insert into Test (a) values (?)', [[4]]))
+
+    def test_commits_once_per_batch(self):
+        cursor = Mock()
+        rows = [[i] for i in range(5)]
+
+        insert_rows(rows, 'insert into Test (a) values (?)', cursor, batch_size=2)
+
+        self.assertEqual(cursor.commit.call_count, 3)
+
+    def test_does_nothing_without_rows(self):
+        cursor = Mock()
+
+        insert_rows([], 'insert into Test (a) values (?)', cursor)
+
+        self.assertFalse(cursor.executemany.called)
+        self.assertFalse(cursor.commit.called)
+
+    def test_rolls_back_failed_batch(self):
+        cursor = Mock()
+        cursor.executemany.side_effect = Exception('bad row')
+
+        with self.assertRaises(Exception):
+            insert_rows([[1]], 'insert into Test (a) values (?)', cursor)
+
+        self.assertEqual(cursor.rollback.call_count, 1)
+        self.assertFalse(cursor.commit.called)
+
+
+class TestMergeRows(unittest.TestCase):
+    def test_stages_every_batch_and_merges_once(self):
+        cursor = Mock()
+        merge = {'create': 'create', 'truncate': 'truncate', 'stage': 'stage', 'merge': 'merge'}
+        rows = [[i] for i in range(3)]
+
+        merge_rows(rows, merge, cursor, batch_size=2)
+
+        self.assertEqual([c[0][0] for c in cursor.execute.call_args_list], ['create', 'truncate', 'merge'])
+        self.assertEqual(cursor.executemany.call_args_list[0][0], ('stage', [[0], [1]]))
+        self.assertEqual(cursor.executemany.call_args_list[1][0], ('stage', [[2]]))
+        self.assertEqual(cursor.commit.call_count, 2)
+
+    def test_keeps_samples_that_span_batches(self):
+        cursor = sqlite.create_cursor(':memory:')
+        cursor.execute('CREATE TABLE Results (SampleId TEXT, Param TEXT)')
+        cursor.execute('INSERT INTO Results VALUES (\'existing\', \'Calcium\')')
+        merge = {
+            'create': 'CREATE TEMP TABLE IF NOT EXISTS Staging (SampleId TEXT, Param TEXT)',
+            'truncate': 'DELETE FROM Staging',
+            'stage': 'insert into Staging (SampleId, Param) values (?, ?)',
+            'merge': ('insert into Results (SampleId, Param) SELECT SampleId, Param FROM Staging s WHERE NOT EXISTS('
+                      'SELECT 1 FROM Results t WHERE t.[SampleId] = s.[SampleId])')
+        }
+        #: the last sample and its charge balance row are split across the batches
+        rows = [['1', 'Calcium'], ['2', 'Calcium'], ['2', 'Sodium'], ['2', 'Charge Balance'], ['existing', 'Sodium']]
+
+        merge_rows(rows, merge, cursor, batch_size=2)
+
+        self.assertEqual(cursor.execute('SELECT SampleId, Param FROM Results').fetchall(),
+                         [('existing', 'Calcium'), ('1', 'Calcium'), ('2', 'Calcium'), ('2', 'Sodium'),
+                          ('2', 'Charge Balance')])
+        cursor.connection.close()
+
+    def test_rolls_back_failed_batch(self):
+        cursor = Mock()
+        cursor.executemany.side_effect = Exception('bad row')
+        merge = {'create': 'create', 'truncate': 'truncate', 'stage': 'stage', 'merge': 'merge'}
+
+        with self.assertRaises(Exception):
+            merge_rows([[1]], merge, cursor)
+
+        self.assertEqual(cursor.rollback.call_count, 1)
+
+
+class TestFindNewKeys(unittest.TestCase):
+    def setUp(self):
+        self.statements = {'drop': 'drop', 'create': 'create', 'stage': 'stage', 'index': 'index', 'select': 'select'}
+
+    def test_stages_keys_and_selects_once(self):
+        cursor = Mock()
+        cursor.execute.return_value.fetchall.return_value = [['a'], ['b'], ['a']]
+
+        new_keys = find_new_keys([('a',), ('b',), ('c',)], self.statements, cursor, batch_size=2)
+
+        self.assertEqual(new_keys, set([('a',), ('b',)]))
+        self.assertEqual([c[0][0] for c in cursor.execute.call_args_list], ['drop', 'create', 'index', 'select', 'drop'])
+        self.assertEqual(cursor.executemany.call_args_list[0][0], ('stage', [('a',), ('b',)]))
+        self.assertEqual(cursor.executemany.call_args_list[1][0], ('stage', [('c',)]))
+        self.assertEqual(cursor.commit.call_count, 1)
+
+    def test_no_keys(self):
+        cursor = Mock()
+
+        self.assertEqual(find_new_keys([], self.statements, cursor), set())
+        self.assertFalse(cursor.execute.called)
+
+    def test_rolls_back_failure(self):
+        cursor = Mock()
+        cursor.executemany.side_effect = Exception('bad key')
+
+        with self.assertRaises(Exception):
+            find_new_keys([('a',)], self.statements, cursor)
+
+        self.assertEqual(cursor.rollback.call_count, 1)
+
+    def test_key_statements_anti_join(self):
+        statements = key_statements('Results', ['SampleId', 'Param'])
+
+        self.assertEqual(statements['stage'], 'insert into #ResultsKeys ([SampleId], [Param]) values (?, ?)')
+        self.assertEqual(statements['select'], 'SELECT DISTINCT [SampleId], [Param] FROM #ResultsKeys s WHERE NOT EXISTS('
+                                               'SELECT 1 FROM Results t WHERE t.[SampleId] = s.[SampleId] AND '
+                                               't.[Param] = s.[Param])')
+
+
+class TestMergeStatements(unittest.TestCase):
+    def test_results_are_matched_on_keys(self):
+        merge = merge_statements(['SampleDate', 'SampleId', 'Param'])['result_insert']
+
+        self.assertTrue(merge['stage'].startswith('insert into #ResultsStaging (AnalysisDate, AnalytMeth,'))
+        self.assertTrue(merge['merge'].endswith('WHERE NOT EXISTS(SELECT 1 FROM Results t WHERE '
+                                                '(t.[SampleDate] = s.[SampleDate] OR (t.[SampleDate] IS NULL AND '
+                                                's.[SampleDate] IS NULL)) AND '
+                                                '(t.[SampleId] = s.[SampleId] OR (t.[SampleId] IS NULL AND s.[SampleId] IS NULL)) AND '
+                                                '(t.[Param] = s.[Param] OR (t.[Param] IS NULL AND s.[Param] IS NULL)))'))
+
+    def test_stations_are_matched_on_station_id(self):
+        merge = merge_statements(['SampleId'])['station_insert']
+
+        self.assertTrue(merge['stage'].endswith('geometry::STGeomFromText(?, 26912))'))
+        self.assertTrue(merge['merge'].endswith('WHERE NOT EXISTS(SELECT 1 FROM Stations t WHERE (t.[StationId] = s.[StationId] OR '
+                                                '(t.[StationId] IS NULL AND s.[StationId] IS NULL)))'))
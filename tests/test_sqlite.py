@@ -0,0 +1,114 @@
+#!usr/bin/env python
+# -*- coding: utf-8 -*-
+
+'''
+test_sqlite.py
+----------------------------------
+test the sqlite backend
+'''
+
+import unittest
+from datetime import datetime, time
+from os.path import dirname, join
+from ugsdbseeder import schema, sqlite
+
+
+def read_script(name):
+    with open(join(dirname(__file__), '..', 'scripts', sqlite.scripts[name]), 'r') as f:
+        return f.read()
+
+
+class TestSqlite(unittest.TestCase):
+
+    def setUp(self):
+        self.cursor = sqlite.create_cursor(':memory:')
+
+        sqlite.execute_script(read_script('tables'), self.cursor)
+        sqlite.execute_script(read_script('indices'), self.cursor)
+
+    def tearDown(self):
+        self.cursor.connection.close()
+
+    def test_creates_schema(self):
+        tables = [row[0] for row in self.cursor.execute('SELECT name FROM sqlite_master WHERE type = \'table\'')]
+
+        for table in ['Results', 'Stations', 'Params']:
+            self.assertIn(table, tables)
+
+    def test_insert_statements_match_schema_columns(self):
+        for table, fields in [('Stations', schema.station), ('Results', schema.result)]:
+            columns = [row[1] for row in self.cursor.execute('PRAGMA table_info({})'.format(table))][1:]
+
+            self.assertEqual([column.lower() for column in columns], [field.lower() for field in fields.keys()])
+
+    def test_insert_rows(self):
+        station = dict.fromkeys(schema.station.keys())
+        station.update({'StationId': 'UTAHDWQ-4900440', 'Lon_X': -114, 'Lat_Y': 40, 'Shape': None})
+        station = sqlite.update_rows([station], 'WQP')[0]
+
+        result = dict.fromkeys(schema.result.keys())
+        result.update({'SampleId': '1', 'SampleDate': datetime(2015, 1, 2), 'SampleTime': time(12, 30), 'ResultValue': 1.5})
+
+        sqlite.insert_rows([list(station.values())], sqlite.sql_statements['station_insert'], self.cursor)
+        sqlite.insert_rows([list(result.values())], sqlite.sql_statements['result_insert'], self.cursor)
+
+        shape, datasource = self.cursor.execute('SELECT Shape, DataSource FROM Stations').fetchone()
+        self.assertTrue(shape.startswith('POINT ('))
+        self.assertEqual(datasource, 'WQP')
+
+        self.assertEqual(self.cursor.execute('SELECT SampleDate, SampleTime, ResultValue FROM Results').fetchone(),
+                         ('2015-01-02 00:00:00', '12:30:00', 1.5))
+
+    def test_insert_rows_rolls_back_failed_batch(self):
+        station = dict.fromkeys(schema.station.keys())
+
+        with self.assertRaises(Exception):
+            #: StationId is not nullable
+            sqlite.insert_rows([list(station.values())], sqlite.sql_statements['station_insert'], self.cursor)
+
+        self.assertEqual(self.cursor.execute('SELECT count(*) FROM Stations').fetchone()[0], 0)
+
+    def test_indices_can_be_dropped_and_rebuilt(self):
+        indices = [tuple(row) for row in self.cursor.execute(sqlite.index_statements['enabled']).fetchall()]
+
+        self.assertEqual(len(indices), 12)
+
+        for index in indices:
+            self.cursor.execute(sqlite.index_statements['disable'].format(*index))
+
+        self.assertEqual(self.cursor.execute(sqlite.index_statements['enabled']).fetchall(), [])
+
+        for index in indices:
+            self.cursor.execute(sqlite.index_statements['rebuild'].format(*index))
+
+        self.assertEqual(len(self.cursor.execute(sqlite.index_statements['enabled']).fetchall()), 12)
+
+    def test_merge_rows_skips_existing_rows(self):
+        merge = sqlite.merge_statements(['SampleDate', 'SampleId', 'Param'])
+        rows = []
+
+        for sample_date, param in [(datetime(2015, 1, 2), 'Calcium'), (None, 'Charge Balance')]:
+            result = dict.fromkeys(schema.result.keys())
+            result.update({'SampleId': '1', 'SampleDate': sample_date, 'Param': param})
+            rows.append(list(result.values()))
+
+        sqlite.merge_rows(rows[:1], merge['result_insert'], self.cursor)
+        #: the charge balance row without a SampleDate is only inserted once when resuming
+        sqlite.merge_rows(rows, merge['result_insert'], self.cursor)
+        sqlite.merge_rows(rows, merge['result_insert'], self.cursor)
+
+        self.assertEqual(self.cursor.execute('SELECT SampleDate, Param FROM Results').fetchall(),
+                         [('2015-01-02 00:00:00', 'Calcium'), (None, 'Charge Balance')])
+
+    def test_merge_indices_exist(self):
+        indices = [tuple(row[:2]) for row in self.cursor.execute(sqlite.index_statements['enabled'])]
+
+        for index in sqlite.merge_indices:
+            self.assertIn(index, indices)
+
+    def test_populates_params(self):
+        self.cursor.executemany('INSERT INTO Results (Param) VALUES (?)', [('Calcium',), ('Calcium',), (None,)])
+
+        sqlite.execute_script(read_script('params'), self.cursor)
+
+        self.assertEqual(self.cursor.execute('SELECT Param FROM Params').fetchall(), [('Calcium',)])